@@ -7,6 +7,8 @@ __author__ = 'Lucas Ou-Yang'
 __license__ = 'MIT'
 __copyright__ = 'Copyright 2014, Lucas Ou-Yang'
 
+import sys
+
 from .api import (build, build_article, fulltext, hot, languages,
                   popular_urls, Configuration as Config)
 from .article import Article, ArticleException
@@ -14,6 +16,10 @@ from .mthreading import NewsPool
 from .source import Source
 from .version import __version__
 
+# The asyncio engine needs Python 3.7, the rest of the library does not
+if sys.version_info >= (3, 7):
+    from .aio import AsyncNewsPool
+
 news_pool = NewsPool()
 
 # Set default logging handler to avoid "No handler found" warnings.
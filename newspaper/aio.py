@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+"""
+Anything that has to do with asyncio in this library must be
+abstracted in this file, the same way mthreading.py holds the
+threaded engine. Requires Python 3.7 and aiohttp, the sync library
+never imports it.
+"""
+__title__ = 'newspaper'
+__author__ = 'Lucas Ou-Yang'
+__license__ = 'MIT'
+__copyright__ = 'Copyright 2014, Lucas Ou-Yang'
+
+import asyncio
+import contextlib
+import contextvars
+import datetime
+import logging
+import time
+from urllib.parse import urlparse
+
+import requests
+
+from requests.structures import CaseInsensitiveDict
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from . import network, proxies, redirects
+from .configuration import Configuration
+from .mthreading import ConcurrencyException
+from .urls import get_domain
+
+log = logging.getLogger(__name__)
+
+
+# aiohttp session of the running `aio_session()` block, if any
+_aio_session = contextvars.ContextVar('newspaper_aio_session', default=None)
+
+
+def _require_aiohttp():
+    if aiohttp is None:
+        raise ImportError('The asyncio download engine requires aiohttp, '
+                          'install it via `pip3 install newspaper3k[async]`')
+
+
+@contextlib.asynccontextmanager
+async def aio_session(config=None):
+    """Opens the aiohttp session used by every `aget_html` call made
+    inside the block. The asyncio counterpart of `network.get_session`:
+    one connector holds at most `config.max_concurrent_requests`
+    connections in total and `config.pool_maxsize` per host. Nested
+    blocks reuse the outermost session.
+    """
+    session = _aio_session.get()
+    if session is not None and not session.closed:
+        yield session
+        return
+
+    _require_aiohttp()
+    async with _new_aio_session(config or Configuration()) as session:
+        token = _aio_session.set(session)
+        try:
+            yield session
+        finally:
+            _aio_session.reset(token)
+            network.save_urls()
+
+
+def _new_aio_session(config):
+    connector = aiohttp.TCPConnector(
+        limit=config.max_concurrent_requests,
+        limit_per_host=config.pool_maxsize,
+        use_dns_cache=bool(config.dns_cache_ttl),
+        ttl_dns_cache=config.dns_cache_ttl,
+        force_close=not config.keep_alive)
+    return aiohttp.ClientSession(connector=connector,
+                                 cookie_jar=aiohttp.DummyCookieJar())
+
+
+async def _closed_with_loop(session):
+    """Closes `session` when the event loop shuts down its async
+    generators, which `asyncio.run` does before closing the loop
+    """
+    try:
+        yield session
+    finally:
+        await session.close()
+
+
+async def get_aio_session(config=None):
+    """Returns the aiohttp session of the enclosing `aio_session()` block,
+    else the one of `config` for the running event loop. Those are built
+    lazily, so that the `aget_html` calls made outside of a block share
+    their connections too.
+    """
+    session = _aio_session.get()
+    if session is not None and not session.closed:
+        return session
+
+    _require_aiohttp()
+    config = config or Configuration()
+    loop = asyncio.get_running_loop()
+    entry = config._aio_sessions.get(loop)
+    if entry is not None and not entry[0].closed:
+        return entry[0]
+    session = _new_aio_session(config)
+    keeper = _closed_with_loop(session)
+    await keeper.__anext__()
+    config._aio_sessions[loop] = (session, keeper)
+    return session
+
+
+def _build_response(aio_response, content, truncated=False):
+    """Wraps a finished aiohttp response into a `requests.Response` so the
+    sync and async engines share the same decoding and error handling
+    """
+    response = requests.Response()
+    response.status_code = aio_response.status
+    response.reason = aio_response.reason
+    response.url = str(aio_response.url)
+    response.headers = CaseInsensitiveDict(aio_response.headers)
+    response.encoding = requests.utils.get_encoding_from_headers(
+        response.headers)
+    response._content = content
+    response.truncated = truncated
+    response.history = [_build_response(hop, b'')
+                         for hop in aio_response.history]
+    return response
+
+
+async def aget_html(url, config=None, revalidate=False):
+    """Asyncio version of `network.get_html`, HTTP response code agnostic
+    """
+    try:
+        return await aget_html_2XX_only(url, config, revalidate)
+    except requests.exceptions.RequestException as e:
+        log.debug('aget_html() error. %s on URL: %s' % (e, url))
+        return ''
+
+
+async def _aread_body(url, aio_response, config, stop_at_amp=False,
+                      build_doc=False):
+    """Asyncio version of `network._read_body`, returns the body read,
+    None when it was skipped
+    """
+    if network._skip_body(url, aio_response.headers, config):
+        aio_response.close()
+        return None
+
+    body = network._Body(url, config,
+                         aio_response.headers.get('Content-Type'),
+                         stop_at_amp, build_doc)
+    async for chunk in aio_response.content.iter_chunked(network.CHUNK_SIZE):
+        if not body.add(chunk):
+            aio_response.close()
+            break
+    # aiohttp versions which do not count the encoded bytes only know the
+    # decoded size
+    wire_bytes = getattr(aio_response.content, 'total_raw_bytes',
+                         aio_response.content.total_bytes)
+    network.transfers.record(get_domain(url), wire_bytes, body.size,
+                             aio_response.headers.get('Content-Encoding'))
+    return body
+
+
+async def aget_html_2XX_only(url, config=None, revalidate=False):
+    """Asyncio version of `network.get_html_2XX_only`. Network failures are
+    raised as `requests` exceptions so callers handle both engines the
+    same way.
+    """
+    return (await afetch(url, config, revalidate))[0]
+
+
+async def _asend(url, config, revalidate=False, stop_at_amp=False,
+                 build_doc=False):
+    """Asyncio version of `network._send`
+    """
+    target = redirects.resolve(url, config)
+    key = network._flight_key(target, config, revalidate, stop_at_amp)
+    try:
+        response = network._shared(*await network.single_flight.ado(
+            key, _asend_once, target, config, revalidate, stop_at_amp,
+            build_doc))
+    except requests.exceptions.RequestException:
+        network._sent_to(url, target)
+        raise
+    network._sent_to(url, target, response)
+    return response
+
+
+async def _asend_once(url, config, revalidate=False, stop_at_amp=False,
+                      build_doc=False):
+    timeout = network.host_latencies.timeout(get_domain(url), config)
+    kwargs = network.get_request_kwargs(timeout, config.browser_user_agent,
+                                        config.proxies, config.headers)
+    request_headers = kwargs['headers']
+    response = network._from_cache(url, config, request_headers, stop_at_amp)
+    if response is not None:
+        return response
+
+    kwargs['headers'] = network._negotiated(kwargs['headers'], config,
+                                            aio=True)
+    stored = network._validators.load(url) if revalidate else None
+    if stored is not None:
+        kwargs['headers'] = network._conditional_headers(kwargs['headers'],
+                                                         stored)
+
+    proxy = proxies.select(url, config)
+    session = await get_aio_session(config)
+    started = time.time()
+    try:
+        async with session.get(
+                url, headers=kwargs['headers'],
+                proxy=proxy or config.proxies.get(urlparse(url).scheme),
+                timeout=aiohttp.ClientTimeout(
+                    sock_connect=timeout, sock_read=timeout),
+                allow_redirects=True) as aio_response:
+            elapsed = time.time() - started
+            body = await _aread_body(url, aio_response, config, stop_at_amp,
+                                     build_doc)
+    except asyncio.TimeoutError as e:
+        proxies.record(proxy, started, config)
+        network._record_host(url, config, timeout=timeout)
+        raise requests.exceptions.Timeout(
+            'Timed out fetching %s' % url) from e
+    except aiohttp.ClientError as e:
+        proxies.record(proxy, started, config)
+        network._record_host(url, config)
+        raise requests.exceptions.ConnectionError(
+            '%s on URL %s' % (e, url)) from e
+
+    if body is None:
+        response = _build_response(aio_response, b'')
+        response.doc = response.amp_url = None
+    else:
+        response = _build_response(aio_response, body.content,
+                                   not body.complete)
+        response.doc = body.doc
+        response.amp_url = body.amp_url
+    response.elapsed = datetime.timedelta(seconds=elapsed)
+    proxies.record(proxy, started, config, response)
+    network._record_host(url, config, response)
+    if config.remember_redirects:
+        redirects.redirect_map.record(response)
+    if revalidate:
+        response = network._revalidated(url, response, stored)
+    network._to_cache(url, config, request_headers, response, stop_at_amp)
+    return response
+
+
+async def afetch(url, config=None, revalidate=False, decode=True,
+                 stop_at_amp=False, build_doc=False):
+    """Asyncio version of `network.fetch`
+    """
+    config = config or Configuration()
+    response = await _asend(url, config, revalidate, stop_at_amp, build_doc)
+    html = network._response_html(response, config, decode)
+
+    if config.http_success_only:
+        response.raise_for_status()
+
+    return html, response
+
+
+async def agather_html(urls, config=None, revalidate=False):
+    """Asyncio counterpart of `network.multithread_request`, downloads
+    every url concurrently over one session and returns their html in
+    input order, '' for the urls which failed
+    """
+    config = config or Configuration()
+    async with aio_session(config):
+        return await asyncio.gather(*[
+            aget_html(url, config, revalidate) for url in urls])
+
+
+class AsyncNewsPool(object):
+
+    def __init__(self, config=None):
+        """
+        Asyncio equivalent of `NewsPool`. Every article of every source
+        is downloaded concurrently on a single thread over one shared
+        aiohttp session. Politeness comes from the connector, which keeps
+        at most `config.pool_maxsize` connections open per host.
+
+        >>> import asyncio
+        >>> import newspaper
+        >>> from newspaper import AsyncNewsPool
+
+        >>> cnn_paper = newspaper.build('http://cnn.com')
+        >>> tc_paper = newspaper.build('http://techcrunch.com')
+
+        >>> pool = AsyncNewsPool()
+        >>> pool.set([cnn_paper, tc_paper])
+        >>> asyncio.run(pool.join())
+
+        # All of your papers should have their articles html all populated now.
+        >>> cnn_paper.articles[50].html
+        u'<html>blahblah ... '
+        """
+        self.news_list = None
+        self.config = config or Configuration()
+
+    def set(self, news_list):
+        """news_list can be a list of `Article`, `Source`, or both.
+        """
+        self.news_list = list(news_list)
+
+    async def join(self):
+        """Downloads everything passed to `set(..)` and resets the pool
+        """
+        from .source import Source
+
+        if self.news_list is None:
+            raise ConcurrencyException('Call set(..) with a list of source objects '
+                                       'before calling .join(..)')
+        news_list, self.news_list = self.news_list, None
+
+        async with aio_session(self.config):
+            await asyncio.gather(*[
+                n.adownload_articles() if isinstance(n, Source)
+                else n.adownload() for n in news_list])
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+AMP variants of articles, see `config.prefer_amp`. Article pages which
+advertise a <link rel="amphtml"> are only read up to the end of their
+<head>, which holds the metadata, and the text is extracted from the
+lighter AMP page instead.
+"""
+__title__ = 'newspaper'
+__author__ = 'Lucas Ou-Yang'
+__license__ = 'MIT'
+__copyright__ = 'Copyright 2014, Lucas Ou-Yang'
+
+import atexit
+import logging
+import re
+
+from html import unescape
+from urllib.parse import urljoin
+
+from .redirects import RedirectMap
+from .settings import AMP_DIRECTORY
+
+log = logging.getLogger(__name__)
+
+
+# Seconds the AMP url of an article is remembered
+AMP_TTL = 30 * 86400
+
+AMP_LINK_RE = re.compile(
+    rb'<link\b[^>]*?\brel\s*=\s*["\']?amphtml\b[^>]*>', re.I)
+
+HREF_RE = re.compile(
+    rb'\bhref\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s>]+))', re.I)
+
+# Where the metadata of a page ends
+HEAD_END_RE = re.compile(rb'</head\b|<body\b', re.I)
+
+# Article url -> url of its AMP variant, learnt by earlier downloads
+known = RedirectMap(AMP_DIRECTORY)
+atexit.register(lambda: known.save())
+
+
+def find_amp_url(head, base_url):
+    """Url of the AMP variant advertised in the `head` bytes of the page
+    at `base_url`, None when there is none
+    """
+    link = AMP_LINK_RE.search(head)
+    if link is None:
+        return None
+    href = HREF_RE.search(link.group(0))
+    if href is None:
+        return None
+    href = next(g for g in href.groups() if g is not None)
+    href = unescape(href.decode('latin-1')).strip()
+    return urljoin(base_url, href) if href else None
+
+
+class HeadScanner(object):
+    """Watches the chunks of a page go by for the end of its <head> and
+    then looks for a rel=amphtml link in it
+    """
+    def __init__(self, url):
+        self.url = url
+        self.head = []
+        self.tail = b''
+        self.done = False
+        self.amp_url = None
+
+    def add(self, chunk):
+        """Returns True once the head is complete and links to an AMP
+        variant, the rest of the page is not needed then
+        """
+        if self.done:
+            return False
+        data = self.tail + chunk
+        end = HEAD_END_RE.search(data)
+        if end is None:
+            self.head.append(chunk)
+            self.tail = data[-7:]
+            return False
+        self.done = True
+        head = b''.join(self.head)[:-len(self.tail) or None] + \
+            data[:end.start()]
+        self.head = None
+        self.amp_url = find_amp_url(head, self.url)
+        if self.amp_url is not None:
+            log.debug('%s has an AMP variant at %s' % (self.url, self.amp_url))
+        return self.amp_url is not None
+
+
+def remember(url, amp_url):
+    known.add(url, amp_url)
+
+
+def known_amp_url(url):
+    return known.get(url, AMP_TTL)
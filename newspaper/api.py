@@ -70,7 +70,7 @@ def hot():
 
 def fulltext(html, language='en'):
     """Takes article HTML string input and outputs the fulltext
-    Input string is decoded via UnicodeDammit if needed
+    Input bytes are decoded via encoding.decode_html
     """
     from .cleaners import DocumentCleaner
     from .configuration import Configuration
@@ -12,6 +12,8 @@ from urllib.parse import urlparse
 
 import requests
 
+from . import amp
+from . import encoding
 from . import images
 from . import network
 from . import nlp
@@ -105,8 +107,13 @@ class Article(object):
         # Summary generated from the article's body txt
         self.summary = ''
 
-        # This article's unchanged and raw HTML
-        self.html = ''
+        # This article's unchanged and raw HTML, see the `html` property
+        self._html = ''
+
+        # The downloaded bytes and their encoding when
+        # `config.keep_html_bytes` is set
+        self.html_bytes = None
+        self.html_encoding = None
 
         # The HTML of this article's main node (most important part)
         self.article_html = ''
@@ -115,6 +122,13 @@ class Article(object):
         self.is_parsed = False
         self.download_state = ArticleDownloadState.NOT_STARTED
         self.download_exception_msg = None
+        # True when the html was cut at `config.max_html_bytes`
+        self.download_truncated = False
+
+        # Url of the AMP variant the html was downloaded from and the
+        # <head> of the original page, see `config.prefer_amp`
+        self.amp_url = None
+        self.canonical_head = None
 
         # Meta description field in the HTML source
         self.meta_description = ""
@@ -146,9 +160,15 @@ class Article(object):
         # lxml DOM object generated from HTML
         self.doc = None
 
-        # A deepcopied clone of the above object before undergoing heavy
-        # cleaning operations, serves as an API if users need to query the DOM
-        self.clean_doc = None
+        # DOM built while downloading, see `config.parse_while_downloading`
+        self._streamed_doc = None
+
+        # The DOM before undergoing heavy cleaning operations, serves as an
+        # API if users need to query it, see the `clean_doc` property
+        self._clean_doc = None
+
+        # og:type of the page, read by is_valid_body()
+        self._meta_type = None
 
         # A property dict for users to store custom data.
         self.additional_data = {}
@@ -171,13 +191,99 @@ class Article(object):
             self.download_exception_msg = e.strerror
             return None
 
+    def _fetch_amp(self):
+        """Downloads the AMP variant of the article instead of the article
+        when it links to one, see `config.prefer_amp`
+        """
+        decode = not self.config.keep_html_bytes
+        amp_url = amp.known_amp_url(self.url)
+        if amp_url is None:
+            head, response = network.fetch(
+                self.url, self.config, decode=decode, stop_at_amp=True,
+                build_doc=True)
+            if response.amp_url is None:
+                return head, response
+            amp_url = response.amp_url
+            self._set_canonical_head(head, response)
+        try:
+            html, response = network.fetch(
+                amp_url, self.config, decode=decode, build_doc=True)
+        except requests.exceptions.RequestException as e:
+            log.debug('AMP variant %s of %s failed: %s' %
+                      (amp_url, self.url, e))
+            amp.known.forget(self.url)
+            self.canonical_head = None
+            return network.fetch(self.url, self.config, decode=decode,
+                                 build_doc=True)
+        amp.remember(self.url, amp_url)
+        self.amp_url = amp_url
+        return html, response
+
+    async def _afetch_amp(self):
+        """Asyncio version of `_fetch_amp`
+        """
+        from . import aio
+
+        decode = not self.config.keep_html_bytes
+        amp_url = amp.known_amp_url(self.url)
+        if amp_url is None:
+            head, response = await aio.afetch(
+                self.url, self.config, decode=decode, stop_at_amp=True,
+                build_doc=True)
+            if response.amp_url is None:
+                return head, response
+            amp_url = response.amp_url
+            self._set_canonical_head(head, response)
+        try:
+            html, response = await aio.afetch(
+                amp_url, self.config, decode=decode, build_doc=True)
+        except requests.exceptions.RequestException as e:
+            log.debug('AMP variant %s of %s failed: %s' %
+                      (amp_url, self.url, e))
+            amp.known.forget(self.url)
+            self.canonical_head = None
+            return await aio.afetch(self.url, self.config, decode=decode,
+                                    build_doc=True)
+        amp.remember(self.url, amp_url)
+        self.amp_url = amp_url
+        return html, response
+
+    def _set_canonical_head(self, head, response):
+        if isinstance(head, bytes):
+            head = head.decode(response.encoding or 'utf-8', 'replace')
+        self.canonical_head = head
+
     def _parse_scheme_http(self):
         try:
-            return network.get_html_2XX_only(self.url, self.config)
+            if self.config.prefer_amp:
+                html, response = self._fetch_amp()
+            else:
+                html, response = network.fetch(
+                    self.url, self.config,
+                    decode=not self.config.keep_html_bytes, build_doc=True)
+        except requests.exceptions.RequestException as e:
+            self.download_state = ArticleDownloadState.FAILED_RESPONSE
+            self.download_exception_msg = str(e)
+            return None
+        self.set_response(response)
+        return html
+
+    async def _aparse_scheme_http(self):
+        from . import aio
+
+        try:
+            if self.config.prefer_amp:
+                html, response = await self._afetch_amp()
+            else:
+                html, response = await aio.afetch(
+                    self.url, self.config,
+                    decode=not self.config.keep_html_bytes, build_doc=True)
         except requests.exceptions.RequestException as e:
             self.download_state = ArticleDownloadState.FAILED_RESPONSE
             self.download_exception_msg = str(e)
             return None
+        self.set_response(response)
+        return html
 
     def download(self, input_html=None, title=None, recursion_counter=0):
         """Downloads the link's HTML content, don't use if you are batch async
@@ -186,6 +292,8 @@ class Article(object):
         recursion_counter (currently 1) stops refreshes that are potentially
         infinite
         """
+        self._streamed_doc = None
+        self.amp_url = self.canonical_head = None
         if input_html is None:
             parsed_url = urlparse(self.url)
             if parsed_url.scheme == "file":
@@ -198,12 +306,46 @@ class Article(object):
                 return
         else:
             html = input_html
+            self.html_encoding = None
 
         if self.config.follow_meta_refresh:
             meta_refresh_url = extract_meta_refresh(html)
             if meta_refresh_url and recursion_counter < 1:
                 return self.download(
-                    input_html=network.get_html(meta_refresh_url),
+                    input_html=network.get_html(meta_refresh_url, self.config),
+                    recursion_counter=recursion_counter + 1)
+
+        self.set_html(html)
+        self.set_title(title)
+
+    async def adownload(self, input_html=None, title=None,
+                        recursion_counter=0):
+        """Asyncio version of `download()`, requires aiohttp
+        """
+        from . import aio
+
+        self._streamed_doc = None
+        self.amp_url = self.canonical_head = None
+        if input_html is None:
+            parsed_url = urlparse(self.url)
+            if parsed_url.scheme == "file":
+                html = self._parse_scheme_file(parsed_url.path)
+            else:
+                html = await self._aparse_scheme_http()
+            if html is None:
+                log.debug('Download failed on URL %s because of %s' %
+                          (self.url, self.download_exception_msg))
+                return
+        else:
+            html = input_html
+            self.html_encoding = None
+
+        if self.config.follow_meta_refresh:
+            meta_refresh_url = extract_meta_refresh(html)
+            if meta_refresh_url and recursion_counter < 1:
+                return await self.adownload(
+                    input_html=await aio.aget_html(
+                        meta_refresh_url, self.config),
                     recursion_counter=recursion_counter + 1)
 
         self.set_html(html)
@@ -212,8 +354,11 @@ class Article(object):
     def parse(self):
         self.throw_if_not_downloaded_verbose()
 
-        self.doc = self.config.get_parser().fromstring(self.html)
-        self.clean_doc = copy.deepcopy(self.doc)
+        if self._streamed_doc is not None:
+            self.doc, self._streamed_doc = self._streamed_doc, None
+        else:
+            self.doc = self._parse_html()
+        self._clean_doc = None
 
         if self.doc is None:
             # `parse` call failed, return nothing
@@ -226,46 +371,62 @@ class Article(object):
         document_cleaner = DocumentCleaner(self.config)
         output_formatter = OutputFormatter(self.config)
 
-        title = self.extractor.get_title(self.clean_doc)
-        self.set_title(title)
+        # Metadata is read before the DOM gets cleaned, the one of an AMP
+        # download comes from the original page
+        meta_doc = self.doc
+        if self.canonical_head is not None:
+            meta_doc = self.config.get_parser().fromstring(
+                self.canonical_head)
+            if meta_doc is None:
+                meta_doc = self.doc
+
+        # The extractors query the document dozens of times, answer them
+        # from one index built before the tree gets modified
+        parser = self.config.get_parser()
+        with parser.indexed(self.doc), parser.indexed(meta_doc):
+            title = self.extractor.get_title(self.doc)
+            self.set_title(title)
+
+            authors = self.extractor.get_authors(self.doc)
+            self.set_authors(authors)
 
-        authors = self.extractor.get_authors(self.clean_doc)
-        self.set_authors(authors)
+            meta_lang = self.extractor.get_meta_lang(meta_doc)
+            self.set_meta_language(meta_lang)
 
-        meta_lang = self.extractor.get_meta_lang(self.clean_doc)
-        self.set_meta_language(meta_lang)
+            if self.config.use_meta_language:
+                self.extractor.update_language(self.meta_lang)
+                output_formatter.update_language(self.meta_lang)
 
-        if self.config.use_meta_language:
-            self.extractor.update_language(self.meta_lang)
-            output_formatter.update_language(self.meta_lang)
+            meta_favicon = self.extractor.get_favicon(meta_doc)
+            self.set_meta_favicon(meta_favicon)
 
-        meta_favicon = self.extractor.get_favicon(self.clean_doc)
-        self.set_meta_favicon(meta_favicon)
+            meta_site_name = self.extractor.get_meta_site_name(meta_doc)
+            self.set_meta_site_name(meta_site_name)
 
-        meta_site_name = self.extractor.get_meta_site_name(self.clean_doc)
-        self.set_meta_site_name(meta_site_name)
+            meta_description = \
+                self.extractor.get_meta_description(meta_doc)
+            self.set_meta_description(meta_description)
 
-        meta_description = \
-            self.extractor.get_meta_description(self.clean_doc)
-        self.set_meta_description(meta_description)
+            canonical_link = self.extractor.get_canonical_link(
+                self.url, meta_doc)
+            self.set_canonical_link(canonical_link)
 
-        canonical_link = self.extractor.get_canonical_link(
-            self.url, self.clean_doc)
-        self.set_canonical_link(canonical_link)
+            tags = self.extractor.extract_tags(self.doc)
+            self.set_tags(tags)
 
-        tags = self.extractor.extract_tags(self.clean_doc)
-        self.set_tags(tags)
+            meta_keywords = self.extractor.get_meta_keywords(
+                meta_doc)
+            self.set_meta_keywords(meta_keywords)
 
-        meta_keywords = self.extractor.get_meta_keywords(
-            self.clean_doc)
-        self.set_meta_keywords(meta_keywords)
+            meta_data = self.extractor.get_meta_data(meta_doc)
+            self.set_meta_data(meta_data)
 
-        meta_data = self.extractor.get_meta_data(self.clean_doc)
-        self.set_meta_data(meta_data)
+            self.publish_date = self.extractor.get_publishing_date(
+                self.url,
+                self.doc)
 
-        self.publish_date = self.extractor.get_publishing_date(
-            self.url,
-            self.clean_doc)
+            self._meta_type = self.extractor.get_meta_type(self.doc)
+            self._set_img_urls(self.doc)
 
         # Before any computations on the body, clean DOM object
         self.doc = document_cleaner.clean(self.doc)
@@ -283,22 +444,46 @@ class Article(object):
             self.set_article_html(article_html)
             self.set_text(text)
 
-        self.fetch_images()
+        self._set_top_img()
 
         self.is_parsed = True
         self.release_resources()
 
+    def _parse_html(self):
+        if self.html_bytes is not None:
+            return self.config.get_parser().fromstring(
+                self.html_bytes, self.html_encoding)
+        return self.config.get_parser().fromstring(self.html)
+
+    @property
+    def clean_doc(self):
+        """The DOM as it was before cleaning. parse() reads everything it
+        needs before cleaning, so this one is only rebuilt from the html
+        when it is asked for
+        """
+        if self._clean_doc is None and self.doc is not None:
+            self._clean_doc = self._parse_html()
+        return self._clean_doc
+
+    @clean_doc.setter
+    def clean_doc(self, clean_doc):
+        self._clean_doc = clean_doc
+
     def fetch_images(self):
         if self.clean_doc is not None:
-            meta_img_url = self.extractor.get_meta_img_url(
-                self.url, self.clean_doc)
-            self.set_meta_img(meta_img_url)
+            self._set_img_urls(self.clean_doc)
+        self._set_top_img()
 
-            imgs = self.extractor.get_img_urls(self.url, self.clean_doc)
-            if self.meta_img:
-                imgs.add(self.meta_img)
-            self.set_imgs(imgs)
+    def _set_img_urls(self, doc):
+        meta_img_url = self.extractor.get_meta_img_url(self.url, doc)
+        self.set_meta_img(meta_img_url)
 
+        imgs = self.extractor.get_img_urls(self.url, doc)
+        if self.meta_img:
+            imgs.add(self.meta_img)
+        self.set_imgs(imgs)
+
+    def _set_top_img(self):
         if self.clean_top_node is not None and not self.has_top_image():
             first_img = self.extractor.get_first_img_url(
                 self.url, self.clean_top_node)
@@ -326,7 +511,7 @@ class Article(object):
         if not self.is_parsed:
             raise ArticleException('must parse article before checking \
                                     if it\'s body is valid!')
-        meta_type = self.extractor.get_meta_type(self.clean_doc)
+        meta_type = self._meta_type
         wordcount = self.text.split(' ')
         sentcount = self.text.split('.')
 
@@ -351,7 +536,7 @@ class Article(object):
             log.debug('%s caught for sent cnt' % self.url)
             return False
 
-        if self.html is None or self.html == '':
+        if not self.has_html():
             log.debug('%s caught for no html' % self.url)
             return False
 
@@ -391,8 +576,9 @@ class Article(object):
         """A parse candidate is a wrapper object holding a link hash of this
         article and a final_url of the article
         """
-        if self.html:
-            return RawHelper.get_parsing_candidate(self.url, self.html)
+        if self.has_html():
+            return RawHelper.get_parsing_candidate(
+                self.url, self.html_bytes or self.html)
         return URLHelper.get_parsing_candidate(self.url)
 
     def build_resource_path(self):
@@ -452,13 +638,50 @@ class Article(object):
         if text:
             self.text = text
 
+    @property
+    def html(self):
+        """Kept bytes are only decoded the first time the html is read
+        """
+        if self._html is None:
+            self._html = self.html_bytes.decode(self.html_encoding, 'replace')
+        return self._html
+
+    @html.setter
+    def html(self, html):
+        self._html = html
+        self.html_bytes = None
+        self._streamed_doc = None
+
+    def has_html(self):
+        """Tells if there is any html without decoding kept bytes
+        """
+        return bool(self.html_bytes or self._html)
+
+    def set_response(self, response):
+        """Takes what the response of this article's download tells
+        besides its html, which goes to `set_html`: whether the body was
+        truncated, its encoding and the tree parsed while downloading
+        """
+        self.download_truncated = response.truncated
+        self.html_encoding = response.encoding
+        self._streamed_doc = getattr(response, 'doc', None)
+
     def set_html(self, html):
-        """Encode HTML before setting it
+        """Encode HTML before setting it, unless `config.keep_html_bytes`
+        asks to keep the bytes as they are
         """
         if html:
-            if isinstance(html, bytes):
-                html = self.config.get_parser().get_unicode_html(html)
-            self.html = html
+            if isinstance(html, bytes) and self.config.keep_html_bytes:
+                self.html_encoding = (self.html_encoding or
+                                      encoding.guess_encoding(html))
+                self._html = None
+                self.html_bytes = html
+            else:
+                if isinstance(html, bytes):
+                    html = self.config.get_parser().get_unicode_html(html)
+                streamed_doc = self._streamed_doc
+                self.html = html
+                self._streamed_doc = streamed_doc
             self.download_state = ArticleDownloadState.SUCCESS
 
     def set_article_html(self, article_html):
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk storage of HTTP responses. Nothing in this file talks to the
+network, network.py decides what gets stored and when it is reused.
+"""
+__title__ = 'newspaper'
+__author__ = 'Lucas Ou-Yang'
+__license__ = 'MIT'
+__copyright__ = 'Copyright 2014, Lucas Ou-Yang'
+
+import logging
+import os
+import pickle
+import tempfile
+import threading
+import time
+
+from hashlib import sha1
+
+import requests
+
+from requests.structures import CaseInsensitiveDict
+
+from .urls import normalize_url
+
+log = logging.getLogger(__name__)
+
+
+class StoredResponse(object):
+    """Picklable snapshot of a fully read `requests.Response`
+    """
+    def __init__(self, url, status_code, headers, content, encoding,
+                 amp_url=None):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.encoding = encoding
+        self.amp_url = amp_url
+        self.stored_at = time.time()
+
+    @classmethod
+    def from_response(cls, response):
+        return cls(response.url, response.status_code,
+                   CaseInsensitiveDict(response.headers), response.content,
+                   response.encoding, getattr(response, 'amp_url', None))
+
+    def to_response(self):
+        response = requests.Response()
+        response.url = self.url
+        response.status_code = self.status_code
+        response.reason = 'OK'
+        response.headers = CaseInsensitiveDict(self.headers)
+        response.encoding = self.encoding
+        response._content = self.content
+        # truncated bodies are never stored
+        response.truncated = False
+        response.doc = None
+        # entries stored before AMP urls were kept have none
+        response.amp_url = getattr(self, 'amp_url', None)
+        return response
+
+
+class DiskStore(object):
+    """Stores one pickled object per key in `directory`. Writes go to a
+    temporary file which is then renamed over the target, so concurrent
+    readers and crawler processes never see a half written entry.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory,
+                            sha1(key.encode('utf-8')).hexdigest())
+
+    def load(self, key):
+        try:
+            with open(self.path(key), 'rb') as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, EOFError, pickle.UnpicklingError) as e:
+            log.debug('Ignoring unreadable store entry for %s: %s' % (key, e))
+            return None
+
+    def save(self, key, value):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(value, f)
+            os.replace(tmp_path, self.path(key))
+        except OSError as e:
+            log.debug('Could not store entry for %s: %s' % (key, e))
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+    def touch(self, key):
+        try:
+            os.utime(self.path(key))
+        except OSError:
+            pass
+
+    def entries(self):
+        """Returns (mtime, size, path) of every stored entry
+        """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith('.tmp'):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+
+class ResponseCache(object):
+    """Size bounded, on-disk cache of successful responses, keyed by the
+    normalized url and the request headers. Entries expire after a TTL
+    picked by their content type. Once the cache outgrows its size cap,
+    the least recently used entries are evicted. Several crawler processes
+    may share one directory.
+    """
+    def __init__(self, directory):
+        self.store = DiskStore(directory)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._size = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(url, headers, variant=None):
+        """`variant` tells apart the responses of one request which are
+        read differently, e.g. only up to an AMP link
+        """
+        header_lines = sorted('%s:%s' % (k.lower(), v)
+                              for k, v in (headers or {}).items())
+        lines = [normalize_url(url)] + header_lines
+        if variant:
+            lines.append('variant:%s' % variant)
+        return '\n'.join(lines)
+
+    @staticmethod
+    def ttl_for(stored, ttls, default_ttl):
+        content_type = stored.headers.get('Content-Type') or ''
+        mime = content_type.split(';')[0].strip().lower()
+        return ttls.get(mime, default_ttl)
+
+    def get(self, url, headers, ttls, default_ttl, variant=None):
+        """Returns the fresh `StoredResponse` of `url` or None
+        """
+        key = self.key(url, headers, variant)
+        stored = self.store.load(key)
+        if stored is not None and time.time() - stored.stored_at > \
+                self.ttl_for(stored, ttls, default_ttl):
+            self.store.delete(key)
+            stored = None
+
+        with self._lock:
+            if stored is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if stored is not None:
+            # mtime is our LRU clock
+            self.store.touch(key)
+        return stored
+
+    def set(self, url, headers, response, max_size, variant=None):
+        stored = StoredResponse.from_response(response)
+        self.store.save(self.key(url, headers, variant), stored)
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self.store.entries())
+            else:
+                self._size += len(stored.content or b'')
+            if self._size > max_size:
+                self._evict(max_size)
+
+    def _evict(self, max_size):
+        """Deletes least recently used entries until the cache is back
+        to 90% of `max_size`. Re-measures the directory first since other
+        processes write to it too.
+        """
+        entries = sorted(self.store.entries())
+        size = sum(entry_size for _, entry_size, _ in entries)
+        target = max_size * 0.9
+        for _, entry_size, path in entries:
+            if size <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= entry_size
+            self.evictions += 1
+        self._size = size
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions}
@@ -122,17 +122,17 @@ class DocumentCleaner(object):
         # ids
         naughty_list = self.parser.xpath_re(doc, self.nauthy_ids_re)
         for node in naughty_list:
-            if not node.xpath(self.contains_article):
+            if not self.parser.xpath(node, self.contains_article):
                 self.parser.remove(node)
         # class
         naughty_classes = self.parser.xpath_re(doc, self.nauthy_classes_re)
         for node in naughty_classes:
-            if not node.xpath(self.contains_article):
+            if not self.parser.xpath(node, self.contains_article):
                 self.parser.remove(node)
         # name
         naughty_names = self.parser.xpath_re(doc, self.nauthy_names_re)
         for node in naughty_names:
-            if not node.xpath(self.contains_article):
+            if not self.parser.xpath(node, self.contains_article):
                 self.parser.remove(node)
         return doc
 
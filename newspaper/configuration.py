@@ -11,6 +11,7 @@ __license__ = 'MIT'
 __copyright__ = 'Copyright 2014, Lucas Ou-Yang'
 
 import logging
+import weakref
 
 from .parsers import Parser
 from .text import (StopWords, StopWordsArabic, StopWordsChinese,
@@ -54,6 +55,27 @@ class Configuration(object):
         # You may keep the html of just the main article body
         self.keep_article_html = False
 
+        # Store the ETag / Last-Modified of the source home, category and
+        # feed pages and refetch them with conditional GETs, reusing the
+        # stored page when the server answers 304 Not Modified
+        self.revalidate_source_pages = True
+
+        # Keep every downloaded page in an on-disk cache, see
+        # network.response_cache. Entries expire after the TTL (seconds)
+        # of their content type, the least recently used ones are evicted
+        # past `response_cache_size` bytes
+        self.use_response_cache = False
+        self.response_cache_size = 512 * 1024 * 1024
+        self.response_cache_ttls = {
+            'text/html': 86400,
+            'application/xhtml+xml': 86400,
+            'application/rss+xml': 900,
+            'application/atom+xml': 900,
+            'application/xml': 900,
+            'text/xml': 900,
+        }
+        self.response_cache_default_ttl = 3600
+
         # Fail for error responses (e.g. 404 page)
         self.http_success_only = True
 
@@ -66,18 +88,141 @@ class Configuration(object):
         self.browser_user_agent = 'newspaper/%s' % __version__
         self.headers = {}
         self.request_timeout = 7
+
+        # Derive the timeout of every request from the response times of
+        # its host instead of `request_timeout`: the `timeout_percentile`
+        # of its last responses times `timeout_factor`, between
+        # `min_request_timeout` and `max_request_timeout` seconds, None
+        # for `request_timeout`. See network.host_latencies.stats()
+        self.adaptive_timeouts = False
+        self.timeout_percentile = 99
+        self.timeout_factor = 3
+        self.min_request_timeout = 1
+        self.max_request_timeout = None
         self.proxies = {}
         self.number_threads = 10
 
+        # Proxy urls to spread the requests over instead of the static
+        # `proxies`, one picked per request or, with `proxy_rotation` set
+        # to 'host', one per host. Healthy proxies are picked in proportion
+        # to their success rate over latency, a proxy is quarantined for
+        # `proxy_quarantine` seconds after `proxy_max_failures` failed
+        # requests in a row. See proxies.pool.stats()
+        self.proxy_pool = []
+        self.proxy_rotation = 'request'
+        self.proxy_max_failures = 3
+        self.proxy_quarantine = 300
+        self.proxy_ban_statuses = [403, 407, 429]
+
+        # `multithread_request` requeues a request which timed out, failed
+        # to connect or got one of `retry_statuses` up to `max_retries`
+        # times. It waits for the server's Retry-After or a jittered
+        # exponential backoff, both capped at `retry_backoff_max` seconds
+        self.max_retries = 2
+        self.retry_statuses = [429, 500, 502, 503, 504]
+        self.retry_backoff = 0.5
+        self.retry_backoff_max = 30
+
+        # After `breaker_threshold` consecutive failures a host gets no
+        # more requests for `breaker_cooldown` seconds, then one trial
+        # request which pauses it again if it fails
+        self.breaker_threshold = 5
+        self.breaker_cooldown = 60
+
+        # Min seconds between two downloads from one domain in NewsPool
+        self.domain_delay = 0
+
+        # Let the number of parallel downloads per domain adapt instead of
+        # the fixed `threads_per_source` / `number_threads`, see
+        # mthreading.HostLimits. A domain starts at
+        # `initial_host_concurrency` (or its cap of the last run), grows
+        # while its responses stay fast and is halved on 429 / 503, on
+        # timeouts and on responses `latency_spike_factor` times slower
+        # than usual
+        self.adaptive_concurrency = False
+        self.initial_host_concurrency = 2
+        self.min_host_concurrency = 1
+        self.max_host_concurrency = 20
+        self.latency_spike_factor = 3
+
+        # Obey robots.txt: Source.generate_articles drops disallowed urls
+        # and the Crawl-delay of a host, up to `max_crawl_delay` seconds,
+        # spaces out the NewsPool and multithread_request downloads. The
+        # files are kept on disk for `robots_txt_ttl` seconds
+        self.respect_robots_txt = False
+        self.robots_txt_ttl = 86400
+        self.max_crawl_delay = 30
+
+        # Remember the permanent (301, 308) redirects met while downloading
+        # for `redirect_ttl` seconds: later requests of a redirecting url
+        # go straight to its final url, and so do the article urls of a
+        # Source before they are memoized
+        self.remember_redirects = True
+        self.redirect_ttl = 30 * 86400
+
+        # Every request goes through a keep-alive `requests.Session`, one
+        # per thread shared by the configs with the same pool settings,
+        # see network.get_session().
+        # `pool_connections` is the number of hosts we keep a pool for,
+        # `pool_maxsize` the number of idle connections kept open per host
+        self.pool_connections = 10
+        self.pool_maxsize = 10
+        self.keep_alive = True
+        # aiohttp sessions used outside of aio.aio_session() blocks,
+        # one per event loop
+        self._aio_sessions = weakref.WeakKeyDictionary()
+
+        # Seconds a resolved host name is reused by every session, see
+        # network.dns_cache (0 to resolve on each new connection). With
+        # `prewarm_connections` Source.build resolves the distinct category
+        # hosts in parallel before downloading them
+        self.dns_cache_ttl = 300
+        self.prewarm_connections = False
+
+        # Cap on in-flight requests across all hosts for the asyncio
+        # engine, see aio.aio_session()
+        self.max_concurrent_requests = 1000
+
         self.verbose = False  # for debugging
 
-        self.thread_timeout_seconds = 1
         self.ignored_content_types_defaults = {}
+
+        # Bodies are streamed: responses of these content types are
+        # dropped before their body is read, longer bodies are cut at
+        # `max_html_bytes` (None to disable the cap)
+        self.non_html_content_types = [
+            'image/', 'audio/', 'video/', 'font/',
+            'application/octet-stream', 'application/zip']
+        self.max_html_bytes = 10 * 1024 * 1024
+
+        # Articles keep the downloaded bytes and their encoding, lxml
+        # parses the bytes directly. `article.html` is decoded on first read
+        self.keep_html_bytes = False
+
+        # Feed html bodies to an incremental lxml parser as they download,
+        # so that `article.parse()` finds the tree already built
+        self.parse_while_downloading = False
+
+        # Articles linking to an AMP variant are only downloaded up to the
+        # end of their <head>, the text is extracted from the AMP page
+        self.prefer_amp = False
+
+        # Content codings asked for in Accept-Encoding, best first. br and
+        # zstd are only advertised when their codecs are installed, e.g.
+        # with `pip3 install newspaper3k[compression]`
+        self.content_codings = ['zstd', 'br', 'gzip', 'deflate']
         # Set this to False if you want to recompute the categories
         # *every* time you build a `Source` object
         # TODO: Actually make this work
         # self.use_cached_categories = True
 
+    def __getstate__(self):
+        """Sessions hold sockets and locks, never pickle them
+        """
+        state = self.__dict__.copy()
+        state['_aio_sessions'] = weakref.WeakKeyDictionary()
+        return state
+
     def get_language(self):
         return self._language
 
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""
+Finds out how the bytes of a downloaded page are encoded, following the
+order of the WHATWG encoding sniffing algorithm: byte order mark, HTTP
+Content-Type header, then a prescan of the first bytes of the document
+for a <meta charset>. Statistical detection only runs when all of these
+come up empty and the page is not valid UTF-8.
+"""
+__title__ = 'newspaper'
+__author__ = 'Lucas Ou-Yang'
+__license__ = 'MIT'
+__copyright__ = 'Copyright 2014, Lucas Ou-Yang'
+
+import codecs
+import logging
+import re
+
+from requests.compat import chardet
+
+log = logging.getLogger(__name__)
+
+
+# Bytes of the document looked at by the <meta charset> prescan. The
+# standard says 1024 but news sites often put the tag after kilobytes of
+# inline scripts and link tags
+PRESCAN_BYTES = 16 * 1024
+
+# Bytes fed to statistical detection, the last resort
+SNIFF_BYTES = 64 * 1024
+
+# Used when nothing else tells, as browsers do
+DEFAULT_ENCODING = 'cp1252'
+
+BOMS = (
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+)
+
+# Labels which browsers decode with a superset of the named encoding,
+# keyed by python codec name. Pages labelled latin-1 routinely contain
+# windows-1252 quotes, gb2312 pages contain GBK characters and so on
+SUPERSETS = {
+    'ascii': 'cp1252',
+    'iso8859-1': 'cp1252',
+    'iso8859-9': 'cp1254',
+    'iso8859-11': 'cp874',
+    'tis-620': 'cp874',
+    'gb2312': 'gb18030',
+    'gbk': 'gb18030',
+    'euc_kr': 'cp949',
+    'shift_jis': 'cp932',
+    'big5': 'big5hkscs',
+}
+
+CHARSET_RE = re.compile(
+    rb'charset[\t\n\f\r ]*=[\t\n\f\r ]*'
+    rb'(?:"([^"]*)"|\'([^\']*)\'|([^\t\n\f\r ;"\']+))', re.I)
+
+ATTRIBUTE_RE = re.compile(
+    rb'[\t\n\f\r /]*([^\t\n\f\r /=>][^\t\n\f\r /=>]*)'
+    rb'(?:[\t\n\f\r ]*=[\t\n\f\r ]*'
+    rb'(?:"([^"]*)"|\'([^\']*)\'|([^\t\n\f\r >]*)))?')
+
+META_RE = re.compile(rb'<meta[\t\n\f\r /]', re.I)
+
+# A start or end tag up to its closing >, a > within quotes does not
+# close the tag
+TAG_RE = re.compile(rb'</?[a-zA-Z](?:"[^"]*"|\'[^\']*\'|[^"\'>])*')
+
+CHARSET_WORD_RE = re.compile(rb'charset', re.I)
+
+
+def lookup(label):
+    """Maps an encoding label found in a header or a meta tag to the name
+    of a python codec, None for unknown labels
+    """
+    if isinstance(label, bytes):
+        label = label.decode('ascii', 'ignore')
+    label = label.strip().strip('"\'').lower()
+    if label == 'x-user-defined':
+        return DEFAULT_ENCODING
+    try:
+        codec = codecs.lookup(label)
+    except (LookupError, ValueError):
+        return None
+    if not getattr(codec, '_is_text_encoding', True):
+        # rot13, base64, zlib and friends are not page encodings
+        return None
+    return SUPERSETS.get(codec.name, codec.name)
+
+
+def from_bom(content):
+    for bom, encoding in BOMS:
+        if content.startswith(bom):
+            return encoding
+    return None
+
+
+def from_content_type(content_type):
+    """Encoding named by the charset parameter of a Content-Type header
+    """
+    if not content_type:
+        return None
+    match = CHARSET_RE.search(content_type.encode('latin-1', 'ignore'))
+    if match is None:
+        return None
+    return lookup(next(g for g in match.groups() if g is not None))
+
+
+def _attributes(data, pos):
+    """Yields the (name, value, end) of the attributes of the tag whose
+    attributes start at `pos`, stops at the end of the tag
+    """
+    while True:
+        match = ATTRIBUTE_RE.match(data, pos)
+        if match is None or match.end() == pos:
+            return
+        pos = match.end()
+        value = next((g for g in match.groups()[1:] if g is not None), b'')
+        yield match.group(1).lower(), value.lower(), pos
+
+
+def _from_meta(data, pos):
+    """Runs the WHATWG attribute checks on the <meta> tag starting at
+    `pos`, returns its encoding and where the tag ends
+    """
+    seen = set()
+    got_pragma = False
+    need_pragma = None
+    charset = None
+    end = pos
+    for name, value, end in _attributes(data, pos):
+        if name in seen:
+            continue
+        seen.add(name)
+        if name == b'http-equiv' and value == b'content-type':
+            got_pragma = True
+        elif name == b'content' and charset is None:
+            match = CHARSET_RE.search(value)
+            if match is not None:
+                charset = next(g for g in match.groups() if g is not None)
+                need_pragma = True
+        elif name == b'charset':
+            charset = value
+            need_pragma = False
+
+    if charset is None or need_pragma is None:
+        return None, end
+    if need_pragma and not got_pragma:
+        return None, end
+    encoding = lookup(charset)
+    if encoding in ('utf-16', 'utf-16-be', 'utf-16-le'):
+        # a document which can be prescanned is not utf-16
+        encoding = 'utf-8'
+    return encoding, end
+
+
+def prescan(content):
+    """The WHATWG prescan of a byte stream for a <meta> declared charset,
+    over the first `PRESCAN_BYTES` bytes of `content`
+    """
+    data = content[:PRESCAN_BYTES]
+    if CHARSET_WORD_RE.search(data) is None:
+        return None
+    pos = data.find(b'<')
+    while 0 <= pos < len(data):
+        if data.startswith(b'<!--', pos):
+            end = data.find(b'-->', pos + 2)
+            if end == -1:
+                return None
+            pos = end + 3
+        elif META_RE.match(data, pos):
+            encoding, pos = _from_meta(data, pos + 6)
+            if encoding is not None:
+                return encoding
+        else:
+            match = TAG_RE.match(data, pos)
+            if match is not None:
+                pos = match.end()
+            elif data[pos + 1:pos + 2] in (b'!', b'/', b'?'):
+                end = data.find(b'>', pos)
+                if end == -1:
+                    return None
+                pos = end
+            pos += 1
+        pos = data.find(b'<', pos)
+    return None
+
+
+def detect_encoding(content, content_type=None):
+    """Returns the encoding the document declares through its byte order
+    mark, the Content-Type header or a <meta> tag, None if it does not
+    """
+    return (from_bom(content) or from_content_type(content_type) or
+            prescan(content))
+
+
+def guess_encoding(content, content_type=None):
+    """Like `detect_encoding` but always settles on an encoding, for the
+    callers which hand the bytes over to a decoder of their own
+    """
+    encoding = detect_encoding(content, content_type)
+    if encoding is None:
+        try:
+            content.decode('utf-8')
+            encoding = 'utf-8'
+        except UnicodeDecodeError:
+            encoding = sniff(content)
+    return encoding
+
+
+def sniff(content):
+    """Statistical detection over the first `SNIFF_BYTES` of `content`
+    """
+    guess = chardet.detect(content[:SNIFF_BYTES]).get('encoding')
+    return (guess and lookup(guess)) or DEFAULT_ENCODING
+
+
+def decode_html(content, content_type=None):
+    """Decodes the raw bytes of a page, returns the text along with the
+    encoding which was used. Undeclared pages are tried as UTF-8 first.
+    """
+    encoding = detect_encoding(content, content_type)
+    if encoding is None:
+        try:
+            return content.decode('utf-8'), 'utf-8'
+        except UnicodeDecodeError:
+            encoding = sniff(content)
+            log.debug('No declared encoding, detected %s' % encoding)
+    return content.decode(encoding, 'replace'), encoding
@@ -22,6 +22,7 @@ from tldextract import tldextract
 from urllib.parse import urljoin, urlparse, urlunparse
 
 from . import urls
+from .parsers import ASCII_LOWER, SIMPLE_SELECTOR_RE
 from .utils import StringReplacement, StringSplitter
 
 log = logging.getLogger(__name__)
@@ -52,6 +53,56 @@ bad_chunks = ['careers', 'contact', 'about', 'faq', 'terms', 'privacy',
 bad_domains = ['amazon', 'doubleclick', 'twitter']
 
 
+class MetaTags(object):
+    """The <meta> and <link> elements of a document, harvested in one pass
+    for every extractor which reads them
+    """
+    def __init__(self, parser, doc):
+        self.parser = parser
+        self.metas = []
+        self.links = []
+        # (attribute, value) -> <meta> elements, e.g. ('property', 'og:type')
+        self.named = defaultdict(list)
+        for element in parser.getElementsByTags(doc, ['meta', 'link']):
+            if element.tag == 'link':
+                self.links.append(element)
+                continue
+            self.metas.append(element)
+            for attr, value in element.items():
+                if attr != 'content':
+                    self.named[(attr, value)].append(element)
+
+    def content(self, attr, value):
+        """Content of the first <meta> whose `attr` is exactly `value`
+        """
+        metas = self.named.get((attr, value))
+        content = self.parser.getAttribute(metas[0], 'content') \
+            if metas else None
+        return content.strip() if content else ''
+
+    @staticmethod
+    def _containing(elements, attr, values):
+        """`elements` whose `attr` contains one of `values`, ignoring
+        ASCII case like `Parser.getElementsByTag`
+        """
+        values = [v.lower() for v in values]
+        found = []
+        for element in elements:
+            attr_value = element.get(attr)
+            if attr_value is None:
+                continue
+            attr_value = attr_value.translate(ASCII_LOWER)
+            if any(v in attr_value for v in values):
+                found.append(element)
+        return found
+
+    def find_metas(self, attr, *values):
+        return self._containing(self.metas, attr, values)
+
+    def find_links(self, *rels):
+        return self._containing(self.links, 'rel', rels)
+
+
 class ContentExtractor(object):
     def __init__(self, config):
         self.config = config
@@ -59,6 +110,18 @@ class ContentExtractor(object):
         self.language = config.language
         self.stopwords_class = config.stopwords_class
 
+    def get_meta_tags(self, doc):
+        """The `MetaTags` of `doc`, harvested once for as long as `doc` is
+        indexed, see `Parser.indexed`
+        """
+        index = self.parser.get_index(doc)
+        if index is None:
+            return MetaTags(self.parser, doc)
+        meta_tags = index.memo.get('meta_tags')
+        if meta_tags is None:
+            meta_tags = index.memo['meta_tags'] = MetaTags(self.parser, doc)
+        return meta_tags
+
     def update_language(self, meta_lang):
         """Required to be called before the extraction process in some
         cases because the stopwords_class has to set incase the lang
@@ -149,7 +212,7 @@ class ContentExtractor(object):
         for match in matches:
             content = ''
             if match.tag == 'meta':
-                mm = match.xpath('@content')
+                mm = self.parser.xpath(match, '@content')
                 if len(mm) > 0:
                     content = mm[0]
             else:
@@ -219,11 +282,18 @@ class ContentExtractor(object):
             {'attribute': 'name', 'value': 'publish_date',
              'content': 'content'},
         ]
+        harvested = self.get_meta_tags(doc)
         for known_meta_tag in PUBLISH_DATE_TAGS:
-            meta_tags = self.parser.getElementsByTag(
-                doc,
-                attr=known_meta_tag['attribute'],
-                value=known_meta_tag['value'])
+            meta_tags = None
+            if known_meta_tag['content'] == 'content':
+                meta_tags = harvested.find_metas(
+                    known_meta_tag['attribute'], known_meta_tag['value'])
+            if not meta_tags:
+                # e.g. <span property="article:published_time" content=..>
+                meta_tags = self.parser.getElementsByTag(
+                    doc,
+                    attr=known_meta_tag['attribute'],
+                    value=known_meta_tag['value'])
             if meta_tags:
                 date_str = self.parser.getAttribute(
                     meta_tags[0],
@@ -397,8 +467,7 @@ class ContentExtractor(object):
         <link rel="shortcut icon" type="image/png" href="favicon.png" />
         <link rel="icon" type="image/png" href="favicon.png" />
         """
-        kwargs = {'tag': 'link', 'attr': 'rel', 'value': 'icon'}
-        meta = self.parser.getElementsByTag(doc, **kwargs)
+        meta = self.get_meta_tags(doc).find_links('icon')
         if meta:
             favicon = self.parser.getAttribute(meta[0], 'href')
             return favicon
@@ -411,13 +480,10 @@ class ContentExtractor(object):
         attr = self.parser.getAttribute(doc, attr='lang')
         if attr is None:
             # look up for a Content-Language in meta
-            items = [
-                {'tag': 'meta', 'attr': 'http-equiv',
-                 'value': 'content-language'},
-                {'tag': 'meta', 'attr': 'name', 'value': 'lang'}
-            ]
+            items = [('http-equiv', 'content-language'), ('name', 'lang')]
+            meta_tags = self.get_meta_tags(doc)
             for item in items:
-                meta = self.parser.getElementsByTag(doc, **item)
+                meta = meta_tags.find_metas(*item)
                 if meta:
                     attr = self.parser.getAttribute(
                         meta[0], attr='content')
@@ -436,6 +502,12 @@ class ContentExtractor(object):
             "meta[name=keywords]"
             "meta[property=og:type]"
         """
+        match = SIMPLE_SELECTOR_RE.match(metaname.strip())
+        if match and match.group(1).lower() == 'meta' and match.group(2):
+            value = next(v for v in match.groups()[2:] if v is not None)
+            return self.get_meta_tags(doc).content(
+                match.group(2).lower(), value)
+
         meta = self.parser.css_select(doc, metaname)
         content = None
         if meta is not None and len(meta) > 0:
@@ -450,17 +522,15 @@ class ContentExtractor(object):
         top_meta_image, try_one, try_two, try_three, try_four = [None] * 5
         try_one = self.get_meta_content(doc, 'meta[property="og:image"]')
         if not try_one:
-            link_img_src_kwargs = \
-                {'tag': 'link', 'attr': 'rel', 'value': 'img_src|image_src'}
-            elems = self.parser.getElementsByTag(doc, use_regex=True, **link_img_src_kwargs)
+            meta_tags = self.get_meta_tags(doc)
+            elems = meta_tags.find_links('img_src', 'image_src')
             try_two = elems[0].get('href') if elems else None
 
             if not try_two:
                 try_three = self.get_meta_content(doc, 'meta[name="og:image"]')
 
                 if not try_three:
-                    link_icon_kwargs = {'tag': 'link', 'attr': 'rel', 'value': 'icon'}
-                    elems = self.parser.getElementsByTag(doc, **link_icon_kwargs)
+                    elems = meta_tags.find_links('icon')
                     try_four = elems[0].get('href') if elems else None
 
         top_meta_image = try_one or try_two or try_three or try_four
@@ -491,7 +561,7 @@ class ContentExtractor(object):
 
     def get_meta_data(self, doc):
         data = defaultdict(dict)
-        properties = self.parser.css_select(doc, 'meta')
+        properties = self.get_meta_tags(doc).metas
         for prop in properties:
             key = prop.attrib.get('property') or prop.attrib.get('name')
             value = prop.attrib.get('content') or prop.attrib.get('value')
@@ -536,8 +606,7 @@ class ContentExtractor(object):
         1. The rel=canonical tag
         2. The og:url tag
         """
-        links = self.parser.getElementsByTag(doc, tag='link', attr='rel',
-                                             value='canonical')
+        links = self.get_meta_tags(doc).find_links('canonical')
 
         canonical = self.parser.getAttribute(links[0], 'href') if links else ''
         og_url = self.get_meta_content(doc, 'meta[property="og:url"]')
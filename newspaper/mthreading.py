@@ -11,11 +11,17 @@ __copyright__ = 'Copyright 2014, Lucas Ou-Yang'
 
 import logging
 import queue
-import traceback
+import time
 
-from threading import Thread
+from collections import defaultdict, deque, OrderedDict
+from concurrent import futures
+from threading import Condition, current_thread, Lock, Thread
 
+from . import robots
+from . import urls
+from .cache import DiskStore
 from .configuration import Configuration
+from .settings import LIMITS_DIRECTORY
 
 log = logging.getLogger(__name__)
 
@@ -24,43 +30,343 @@ class ConcurrencyException(Exception):
     pass
 
 
-class Worker(Thread):
-    """
-    Thread executing tasks from a given tasks queue.
+# Workers `Executor.submit` starts on its own and the size the pool
+# shrinks back to, `reserve` may go further for a while
+MAX_WORKERS = 32
+
+# Seconds a worker beyond `MAX_WORKERS` waits for a task before it exits
+IDLE_TIMEOUT = 60
+
+
+class Executor(object):
+    """Long lived pool of daemon worker threads returning a
+    `concurrent.futures.Future` for every submitted task. Up to
+    `max_workers` workers never exit when idle and are shared by every
+    `multithread_request` and `NewsPool` run, so a crawl loop pays for
+    thread creation once and the per thread sessions of
+    `network.get_session` keep their connections. The workers `reserve`
+    starts beyond them exit after `idle_timeout` seconds without a task.
     """
-    def __init__(self, tasks, timeout_seconds):
-        Thread.__init__(self)
-        self.tasks = tasks
-        self.timeout = timeout_seconds
-        self.daemon = True
-        self.start()
-
-    def run(self):
+    def __init__(self, max_workers=MAX_WORKERS, idle_timeout=IDLE_TIMEOUT):
+        self.tasks = queue.Queue()
+        self.workers = []
+        self.max_workers = max_workers
+        self.idle_timeout = idle_timeout
+        self.busy = 0
+        self.queued = 0
+        self.started = 0
+        self._lock = Lock()
+
+    def _grow(self, wanted):
+        """Starts workers until there are `wanted` of them, call with
+        the lock held
+        """
+        for _ in range(wanted - len(self.workers)):
+            worker = Thread(target=self._work, daemon=True,
+                            name='newspaper-%d' % self.started)
+            worker.start()
+            self.workers.append(worker)
+            self.started += 1
+
+    def reserve(self, num_threads):
+        """Makes sure `num_threads` workers are free for the next tasks,
+        on top of the running and the queued ones, even beyond
+        `max_workers`, since the tasks may wait on each other. The pool
+        shrinks back to `max_workers` once the extra workers are idle.
+        """
+        with self._lock:
+            self._grow(self.busy + self.queued + num_threads)
+
+    def submit(self, func, *args, **kargs):
+        """Queues `func(*args, **kargs)`, starting a worker for it when
+        all of them are taken and the pool is below `max_workers`
+        """
+        future = futures.Future()
+        with self._lock:
+            self.queued += 1
+            self._grow(min(self.busy + self.queued, self.max_workers))
+        self.tasks.put((future, func, args, kargs))
+        return future
+
+    def _retire(self):
+        """Tells if the calling idle worker is one too many, it is then
+        forgotten and must exit
+        """
+        with self._lock:
+            if self.queued or len(self.workers) <= self.max_workers:
+                return False
+            self.workers.remove(current_thread())
+            return True
+
+    def _work(self):
         while True:
             try:
-                func, args, kargs = self.tasks.get(timeout=self.timeout)
+                future, func, args, kargs = self.tasks.get(
+                    timeout=self.idle_timeout)
             except queue.Empty:
-                # Extra thread allocated, no job, exit gracefully
-                break
+                if self._retire():
+                    return
+                continue
+            running = future.set_running_or_notify_cancel()
+            # a started task moves from queued to busy in one step, else
+            # a submit in between would find a worker to spare
+            with self._lock:
+                self.queued -= 1
+                self.busy += running
+            if not running:
+                continue
             try:
-                func(*args, **kargs)
-            except Exception:
-                traceback.print_exc()
+                future.set_result(func(*args, **kargs))
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                with self._lock:
+                    self.busy -= 1
+
+
+# Shared by everything in newspaper which runs on threads
+executor = Executor()
+
+
+# Weight of the latest response in a host's moving average latency
+LATENCY_SMOOTHING = 0.2
+
+# Responses needed before a latency spike can be told apart from noise
+MIN_LATENCY_SAMPLES = 5
+
+# Answers of a host asking us to slow down
+THROTTLE_STATUSES = (429, 503)
+
+
+class HostLimit(object):
+    def __init__(self, limit, latency=None, samples=0):
+        self.limit = limit
+        self.latency = latency
+        self.samples = samples
+        self.last_decrease = 0
+
+
+class HostLimits(object):
+    """Adaptive cap on the parallel requests sent to each host, see
+    `config.adaptive_concurrency`. Additive increase, multiplicative
+    decrease: every fast and successful response raises the cap of its
+    host by 1 / cap, a throttling answer (429, 503), a timeout or a
+    response `config.latency_spike_factor` times slower than the host's
+    average halves it, at most once per average response time. The caps
+    are kept on disk between runs by `save()`.
+    """
+    def __init__(self, directory):
+        self.store = DiskStore(directory)
+        self.hosts = {}
+        self.dirty = set()
+        self._lock = Lock()
+
+    def _host(self, host, config):
+        state = self.hosts.get(host)
+        if state is None:
+            stored = self.store.load(host)
+            if stored is not None:
+                state = HostLimit(*stored)
+            else:
+                state = HostLimit(config.initial_host_concurrency)
+            self.hosts[host] = state
+        return state
+
+    def limit(self, host, config):
+        """Parallel requests `host` may get right now
+        """
+        with self._lock:
+            limit = self._host(host, config).limit
+        return max(int(limit), config.min_host_concurrency)
+
+    def record(self, host, config, latency=None, status=None):
+        """Adjusts the cap of `host` after one response of `status` which
+        took `latency` seconds to arrive, a None latency for a request
+        which failed or timed out
+        """
+        throttled = latency is None or status in THROTTLE_STATUSES
+        now = time.time()
+        with self._lock:
+            state = self._host(host, config)
+            spike = (latency is not None and state.latency is not None and
+                     state.samples >= MIN_LATENCY_SAMPLES and
+                     latency > config.latency_spike_factor * state.latency)
+            if latency is not None:
+                state.samples += 1
+                if state.latency is None:
+                    state.latency = latency
+                else:
+                    state.latency += LATENCY_SMOOTHING * (
+                        latency - state.latency)
+
+            if throttled or spike:
+                if now - state.last_decrease < (state.latency or 0):
+                    return
+                state.last_decrease = now
+                state.limit = max(state.limit / 2,
+                                  config.min_host_concurrency)
+                log.debug('Concurrency of %s cut to %d' %
+                          (host, state.limit))
+            else:
+                state.limit = min(state.limit + 1 / state.limit,
+                                  config.max_host_concurrency)
+            self.dirty.add(host)
 
-            self.tasks.task_done()
+    def limiter(self, config, cap):
+        """The `limits` of a `DomainScheduler`: the current cap of a
+        domain, never more than `cap`
+        """
+        return lambda domain: min(self.limit(domain, config), cap)
+
+    def save(self):
+        with self._lock:
+            changed = [(host, self.hosts[host]) for host in self.dirty]
+            self.dirty.clear()
+        for host, state in changed:
+            self.store.save(host, (state.limit, state.latency, state.samples))
+
+    def clear(self):
+        with self._lock:
+            self.hosts.clear()
+            self.dirty.clear()
+
+
+# Shared by every run, see `config.adaptive_concurrency`
+host_limits = HostLimits(LIMITS_DIRECTORY)
 
 
-class ThreadPool:
-    def __init__(self, num_threads, timeout_seconds):
-        self.tasks = queue.Queue(num_threads)
-        for _ in range(num_threads):
-            Worker(self.tasks, timeout_seconds)
+class DomainScheduler(object):
+    """Runs tasks on a fixed budget of `executor` threads while being polite
+    to every domain: at most `per_domain` tasks of one domain run at once,
+    two tasks of one domain start at least `delay` seconds apart and
+    domains are served round-robin so one big source can't starve others.
+    Every task gets a future holding its result or exception.
+    """
+    def __init__(self, num_threads, per_domain=1, delay=0, stream=False,
+                 limits=None):
+        self.num_threads = num_threads
+        self.per_domain = per_domain
+        # Callable returning the current cap of a domain, overrides
+        # `per_domain`, see `HostLimits`. It may read from disk, so it is
+        # called without holding `cond` and its answers are kept in `caps`
+        self.limits = limits
+        self.caps = {}
+        self.delay = delay
+        self.queues = OrderedDict()
+        self.active = defaultdict(int)
+        self.next_start = defaultdict(float)
+        # Per domain overrides of `delay`
+        self.delays = {}
+        self.cond = Condition()
+        self.workers = []
+        # Streaming schedulers keep their threads waiting for more tasks
+        # until `close()`, others stop as soon as their queues run dry
+        self.closed = not stream
+
+    def add_task(self, domain, func, *args, **kargs):
+        future = futures.Future()
+        cap = self._limit(domain)
+        with self.cond:
+            if cap is not None:
+                self.caps[domain] = cap
+            self.queues.setdefault(domain, deque()).append(
+                (future, func, args, kargs))
+            self.cond.notify()
+        return future
+
+    def cancel(self):
+        """Cancels every task which has not started yet
+        """
+        with self.cond:
+            for tasks in self.queues.values():
+                for future, _, _, _ in tasks:
+                    future.cancel()
+            self.queues.clear()
+            self.cond.notify_all()
 
-    def add_task(self, func, *args, **kargs):
-        self.tasks.put((func, args, kargs))
+    def set_delay(self, domain, seconds):
+        with self.cond:
+            self.delays[domain] = seconds
+
+    def defer(self, domain, seconds):
+        """Starts no task of `domain` for the next `seconds`
+        """
+        with self.cond:
+            self.next_start[domain] = max(self.next_start[domain],
+                                          time.time() + seconds)
+            self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def start(self):
+        executor.reserve(self.num_threads)
+        for _ in range(self.num_threads):
+            self.workers.append(executor.submit(self._work))
 
     def wait_completion(self):
-        self.tasks.join()
+        futures.wait(self.workers)
+        self.workers = []
+
+    def _limit(self, domain):
+        """Current cap of `domain` from `limits`, None without them
+        """
+        if self.limits is None:
+            return None
+        return self.limits(domain)
+
+    def _per_domain(self, domain):
+        return self.caps.get(domain, self.per_domain)
+
+    def _next_task(self):
+        """Blocks until a task may start, None once the queues are empty
+        and the scheduler is closed
+        """
+        with self.cond:
+            while self.queues or not self.closed:
+                now = time.time()
+                wait = None
+                for domain, tasks in self.queues.items():
+                    if self.active[domain] >= self._per_domain(domain):
+                        continue
+                    if self.next_start[domain] > now:
+                        ready_in = self.next_start[domain] - now
+                        wait = ready_in if wait is None else min(wait, ready_in)
+                        continue
+                    task = tasks.popleft()
+                    if tasks:
+                        self.queues.move_to_end(domain)
+                    else:
+                        del self.queues[domain]
+                    self.active[domain] += 1
+                    self.next_start[domain] = now + self.delays.get(
+                        domain, self.delay)
+                    return domain, task
+                self.cond.wait(wait)
+            return None
+
+    def _work(self):
+        while True:
+            scheduled = self._next_task()
+            if scheduled is None:
+                break
+            domain, (future, func, args, kargs) = scheduled
+            try:
+                if future.set_running_or_notify_cancel():
+                    future.set_result(func(*args, **kargs))
+            except Exception as e:
+                log.exception('%s failed' % func)
+                future.set_exception(e)
+            finally:
+                # the task's responses may have moved the cap
+                cap = self._limit(domain)
+                with self.cond:
+                    if cap is not None:
+                        self.caps[domain] = cap
+                    self.active[domain] -= 1
+                    self.cond.notify_all()
 
 
 class NewsPool(object):
@@ -68,11 +374,12 @@ class NewsPool(object):
     def __init__(self, config=None):
         """
         Abstraction of a threadpool. A newspool can accept any number of
-        source OR article objects together in a list. It allocates one
-        thread to every source and then joins.
+        source OR article objects together in a list. Article downloads
+        of all of them are interleaved by domain on one shared budget
+        of threads, see `DomainScheduler`.
 
-        We allocate one thread per source to avoid rate limiting.
-        5 sources = 5 threads, one per source.
+        To avoid rate limiting, at most `threads_per_source` downloads
+        run against one domain at a time, spaced by `config.domain_delay`.
 
         >>> import newspaper
         >>> from newspaper import news_pool
@@ -90,6 +397,7 @@ class NewsPool(object):
         u'<html>blahblah ... '
         """
         self.pool = None
+        self.sources = []
         self.config = config or Configuration()
 
     def join(self):
@@ -97,37 +405,67 @@ class NewsPool(object):
         Runs the mtheading and returns when all threads have joined
         resets the task.
         """
+        from .network import save_urls
+
         if self.pool is None:
             raise ConcurrencyException('Call set(..) with a list of source objects '
                                        'before calling .join(..)')
         self.pool.wait_completion()
         self.pool = None
+        if self.config.adaptive_concurrency:
+            host_limits.save()
+        save_urls()
+
+        for source in self.sources:
+            failed_urls = [a.url for a in source.articles if not a.has_html()]
+            source.purge_articles('download', source.articles)
+            source.is_downloaded = True
+            if failed_urls:
+                log.warning('The following article urls failed the download: %s' %
+                            ', '.join(failed_urls))
+        self.sources = []
 
     def set(self, news_list, threads_per_source=1, override_threads=None):
         """
         news_list can be a list of `Article`, `Source`, or both.
 
-        If caller wants to decide how many threads to use, they can use
-        `override_threads` which takes precedence over all. Otherwise,
-        this api infers that if the input is all `Source` objects, to
-        allocate one thread per `Source` to not spam the host.
-
-        If both of the above conditions are not true, default to 1 thread.
+        `threads_per_source` caps the parallel downloads per domain. The
+        total number of threads is one batch of `threads_per_source` per
+        distinct domain, unless the caller decides with `override_threads`,
+        which takes precedence over all.
         """
         from .source import Source
 
+        self.sources = [n for n in news_list if isinstance(n, Source)]
+        articles = []
+        for news_object in news_list:
+            if isinstance(news_object, Source):
+                articles.extend(news_object.articles)
+            else:
+                articles.append(news_object)
+        domains = [urls.get_domain(a.url) for a in articles]
+
         if override_threads is not None:
             num_threads = override_threads
-        elif all([isinstance(n, Source) for n in news_list]):
-            num_threads = threads_per_source * len(news_list)
         else:
-            num_threads = 1
+            num_threads = threads_per_source * max(len(set(domains)), 1)
 
-        timeout = self.config.thread_timeout_seconds
-        self.pool = ThreadPool(num_threads, timeout)
-
-        for news_object in news_list:
-            if isinstance(news_object, Source):
-                self.pool.add_task(news_object.download_articles)
-            else:
-                self.pool.add_task(news_object.download)
+        limits = None
+        if self.config.adaptive_concurrency:
+            num_threads = override_threads or max(
+                num_threads, self.config.number_threads)
+            limits = host_limits.limiter(self.config, num_threads)
+        self.pool = DomainScheduler(num_threads, threads_per_source,
+                                    self.config.domain_delay, limits=limits)
+        if self.config.respect_robots_txt:
+            first_urls = {}
+            for domain, article in zip(domains, articles):
+                first_urls.setdefault(domain, article.url)
+            robots.prefetch(first_urls.values(), self.config)
+            for domain, url in first_urls.items():
+                self.pool.set_delay(domain, max(
+                    self.config.domain_delay,
+                    robots.crawl_delay(url, self.config)))
+        for domain, article in zip(domains, articles):
+            self.pool.add_task(domain, article.download)
+        self.pool.start()
@@ -8,17 +8,577 @@ __author__ = 'Lucas Ou-Yang'
 __license__ = 'MIT'
 __copyright__ = 'Copyright 2014, Lucas Ou-Yang'
 
+import asyncio
+import email.utils
+import functools
+import ipaddress
 import logging
+import math
+import queue
+import random
+import socket
+import threading
+import time
+import weakref
+from collections import defaultdict, deque
+from concurrent import futures
+from urllib.parse import urlparse
+
 import requests
+import urllib3
+
+from http.cookiejar import DefaultCookiePolicy
 
+from . import amp, mthreading, proxies, redirects, robots
+from .cache import DiskStore, ResponseCache, StoredResponse
 from .configuration import Configuration
-from .mthreading import ThreadPool
-from .settings import cj
+from .encoding import decode_html, guess_encoding
+from .mthreading import DomainScheduler, executor
+from .parsers import IncrementalParser
+from .settings import cj, RESPONSE_CACHE_DIRECTORY, VALIDATOR_DIRECTORY
+from .urls import get_domain
 
 log = logging.getLogger(__name__)
 
 
-FAIL_ENCODING = 'ISO-8859-1'
+# Bytes read from the socket at a time while streaming a body
+CHUNK_SIZE = 64 * 1024
+
+# Keep-alive sessions of the calling thread, keyed by their pool settings
+_thread_sessions = threading.local()
+# Every session alive, so `close_session` reaches those of other threads
+_all_sessions = weakref.WeakSet()
+_session_lock = threading.Lock()
+
+# Last 2XX response carrying an ETag or Last-Modified, per revalidated url
+_validators = DiskStore(VALIDATOR_DIRECTORY)
+
+# Opt-in cache of downloaded pages, see `config.use_response_cache`.
+# `response_cache.stats()` reports its hit and miss counters
+response_cache = ResponseCache(RESPONSE_CACHE_DIRECTORY)
+
+
+class ContentTypeError(requests.exceptions.RequestException):
+    """Raised before the body is read when the Content-Type header
+    tells the response is not a web page, see
+    `config.non_html_content_types`
+    """
+
+
+class CircuitBreaker(object):
+    """Counts the consecutive failures of every host. A host which reaches
+    the threshold is open: requests to it are skipped until the cooldown
+    has passed. The breaker is then half-open, the next request is the
+    only trial let through, which closes the breaker on success and opens
+    it again on failure. A trial which never reports back is replaced by
+    another one after a cooldown.
+    """
+    def __init__(self):
+        self.failures = defaultdict(int)
+        self.opened_at = {}
+        self.trials = {}
+        self._lock = threading.Lock()
+
+    def is_open(self, host, cooldown):
+        """Tells if a request to `host` must be skipped, a caller which
+        gets False from a half-open breaker sends the trial
+        """
+        with self._lock:
+            opened_at = self.opened_at.get(host)
+            if opened_at is None:
+                return False
+            now = time.time()
+            if now - opened_at < cooldown:
+                return True
+            if now - self.trials.get(host, 0) < cooldown:
+                return True
+            self.trials[host] = now
+            return False
+
+    def record(self, host, success, threshold):
+        with self._lock:
+            trial = self.trials.pop(host, None) is not None
+            if success:
+                self.failures.pop(host, None)
+                self.opened_at.pop(host, None)
+                return
+            self.failures[host] += 1
+            if trial or threshold and self.failures[host] >= threshold:
+                if host not in self.opened_at:
+                    log.warning('%s failed %d times in a row, pausing '
+                                'requests to it' % (host, self.failures[host]))
+                self.opened_at[host] = time.time()
+
+    def reset(self):
+        with self._lock:
+            self.failures.clear()
+            self.opened_at.clear()
+            self.trials.clear()
+
+
+# Shared by every `multithread_request` call, see `config.breaker_threshold`
+breaker = CircuitBreaker()
+
+
+# Response times kept per host by `host_latencies`
+LATENCY_WINDOW = 200
+
+# Response times needed before a host gets a timeout of its own
+MIN_TIMEOUT_SAMPLES = 20
+
+
+class HostLatencies(object):
+    """Rolling window of the time every host took to send its response
+    headers, from which `config.adaptive_timeouts` derives the timeout of
+    the next request: the `config.timeout_percentile` of the window times
+    `config.timeout_factor`, kept between `config.min_request_timeout` and
+    `config.max_request_timeout`. Requests which timed out are only
+    counted, they tell nothing of the host's response time and must not
+    give a host which keeps hanging more time.
+    """
+    def __init__(self):
+        self.samples = defaultdict(lambda: deque(maxlen=LATENCY_WINDOW))
+        self.timeouts = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def record(self, host, latency):
+        with self._lock:
+            self.samples[host].append(latency)
+
+    def record_timeout(self, host):
+        with self._lock:
+            self.timeouts[host] += 1
+
+    def percentile(self, host, percent):
+        """Nearest rank percentile of the window of `host`, None until it
+        holds `MIN_TIMEOUT_SAMPLES` response times
+        """
+        with self._lock:
+            samples = sorted(self.samples.get(host, ()))
+        if len(samples) < MIN_TIMEOUT_SAMPLES:
+            return None
+        rank = math.ceil(percent / 100.0 * len(samples))
+        return samples[min(max(rank, 1), len(samples)) - 1]
+
+    def timeout(self, host, config):
+        """Seconds the next request to `host` may wait on the connection
+        and on every read
+        """
+        if not config.adaptive_timeouts:
+            return config.request_timeout
+        latency = self.percentile(host, config.timeout_percentile)
+        if latency is None:
+            return config.request_timeout
+        return min(max(latency * config.timeout_factor,
+                       config.min_request_timeout),
+                   config.max_request_timeout or config.request_timeout)
+
+    def stats(self, config=None):
+        """Latency percentiles, timeouts met and current timeout of every
+        host, keyed by host
+        """
+        config = config or Configuration()
+        with self._lock:
+            hosts = list(self.samples)
+        stats = {}
+        for host in hosts:
+            stats[host] = {
+                'samples': len(self.samples[host]),
+                'timeouts': self.timeouts[host],
+                'p50': self.percentile(host, 50),
+                'p90': self.percentile(host, 90),
+                'p99': self.percentile(host, 99),
+                'timeout': self.timeout(host, config),
+            }
+        return stats
+
+    def reset(self):
+        with self._lock:
+            self.samples.clear()
+            self.timeouts.clear()
+
+
+# Shared by every config, see `config.adaptive_timeouts`
+host_latencies = HostLatencies()
+
+
+class TransferStats(object):
+    """Body bytes every host sent over the wire and what they decoded to,
+    which tells how much the negotiated content codings save
+    """
+    def __init__(self):
+        self.hosts = defaultdict(lambda: {
+            'responses': 0, 'wire_bytes': 0, 'decoded_bytes': 0,
+            'codings': defaultdict(int)})
+        self._lock = threading.Lock()
+
+    def record(self, host, wire_bytes, decoded_bytes, coding=None):
+        with self._lock:
+            stats = self.hosts[host]
+            stats['responses'] += 1
+            stats['wire_bytes'] += wire_bytes
+            stats['decoded_bytes'] += decoded_bytes
+            stats['codings'][(coding or 'identity').lower()] += 1
+
+    def stats(self):
+        """Responses, wire and decoded bytes, compression ratio and the
+        content codings met of every host, keyed by host
+        """
+        with self._lock:
+            return {host: dict(
+                stats, codings=dict(stats['codings']),
+                ratio=(round(stats['decoded_bytes'] / stats['wire_bytes'], 2)
+                       if stats['wire_bytes'] else None))
+                for host, stats in self.hosts.items()}
+
+    def reset(self):
+        with self._lock:
+            self.hosts.clear()
+
+
+transfers = TransferStats()
+
+
+class SingleFlight(object):
+    """Coalesces the identical requests which are in flight at the same
+    time: the first caller sends the request, the later ones wait for its
+    outcome instead of downloading the same page again. Threads share
+    one table, asyncio tasks one table per event loop.
+    """
+    def __init__(self):
+        self.calls = {}
+        self.sent = 0
+        self.avoided = 0
+        self._lock = threading.Lock()
+
+    def _join(self, key, new_future):
+        """Returns the call to wait on and whether the caller leads it
+        """
+        with self._lock:
+            call = self.calls.get(key)
+            if call is not None:
+                self.avoided += 1
+                return call, False
+            call = self.calls[key] = new_future()
+            self.sent += 1
+            return call, True
+
+    def _leave(self, key):
+        with self._lock:
+            del self.calls[key]
+
+    def do(self, key, func, *args):
+        """Returns `func(*args)` and whether the result is shared with
+        another caller
+        """
+        call, leader = self._join(key, futures.Future)
+        if not leader:
+            return call.result(), True
+        try:
+            result = func(*args)
+            call.set_result(result)
+            return result, False
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        finally:
+            self._leave(key)
+
+    async def ado(self, key, func, *args):
+        """Asyncio version of `do`, `func` is a coroutine function. When
+        the leading task is cancelled its waiters send the request again
+        instead of being cancelled along.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            call, leader = self._join((id(loop), key), loop.create_future)
+            if leader:
+                break
+            try:
+                return await asyncio.shield(call), True
+            except asyncio.CancelledError:
+                if not call.cancelled():
+                    raise
+        try:
+            result = await func(*args)
+            call.set_result(result)
+            return result, False
+        except asyncio.CancelledError:
+            call.cancel()
+            raise
+        except BaseException as e:
+            call.set_exception(e)
+            # consumed here if nobody else waits on it
+            call.exception()
+            raise
+        finally:
+            self._leave((id(loop), key))
+
+    def stats(self):
+        return {'sent': self.sent, 'avoided': self.avoided}
+
+
+# Process wide, `single_flight.stats()` counts the duplicate downloads
+# which were avoided
+single_flight = SingleFlight()
+
+
+class DNSCache(object):
+    """Keeps the addresses a host name resolved to for a while, so that the
+    connections opened to a host by every thread and session only pay for
+    one lookup. getaddrinfo does not tell the record's TTL, entries live
+    for `config.dns_cache_ttl` seconds.
+    """
+    def __init__(self):
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def resolve(self, host, port, ttl):
+        """Returns the addresses of `host`, an empty list when it does not
+        resolve, which is never cached
+        """
+        host = host.strip('[]')
+        try:
+            ipaddress.ip_address(host)
+            return [host]
+        except ValueError:
+            pass
+
+        key = (host, port)
+        now = time.time()
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        try:
+            infos = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        except (socket.gaierror, UnicodeError):
+            return []
+        addresses = []
+        for info in infos:
+            if info[4][0] not in addresses:
+                addresses.append(info[4][0])
+        with self._lock:
+            self.entries[key] = (now + ttl, addresses)
+        return addresses
+
+    def forget(self, host, port):
+        with self._lock:
+            self.entries.pop((host.strip('[]'), port), None)
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'hosts': len(self.entries)}
+
+
+# Shared by the sessions of every config and thread
+dns_cache = DNSCache()
+
+
+class _CachedDNSConnection(object):
+    """Mixed into urllib3's connection classes: the connection is opened
+    to the cached addresses of its host, trying them in turn. Only the
+    socket is opened to the address, TLS still verifies the host name.
+    """
+    dns_ttl = 0
+
+    def _new_conn(self):
+        host = self._dns_host
+        addresses = dns_cache.resolve(host, self.port, self.dns_ttl)
+        if not addresses:
+            return super(_CachedDNSConnection, self)._new_conn()
+        error = None
+        try:
+            for address in addresses:
+                self._dns_host = address
+                try:
+                    return super(_CachedDNSConnection, self)._new_conn()
+                except urllib3.exceptions.ConnectTimeoutError as e:
+                    error = e
+        finally:
+            self._dns_host = host
+        # the host may have moved
+        dns_cache.forget(host, self.port)
+        raise error
+
+
+@functools.lru_cache(maxsize=None)
+def _cached_dns_pool_class(pool_class, dns_ttl):
+    connection_class = type(
+        'CachedDNS' + pool_class.ConnectionCls.__name__,
+        (_CachedDNSConnection, pool_class.ConnectionCls),
+        {'dns_ttl': dns_ttl})
+    return type('CachedDNS' + pool_class.__name__, (pool_class,),
+                {'ConnectionCls': connection_class})
+
+
+class CachedDNSAdapter(requests.adapters.HTTPAdapter):
+    """`HTTPAdapter` whose connections resolve their host through
+    `dns_cache`
+    """
+    def __init__(self, dns_ttl, **kwargs):
+        self.dns_ttl = dns_ttl
+        super(CachedDNSAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(CachedDNSAdapter, self).init_poolmanager(*args, **kwargs)
+        pool_classes = self.poolmanager.pool_classes_by_scheme
+        self.poolmanager.pool_classes_by_scheme = {
+            scheme: _cached_dns_pool_class(pool_class, self.dns_ttl)
+            for scheme, pool_class in pool_classes.items()}
+
+
+class _NoPersistCookiePolicy(DefaultCookiePolicy):
+    """Cookies are still sent and kept across the redirects of a single
+    request (see `get_request_kwargs`), but never stored on the shared
+    session, so pooling connections does not leak cookies between articles
+    """
+    def set_ok(self, cookie, request):
+        return False
+
+
+def _pool_settings(config):
+    return (config.pool_connections, config.pool_maxsize, config.keep_alive,
+            config.dns_cache_ttl)
+
+
+def get_session(config=None):
+    """Returns the keep-alive `requests.Session` of the calling thread for
+    the pool settings of `config`. Sessions are built lazily, one per
+    thread and settings, so the configs of every `Source` and standalone
+    `Article` share them, and hold one connection pool per host so that
+    every request newspaper makes reuses already opened TCP+TLS
+    connections. The workers of `mthreading.executor` outlive a single
+    run, so their sessions stay warm from one crawl stage to the next.
+    A session goes away with its thread.
+    """
+    config = config or Configuration()
+    settings = _pool_settings(config)
+    sessions = getattr(_thread_sessions, 'sessions', None)
+    if sessions is None:
+        sessions = _thread_sessions.sessions = {}
+    session = sessions.get(settings)
+    if session is not None:
+        return session
+
+    session = requests.Session()
+    session.cookies = requests.cookies.RequestsCookieJar(
+        policy=_NoPersistCookiePolicy())
+    if config.dns_cache_ttl:
+        adapter = CachedDNSAdapter(
+            config.dns_cache_ttl,
+            pool_connections=config.pool_connections,
+            pool_maxsize=config.pool_maxsize)
+    else:
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=config.pool_connections,
+            pool_maxsize=config.pool_maxsize)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    if not config.keep_alive:
+        session.headers['Connection'] = 'close'
+    session.pool_settings = settings
+    sessions[settings] = session
+    with _session_lock:
+        _all_sessions.add(session)
+    return session
+
+
+def prewarm(urls, config=None):
+    """Resolves the distinct hosts of `urls` in parallel on the shared
+    executor and keeps their addresses in `dns_cache`, so the downloads
+    which follow skip the DNS lookup. No connection is opened ahead: the
+    downloads run on whichever worker is free and would seldom reuse it.
+    Hosts reached through a proxy are resolved by the proxy, and nothing
+    is kept when `config.dns_cache_ttl` is 0, both are skipped. Blocks for
+    at most `config.request_timeout` seconds and returns the number of
+    hosts which resolved.
+    """
+    config = config or Configuration()
+    if not config.dns_cache_ttl or config.proxy_pool:
+        return 0
+    hosts = set()
+    for url in urls:
+        parsed = urlparse(url)
+        if parsed.scheme not in ('http', 'https') or not parsed.hostname \
+                or config.proxies.get(parsed.scheme):
+            continue
+        try:
+            port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+        except ValueError:
+            continue
+        hosts.add((parsed.hostname, port))
+
+    executor.reserve(len(hosts))
+    tasks = [executor.submit(dns_cache.resolve, host, port,
+                             config.dns_cache_ttl)
+             for host, port in hosts]
+    done, _ = futures.wait(tasks, timeout=config.request_timeout)
+    return sum(1 for task in done
+               if task.exception() is None and task.result())
+
+
+def close_session(config):
+    """Closes every pooled connection held by the sessions of every thread
+    for the pool settings of `config`, the next requests open new ones
+    """
+    settings = _pool_settings(config)
+    with _session_lock:
+        sessions = [session for session in _all_sessions
+                    if session.pool_settings == settings]
+    for session in sessions:
+        session.close()
+
+
+# Content codings newspaper knows of, best compression first
+CONTENT_CODINGS = ('zstd', 'br', 'gzip', 'deflate')
+
+
+def _decodable_codings(aio=False):
+    """Content codings the http client can decode with the codecs
+    installed, br and zstd need their optional packages
+    """
+    if not aio:
+        return set(getattr(urllib3.response.HTTPResponse,
+                           'CONTENT_DECODERS', ('gzip', 'deflate')))
+    from .aio import aiohttp
+    parser = getattr(aiohttp, 'http_parser', None)
+    codings = {'gzip', 'deflate'}
+    if getattr(parser, 'HAS_BROTLI', False):
+        codings.add('br')
+    if getattr(parser, 'HAS_ZSTD', False):
+        codings.add('zstd')
+    return codings
+
+
+@functools.lru_cache()
+def accept_encoding(codings, aio=False):
+    """Accept-Encoding value advertising the `codings` the sync or async
+    client can decode, in their order of preference
+    """
+    decodable = _decodable_codings(aio)
+    return ', '.join(c for c in codings if c in decodable)
+
+
+def _negotiated(headers, config, aio=False):
+    """`headers` asking for `config.content_codings`, unless the user's
+    headers already pick an Accept-Encoding
+    """
+    if not config.content_codings or \
+            any(k.lower() == 'accept-encoding' for k in headers):
+        return headers
+    value = accept_encoding(tuple(config.content_codings), aio)
+    if not value:
+        return headers
+    return dict(headers, **{'Accept-Encoding': value})
 
 
 def get_request_kwargs(timeout, useragent, proxies, headers):
@@ -34,58 +594,385 @@ def get_request_kwargs(timeout, useragent, proxies, headers):
     }
 
 
-def get_html(url, config=None, response=None):
+def _conditional_headers(headers, stored):
+    """Adds the validators of a previously stored response to `headers`
+    """
+    headers = dict(headers)
+    if stored.headers.get('ETag'):
+        headers['If-None-Match'] = stored.headers['ETag']
+    if stored.headers.get('Last-Modified'):
+        headers['If-Modified-Since'] = stored.headers['Last-Modified']
+    return headers
+
+
+def _revalidated(url, response, stored):
+    """A 304 means the stored body is still fresh, hand it back in place of
+    the empty response. Fresh 2XX responses with validators are stored.
+    """
+    if response.status_code == 304 and stored is not None:
+        log.debug('%s not modified, reusing the stored body' % url)
+        return stored.to_response()
+    if response.ok and not response.truncated and (
+            'ETag' in response.headers or
+            'Last-Modified' in response.headers):
+        _validators.save(url, StoredResponse.from_response(response))
+    return response
+
+
+def _from_cache(url, config, headers, stop_at_amp=False):
+    if not config.use_response_cache:
+        return None
+    stored = response_cache.get(url, headers, config.response_cache_ttls,
+                                config.response_cache_default_ttl,
+                                'amp' if stop_at_amp else None)
+    return stored.to_response() if stored is not None else None
+
+
+def _to_cache(url, config, headers, response, stop_at_amp=False):
+    if (config.use_response_cache and response.status_code == 200
+            and not response.truncated):
+        response_cache.set(url, headers, response,
+                           config.response_cache_size,
+                           'amp' if stop_at_amp else None)
+
+
+def _skip_body(url, headers, config):
+    """Looks at the headers of a response before its body is read. Returns
+    True when the body is not needed because the content type maps to a
+    default in `config.ignored_content_types_defaults`, raises
+    `ContentTypeError` for the content types which are never html
+    """
+    content_type = headers.get('content-type')
+    if content_type in config.ignored_content_types_defaults:
+        return True
+    mime_type = (content_type or '').split(';')[0].strip().lower()
+    if mime_type and mime_type.startswith(
+            tuple(config.non_html_content_types)):
+        raise ContentTypeError('Skipped %s body of %s' % (mime_type, url))
+    return False
+
+
+# Content types `config.parse_while_downloading` builds a tree for
+HTML_CONTENT_TYPES = ('text/html', 'application/xhtml+xml')
+
+
+def _is_html(content_type):
+    return not content_type or \
+        content_type.split(';')[0].strip().lower() in HTML_CONTENT_TYPES
+
+
+class _Body(object):
+    """Collects the chunks of a streamed body up to `config.max_html_bytes`.
+    With `config.parse_while_downloading`, the html bodies of callers
+    which `build_doc` are also fed to an `IncrementalParser` as they
+    arrive. With `stop_at_amp`, reading stops at the end of the <head> of
+    a page which links to an AMP variant.
+    """
+    def __init__(self, url, config, content_type=None, stop_at_amp=False,
+                 build_doc=False):
+        self.url = url
+        self.limit = config.max_html_bytes
+        self.chunks = []
+        self.size = 0
+        self.complete = True
+        self.parser = None
+        self.scanner = None
+        self.amp_url = None
+        if _is_html(content_type):
+            if config.parse_while_downloading and build_doc:
+                self.parser = IncrementalParser(content_type)
+            if stop_at_amp:
+                self.scanner = amp.HeadScanner(url)
+
+    def add(self, chunk):
+        """Returns False once the body outgrows the limit, or once the
+        head of an AMP page is in
+        """
+        self.chunks.append(chunk)
+        self.size += len(chunk)
+        if self.limit and self.size > self.limit:
+            log.warning('%s is larger than %d bytes, body truncated' %
+                        (self.url, self.limit))
+            self.complete = False
+        elif self.scanner is not None and self.scanner.add(chunk):
+            self.amp_url = self.scanner.amp_url
+            self.complete = False
+        elif self.parser is not None:
+            self.parser.feed(chunk)
+        return self.complete
+
+    @property
+    def content(self):
+        content = b''.join(self.chunks)
+        return content if self.complete else content[:self.limit]
+
+    @property
+    def doc(self):
+        """Tree of the body when it was parsed while downloading
+        """
+        if self.parser is None or not self.complete:
+            return None
+        return self.parser.close()
+
+
+def _read_body(url, response, config, stop_at_amp=False, build_doc=False):
+    """Reads a streamed response. The body is dropped unread when
+    `_skip_body` says so and cut at `config.max_html_bytes`, the response
+    is then flagged with `truncated`. With `stop_at_amp` the response of a
+    page linking to an AMP variant holds its head and `amp_url`. Encoded
+    bodies are decoded chunk by chunk, the limit applies to decoded bytes.
+    """
+    try:
+        skip = _skip_body(url, response.headers, config)
+    except ContentTypeError:
+        response.close()
+        raise
+
+    body = _Body(url, config, response.headers.get('Content-Type'),
+                 stop_at_amp, build_doc)
+    if not skip:
+        for chunk in response.iter_content(CHUNK_SIZE):
+            if not body.add(chunk):
+                break
+    if skip or not body.complete:
+        # the rest of the body is still on the wire, drop the connection
+        response.close()
+    if not skip:
+        wire_bytes = response.raw.tell() if hasattr(response.raw, 'tell') \
+            else body.size
+        transfers.record(get_domain(url), wire_bytes, body.size,
+                         response.headers.get('Content-Encoding'))
+    response._content = body.content
+    response.truncated = not body.complete
+    response.doc = None if skip else body.doc
+    response.amp_url = body.amp_url
+    return response
+
+
+def _shared(response, shared):
+    """Callers decode the response they get, hand the ones waiting on
+    another caller's request a copy of their own
+    """
+    if not shared:
+        return response
+    duplicate = requests.Response()
+    duplicate.__dict__.update(response.__dict__)
+    # every caller may modify its tree, the others parse their own
+    duplicate.doc = None
+    return duplicate
+
+
+def _sent_to(url, target, response=None):
+    """A remembered redirect which now leads to an error is dropped, the
+    next request of `url` follows the redirects again
+    """
+    if target != url and (response is None or response.status_code >= 400):
+        redirects.redirect_map.forget(url)
+
+
+def _record_host(url, config, response=None, timeout=None):
+    """Feeds the time to the response headers of every request, or its
+    failure, to the latency window and the concurrency cap of its host.
+    `timeout` is given for a request which timed out.
+    """
+    host = get_domain(url)
+    if response is not None:
+        host_latencies.record(host, response.elapsed.total_seconds())
+    elif timeout is not None:
+        host_latencies.record_timeout(host)
+
+    if not config.adaptive_concurrency:
+        return
+    if response is None:
+        mthreading.host_limits.record(host, config)
+    else:
+        mthreading.host_limits.record(host, config,
+                                      response.elapsed.total_seconds(),
+                                      response.status_code)
+
+
+# The configuration which shapes a response, requests only share a
+# flight when all of it is the same
+FLIGHT_CONFIG = ('request_timeout', 'min_request_timeout',
+                 'max_request_timeout', 'adaptive_timeouts',
+                 'max_html_bytes', 'http_success_only',
+                 'parse_while_downloading', 'content_codings', 'proxies',
+                 'proxy_pool', 'proxy_rotation', 'use_response_cache',
+                 'response_cache_ttls', 'response_cache_default_ttl',
+                 'remember_redirects', 'max_retries', 'retry_statuses',
+                 'keep_alive')
+
+
+def _flight_key(url, config, revalidate, stop_at_amp):
+    headers = config.headers or {'User-Agent': config.browser_user_agent}
+    shaping = repr([getattr(config, name, None) for name in FLIGHT_CONFIG])
+    return (ResponseCache.key(url, headers), shaping, revalidate,
+            stop_at_amp)
+
+
+def _send(url, config, revalidate=False, stop_at_amp=False, build_doc=False):
+    """Sends the GET request of every sync code path, unless the same
+    request is already in flight, see `single_flight`. Urls which are
+    known to redirect permanently are requested at their final url.
+    """
+    target = redirects.resolve(url, config)
+    key = _flight_key(target, config, revalidate, stop_at_amp)
+    try:
+        response = _shared(*single_flight.do(key, _send_once, target, config,
+                                             revalidate, stop_at_amp,
+                                             build_doc))
+    except requests.exceptions.RequestException:
+        _sent_to(url, target)
+        raise
+    _sent_to(url, target, response)
+    return response
+
+
+def _send_once(url, config, revalidate=False, stop_at_amp=False,
+               build_doc=False):
+    """Answers from the response cache when enabled. With `revalidate`,
+    the request is made conditional on the last stored response of `url`.
+    """
+    timeout = host_latencies.timeout(get_domain(url), config)
+    kwargs = get_request_kwargs(timeout, config.browser_user_agent,
+                                config.proxies, config.headers)
+    request_headers = kwargs['headers']
+    response = _from_cache(url, config, request_headers, stop_at_amp)
+    if response is not None:
+        return response
+
+    kwargs['headers'] = _negotiated(kwargs['headers'], config)
+    stored = _validators.load(url) if revalidate else None
+    if stored is not None:
+        kwargs['headers'] = _conditional_headers(kwargs['headers'], stored)
+
+    proxy = proxies.select(url, config)
+    if proxy is not None:
+        kwargs['proxies'] = {'http': proxy, 'https': proxy}
+    started = time.time()
+    try:
+        response = get_session(config).get(url, stream=True, **kwargs)
+        _read_body(url, response, config, stop_at_amp, build_doc)
+    except requests.exceptions.Timeout:
+        proxies.record(proxy, started, config)
+        _record_host(url, config, timeout=timeout)
+        raise
+    except requests.exceptions.ConnectionError:
+        proxies.record(proxy, started, config)
+        _record_host(url, config)
+        raise
+    proxies.record(proxy, started, config, response)
+    _record_host(url, config, response)
+    if config.remember_redirects:
+        redirects.redirect_map.record(response)
+
+    if revalidate:
+        response = _revalidated(url, response, stored)
+    _to_cache(url, config, request_headers, response, stop_at_amp)
+    return response
+
+
+def fetch(url, config=None, revalidate=False, decode=True,
+          stop_at_amp=False, build_doc=False):
+    """Downloads `url` and returns its html along with the response, whose
+    `truncated` flag tells if the body was cut at `config.max_html_bytes`.
+    With `decode` off the html is left as bytes and `response.encoding`
+    tells how to decode them. With `stop_at_amp`, only the head of a page
+    linking to an AMP variant is downloaded and `response.amp_url` is set.
+    With `build_doc` and `config.parse_while_downloading`, `response.doc`
+    holds the tree parsed while downloading.
+    """
+    config = config or Configuration()
+    response = _send(url, config, revalidate, stop_at_amp, build_doc)
+
+    html = _response_html(response, config, decode)
+
+    if config.http_success_only:
+        # fail if HTTP sends a non 2XX response
+        response.raise_for_status()
+
+    return html, response
+
+
+def get_html(url, config=None, response=None, revalidate=False, decode=True):
     """HTTP response code agnostic
     """
     try:
-        return get_html_2XX_only(url, config, response)
+        return get_html_2XX_only(url, config, response, revalidate, decode)
     except requests.exceptions.RequestException as e:
         log.debug('get_html() error. %s on URL: %s' % (e, url))
         return ''
 
 
-def get_html_2XX_only(url, config=None, response=None):
+def get_html_2XX_only(url, config=None, response=None, revalidate=False,
+                      decode=True):
     """Consolidated logic for http requests from newspaper. We handle error cases:
-    - Attempt to find encoding of the html by using HTTP header. Fallback to
-      'ISO-8859-1' if not provided.
+    - Find the encoding of the html from the HTTP header, a byte order
+      mark or a <meta charset>, see `encoding.decode_html`.
     - Error out if a non 2XX HTTP response code is returned.
+    - With `revalidate`, send a conditional GET and reuse the stored body
+      if the server answers 304 Not Modified.
+    - Skip the body of non html content types and stop reading it at
+      `config.max_html_bytes`.
+    With `decode` off the html is returned as bytes, see `fetch`.
     """
     config = config or Configuration()
-    useragent = config.browser_user_agent
-    timeout = config.request_timeout
-    proxies = config.proxies
-    headers = config.headers
 
     if response is not None:
-        return _get_html_from_response(response, config)
+        return _response_html(response, config, decode)
 
-    response = requests.get(
-        url=url, **get_request_kwargs(timeout, useragent, proxies, headers))
+    return fetch(url, config, revalidate, decode)[0]
 
-    html = _get_html_from_response(response, config)
 
-    if config.http_success_only:
-        # fail if HTTP sends a non 2XX response
-        response.raise_for_status()
+def _get_html_from_response(response, config):
+    content_type = response.headers.get('content-type')
+    if content_type in config.ignored_content_types_defaults:
+        return config.ignored_content_types_defaults[content_type]
+    html, response.encoding = decode_html(response.content, content_type)
+    return html or ''
 
-    return html
 
+def _get_bytes_from_response(response, config):
+    content_type = response.headers.get('content-type')
+    if content_type in config.ignored_content_types_defaults:
+        return config.ignored_content_types_defaults[content_type]
+    response.encoding = guess_encoding(response.content, content_type)
+    return response.content
 
-def _get_html_from_response(response, config):
-    if response.headers.get('content-type') in config.ignored_content_types_defaults:
-        return config.ignored_content_types_defaults[response.headers.get('content-type')]
-    if response.encoding != FAIL_ENCODING:
-        # return response as a unicode string
-        html = response.text
-    else:
-        html = response.content
-        if 'charset' not in response.headers.get('content-type'):
-            encodings = requests.utils.get_encodings_from_content(response.text)
-            if len(encodings) > 0:
-                response.encoding = encodings[0]
-                html = response.text
 
-    return html or ''
+def _response_html(response, config, decode=True):
+    if decode:
+        return _get_html_from_response(response, config)
+    return _get_bytes_from_response(response, config)
+
+
+def _retry_after(response):
+    """Seconds to wait according to the Retry-After header of `response`,
+    given either as a number of seconds or as an HTTP date
+    """
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, date.timestamp() - time.time())
+
+
+def _backoff(attempt, config, retry_after=None):
+    """Full jitter exponential backoff unless the server said how long
+    to wait
+    """
+    if retry_after is not None:
+        return min(retry_after, config.retry_backoff_max)
+    ceiling = min(config.retry_backoff_max,
+                  config.retry_backoff * 2 ** (attempt - 1))
+    return random.uniform(0, ceiling)
 
 
 class MRequest(object):
@@ -94,43 +981,164 @@ class MRequest(object):
     If this is the case, we still want to report the url which has failed
     so (perhaps) we can try again later.
     """
-    def __init__(self, url, config=None):
+    def __init__(self, url, config=None, revalidate=False, build_doc=False,
+                 stop_at_amp=False):
         self.url = url
-        self.config = config
-        config = config or Configuration()
-        self.useragent = config.browser_user_agent
-        self.timeout = config.request_timeout
-        self.proxies = config.proxies
-        self.headers = config.headers
+        self.config = config or Configuration()
+        self.revalidate = revalidate
+        self.build_doc = build_doc
+        self.stop_at_amp = stop_at_amp
         self.resp = None
+        self.error = None
+        self.attempts = 0
 
     def send(self):
+        """Makes one attempt, returns the seconds to wait before the
+        request should be retried or None once it is done
+        """
+        config = self.config
+        host = get_domain(self.url)
+        if breaker.is_open(host, config.breaker_cooldown):
+            log.critical('[REQUEST FAILED] %s is paused, skipped %s' %
+                         (host, self.url))
+            self.error = requests.exceptions.ConnectionError(
+                '%s is paused after repeated failures' % host)
+            return None
+
+        self.attempts += 1
+        retryable = False
+        retry_after = None
+        error = None
         try:
-            self.resp = requests.get(self.url, **get_request_kwargs(
-                self.timeout, self.useragent, self.proxies, self.headers))
-            if self.config.http_success_only:
+            self.resp = _send(self.url, config, self.revalidate,
+                              self.stop_at_amp, self.build_doc)
+            if self.resp.status_code in config.retry_statuses:
+                retryable = True
+                retry_after = _retry_after(self.resp)
+            if config.http_success_only:
                 self.resp.raise_for_status()
+        except (requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout) as e:
+            retryable = True
+            error = e
         except requests.exceptions.RequestException as e:
-            log.critical('[REQUEST FAILED] ' + str(e))
+            error = e
 
+        breaker.record(host, not retryable, config.breaker_threshold)
+        if retryable and self.attempts <= config.max_retries:
+            delay = _backoff(self.attempts, config, retry_after)
+            log.warning('[REQUEST RETRY] %s in %.1f seconds, attempt %d '
+                        'failed' % (self.url, delay, self.attempts))
+            return delay
+        if error is not None:
+            log.critical('[REQUEST FAILED] ' + str(error))
+        self.error = error
+        return None
 
-def multithread_request(urls, config=None):
-    """Request multiple urls via mthreading, order of urls & requests is stable
-    returns same requests but with response variables filled.
+
+def _iter_mrequests(m_requests, config, window):
+    """Sends `m_requests` on a `DomainScheduler` and yields each of them
+    as soon as it is done, with at most `window` requests sent or queued
+    but not yet yielded. A request to retry goes to the back of its
+    domain's queue and the domain is put on hold for the backoff, so the
+    threads keep working on the healthy domains meanwhile.
     """
-    config = config or Configuration()
     num_threads = config.number_threads
-    timeout = config.thread_timeout_seconds
+    limits = None
+    if config.adaptive_concurrency:
+        limits = mthreading.host_limits.limiter(config, num_threads)
+    pool = DomainScheduler(num_threads, per_domain=num_threads, stream=True,
+                           limits=limits)
+    finished = queue.Queue()
+
+    def attempt(domain, req):
+        retry_in = None
+        try:
+            retry_in = req.send()
+        except Exception as e:
+            # every request which is done holds a response or its error
+            log.critical('[REQUEST FAILED] %s: %r' % (req.url, e))
+            req.error = e
+        finally:
+            if retry_in is None:
+                finished.put(req)
+            else:
+                pool.defer(domain, retry_in)
+                pool.add_task(domain, attempt, domain, req)
 
-    pool = ThreadPool(num_threads, timeout)
+    if config.respect_robots_txt:
+        m_requests = list(m_requests)
+        robots.prefetch([req.url for req in m_requests], config)
+    pool.start()
+    pending = 0
+    paced = set()
+    try:
+        for req in m_requests:
+            while pending >= window or not finished.empty():
+                yield finished.get()
+                pending -= 1
+            try:
+                domain = get_domain(req.url)
+            except ValueError as e:
+                req.error = e
+                finished.put(req)
+                pending += 1
+                continue
+            if config.respect_robots_txt and domain not in paced:
+                paced.add(domain)
+                pool.set_delay(domain, robots.crawl_delay(req.url, config))
+            pool.add_task(domain, attempt, domain, req)
+            pending += 1
+        while pending:
+            yield finished.get()
+            pending -= 1
+    finally:
+        # the consumer may stop early, drop what has not started yet
+        pool.cancel()
+        pool.close()
+        if config.adaptive_concurrency:
+            mthreading.host_limits.save()
+        save_urls()
 
-    m_requests = []
-    for url in urls:
-        m_requests.append(MRequest(url, config))
 
-    for req in m_requests:
-        pool.add_task(req.send)
+def iter_requests(urls, config=None, revalidate=False, window=None,
+                  build_doc=False, stop_at_amp=False):
+    """Downloads `urls` on the shared threads and yields a
+    `(url, response_or_error)` pair as soon as each one is done, in
+    completion order. The error is the exception of a request which
+    failed for good, a `requests` one unless the url itself is broken,
+    a response is never None. At most `window` (default: twice
+    `config.number_threads`) urls are in flight or waiting to be consumed
+    at any time, so the consumer can start parsing while slow hosts are
+    still downloading. See `fetch` for `build_doc` and `stop_at_amp`.
+    """
+    config = config or Configuration()
+    window = window or 2 * config.number_threads
+    m_requests = (MRequest(url, config, revalidate, build_doc, stop_at_amp)
+                  for url in urls)
+    for req in _iter_mrequests(m_requests, config, window):
+        if req.error is not None:
+            yield req.url, req.error
+        else:
+            yield req.url, req.resp
+
 
-    pool.wait_completion()
+def multithread_request(urls, config=None, revalidate=False):
+    """Request multiple urls via mthreading, order of urls & requests is stable
+    returns same requests but with response variables filled.
+    See `iter_requests` to consume them as they complete.
+    """
+    config = config or Configuration()
+    m_requests = [MRequest(url, config, revalidate) for url in urls]
+    for _ in _iter_mrequests(m_requests, config, max(len(m_requests), 1)):
+        pass
     return m_requests
 
+
+def save_urls():
+    """Writes the redirects and AMP variants learnt since the last save,
+    done after every batch of downloads and at exit
+    """
+    redirects.redirect_map.save()
+    amp.known.save()
+
@@ -6,6 +6,8 @@ https://github.com/codelucas/newspaper/blob/master/GOOSE-LICENSE.txt
 Parser objects will only contain operations that manipulate
 or query an lxml or soup dom object generated from an article's html.
 """
+import codecs
+import contextlib
 import logging
 import lxml.etree
 import lxml.html
@@ -13,22 +15,270 @@ import lxml.html.clean
 import re
 from html import unescape
 import string
+import threading
 
-from bs4 import UnicodeDammit
+from collections import defaultdict, OrderedDict
 from copy import deepcopy
 
+from lxml.cssselect import CSSSelector
+
 from . import text
+from .encoding import decode_html, detect_encoding, PRESCAN_BYTES
 
 log = logging.getLogger(__name__)
 
+# Python codec names libxml2 knows under another name
+LXML_ENCODINGS = {
+    'utf-8-sig': 'utf-8',
+}
+
+# What `lxml.html.fromstring` takes for a whole document, anything else
+# goes through its fragment handling
+FULL_HTML_RE = re.compile(rb'^\s*<(?:html|!doctype)', re.I)
+
+# XPath's translate() in `getElementsByTag` only folds ASCII letters
+ASCII_LOWER = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+# The css selectors a `DocIndex` answers: a tag, optionally with one
+# attribute equal to a value
+SIMPLE_SELECTOR_RE = re.compile(
+    r'^([a-zA-Z][\w-]*)(?:\[([a-zA-Z][\w:-]*)='
+    r'(?:"([^"]*)"|\'([^\']*)\'|([\w:.-]+))\])?$')
+
+# Indexes of the documents of the current thread, see `Parser.indexed`
+_indexes = threading.local()
+
+# Compiled selectors every thread keeps, see `SelectorCache`
+SELECTOR_CACHE_SIZE = 512
+
+EXSLT_NAMESPACES = {'re': 'http://exslt.org/regular-expressions'}
+
+
+class IncrementalParser(object):
+    """Builds the tree of a page chunk by chunk while it downloads, see
+    `config.parse_while_downloading`. The first `PRESCAN_BYTES` are held
+    back until the encoding is known, pages which don't declare one are
+    fed as UTF-8 for as long as they decode as such. `close()` returns the
+    document `Parser.fromstring` would have built, or None when the page
+    has to be parsed the regular way after all.
+    """
+    def __init__(self, content_type=None):
+        self.content_type = content_type
+        self.encoding = None
+        self.failed = False
+        self.parser = None
+        self.chunks = []
+        self.size = 0
+        # Checks that undeclared pages really are UTF-8
+        self.utf8 = None
+
+    def _start(self, data):
+        if not FULL_HTML_RE.match(data):
+            self.failed = True
+            return
+        encoding = detect_encoding(data, self.content_type)
+        if encoding is None:
+            encoding = 'utf-8'
+            self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        try:
+            self.parser = lxml.html.HTMLParser(
+                encoding=LXML_ENCODINGS.get(encoding, encoding))
+        except LookupError:
+            self.failed = True
+            return
+        self.encoding = encoding
+        self._feed(data)
+
+    def _feed(self, data):
+        try:
+            if self.utf8 is not None:
+                self.utf8.decode(data)
+            self.parser.feed(data)
+        except (UnicodeDecodeError, lxml.etree.LxmlError):
+            self.failed = True
+
+    def feed(self, chunk):
+        if self.failed:
+            return
+        if self.parser is not None:
+            self._feed(chunk)
+            return
+        self.chunks.append(chunk)
+        self.size += len(chunk)
+        if self.size >= PRESCAN_BYTES:
+            self._start(b''.join(self.chunks))
+            self.chunks = None
+
+    def close(self):
+        if not self.failed and self.parser is None:
+            self._start(b''.join(self.chunks))
+            self.chunks = None
+        if self.failed:
+            return None
+        try:
+            if self.utf8 is not None:
+                self.utf8.decode(b'', True)
+            return self.parser.close()
+        except (UnicodeDecodeError, lxml.etree.LxmlError):
+            return None
+
+
+class SelectorCache(object):
+    """Bounded LRU of compiled `lxml.etree.XPath` expressions, keyed by
+    expression and namespaces, and of css selectors compiled to XPath, so
+    that the selectors every article runs are only compiled once. A
+    compiled expression evaluates under a lock of its own, each thread
+    keeps its own cache. A `maxsize` of 0 compiles on every call.
+    """
+    def __init__(self, maxsize=SELECTOR_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._local = threading.local()
+
+    def _get(self, key, compile, *args, **kwargs):
+        if not self.maxsize:
+            return compile(*args, **kwargs)
+        cache = getattr(self._local, 'cache', None)
+        if cache is None:
+            cache = self._local.cache = OrderedDict()
+        compiled = cache.get(key)
+        if compiled is not None:
+            cache.move_to_end(key)
+            return compiled
+        compiled = cache[key] = compile(*args, **kwargs)
+        if len(cache) > self.maxsize:
+            cache.popitem(last=False)
+        return compiled
+
+    def xpath(self, expression, namespaces=None):
+        key = ('xpath', expression,
+               tuple(sorted(namespaces.items())) if namespaces else None)
+        return self._get(key, lxml.etree.XPath, expression,
+                         namespaces=namespaces)
+
+    def css(self, selector):
+        return self._get(('css', selector), CSSSelector, selector,
+                         translator='html')
+
+    def clear(self):
+        self._local = threading.local()
+
+
+selectors = SelectorCache()
+
+
+class DocIndex(object):
+    """Elements of a document by tag and by attribute, gathered in one
+    traversal. The metadata extractors query the same document dozens of
+    times, see `Parser.indexed`. The index is not updated when the tree
+    changes.
+    """
+    def __init__(self, doc):
+        self.doc = doc
+        # What readers of the document derive from it, dropped along with
+        # the index, e.g. the `MetaTags` of the extractors
+        self.memo = {}
+        self.elements = []
+        self.tags = defaultdict(list)
+        self.attributes = defaultdict(list)
+        self._lowered = {}
+        for element in doc.iter():
+            if not isinstance(element.tag, str):
+                # comments and processing instructions
+                continue
+            self.elements.append(element)
+            self.tags[element.tag].append(element)
+            for attr, value in element.items():
+                self.attributes[attr].append((element, value))
+
+    def _lowered_values(self, attr):
+        lowered = self._lowered.get(attr)
+        if lowered is None:
+            lowered = self._lowered[attr] = [
+                (element, value.translate(ASCII_LOWER))
+                for element, value in self.attributes.get(attr, ())]
+        return lowered
+
+    def find(self, tag=None, attr=None, value=None, use_regex=False):
+        """The elements `Parser.getElementsByTag` selects on the whole
+        document, in document order. None when the query is left to XPath
+        """
+        if not (attr and value):
+            if tag:
+                return list(self.tags.get(tag, ()))
+            return list(self.elements)
+        if use_regex:
+            try:
+                pattern = re.compile(value, re.I)
+            except re.error:
+                return None
+            if pattern.search(''):
+                # elements without the attribute would match too
+                return None
+            found = [element for element, attr_value
+                     in self.attributes.get(attr, ())
+                     if pattern.search(attr_value)]
+        else:
+            value = value.lower()
+            found = [element for element, attr_value
+                     in self._lowered_values(attr) if value in attr_value]
+        if tag:
+            found = [element for element in found if element.tag == tag]
+        return found
+
+    def select(self, selector):
+        """The elements a simple `tag[attr="value"]` css selector
+        matches, None for any other selector
+        """
+        match = SIMPLE_SELECTOR_RE.match(selector.strip())
+        if match is None:
+            return None
+        # html element and attribute names are case insensitive
+        tag, attr = match.group(1).lower(), match.group(2)
+        if attr is None:
+            return list(self.tags.get(tag, ()))
+        value = next(v for v in match.groups()[2:] if v is not None)
+        return [element for element, attr_value
+                in self.attributes.get(attr.lower(), ())
+                if attr_value == value and element.tag == tag]
+
 
 class Parser(object):
 
+    @classmethod
+    @contextlib.contextmanager
+    def indexed(cls, doc):
+        """Within the block, the queries `getElementsByTag` and
+        `css_select` make on the whole of `doc` are answered from a
+        `DocIndex`. The tree must not be modified meanwhile.
+        """
+        docs = getattr(_indexes, 'docs', None)
+        if docs is None:
+            docs = _indexes.docs = {}
+        if doc is None or id(doc) in docs:
+            yield
+            return
+        docs[id(doc)] = DocIndex(doc)
+        try:
+            yield
+        finally:
+            del docs[id(doc)]
+
+    @classmethod
+    def get_index(cls, node):
+        """The `DocIndex` of `node` if it is an indexed document
+        """
+        index = getattr(_indexes, 'docs', {}).get(id(node))
+        if index is not None and index.doc is node:
+            return index
+        return None
+
+    @classmethod
+    def xpath(cls, node, expression, namespaces=None):
+        return selectors.xpath(expression, namespaces)(node)
+
     @classmethod
     def xpath_re(cls, node, expression):
-        regexp_namespace = "http://exslt.org/regular-expressions"
-        items = node.xpath(expression, namespaces={'re': regexp_namespace})
-        return items
+        return cls.xpath(node, expression, EXSLT_NAMESPACES)
 
     @classmethod
     def drop_tag(cls, nodes):
@@ -40,7 +290,12 @@ class Parser(object):
 
     @classmethod
     def css_select(cls, node, selector):
-        return node.cssselect(selector)
+        index = cls.get_index(node)
+        if index is not None:
+            elems = index.select(selector)
+            if elems is not None:
+                return elems
+        return selectors.css(selector)(node)
 
     @classmethod
     def get_unicode_html(cls, html):
@@ -48,16 +303,28 @@ class Parser(object):
             return html
         if not html:
             return html
-        converted = UnicodeDammit(html, is_html=True)
-        if not converted.unicode_markup:
-            raise Exception(
-                'Failed to detect encoding of article HTML, tried: %s' %
-                ', '.join(converted.tried_encodings))
-        html = converted.unicode_markup
-        return html
+        return decode_html(html)[0]
 
     @classmethod
-    def fromstring(cls, html):
+    def fromstring(cls, html, encoding=None):
+        """Bytes of a known `encoding` are handed to lxml as they are and
+        decoded by libxml2 while parsing, anything else is decoded first
+        """
+        if isinstance(html, bytes) and encoding:
+            try:
+                parser = lxml.html.HTMLParser(
+                    encoding=LXML_ENCODINGS.get(encoding, encoding))
+            except LookupError:
+                log.debug('lxml can not decode %s, decoding first' % encoding)
+            else:
+                try:
+                    cls.doc = lxml.html.fromstring(html, parser=parser)
+                    return cls.doc
+                except Exception:
+                    log.warn('fromstring() could not parse %d bytes of %s',
+                             len(html), encoding)
+                    return
+            html = html.decode(encoding, 'replace')
         html = cls.get_unicode_html(html)
         # Enclosed in a `try` to prevent bringing the entire library
         # down due to one article (out of potentially many in a `Source`)
@@ -102,7 +369,7 @@ class Parser(object):
     @classmethod
     def getElementById(cls, node, idd):
         selector = '//*[@id="%s"]' % idd
-        elems = node.xpath(selector)
+        elems = cls.xpath(node, selector)
         if elems:
             return elems[0]
         return None
@@ -110,22 +377,32 @@ class Parser(object):
     @classmethod
     def getElementsByTag(
             cls, node, tag=None, attr=None, value=None, childs=False, use_regex=False) -> list:
+        index = cls.get_index(node)
+        elems = None
+        if index is not None:
+            elems = index.find(tag, attr, value, use_regex)
+        if elems is None:
+            elems = cls._xpath_elements_by_tag(node, tag, attr, value,
+                                               use_regex)
+        # remove the root node
+        # if we have a selection tag
+        if node in elems and (tag or childs):
+            elems.remove(node)
+        return elems
+
+    @classmethod
+    def _xpath_elements_by_tag(cls, node, tag, attr, value, use_regex):
         NS = None
         # selector = tag or '*'
         selector = 'descendant-or-self::%s' % (tag or '*')
         if attr and value:
             if use_regex:
-                NS = {"re": "http://exslt.org/regular-expressions"}
+                NS = EXSLT_NAMESPACES
                 selector = '%s[re:test(@%s, "%s", "i")]' % (selector, attr, value)
             else:
                 trans = 'translate(@%s, "%s", "%s")' % (attr, string.ascii_uppercase, string.ascii_lowercase)
                 selector = '%s[contains(%s, "%s")]' % (selector, trans, value.lower())
-        elems = node.xpath(selector, namespaces=NS)
-        # remove the root node
-        # if we have a selection tag
-        if node in elems and (tag or childs):
-            elems.remove(node)
-        return elems
+        return cls.xpath(node, selector, NS)
 
     @classmethod
     def appendChild(cls, node, child):
@@ -170,7 +447,7 @@ class Parser(object):
     def getElementsByTags(cls, node, tags):
         selector = 'descendant::*[%s]' % (
             ' or '.join('self::%s' % tag for tag in tags))
-        elems = node.xpath(selector)
+        elems = cls.xpath(node, selector)
         return elems
 
     @classmethod
@@ -183,7 +460,7 @@ class Parser(object):
 
     @classmethod
     def getComments(cls, node):
-        return node.xpath('//comment()')
+        return cls.xpath(node, '//comment()')
 
     @classmethod
     def getParent(cls, node):
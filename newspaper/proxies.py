@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Rotation over the proxies of `config.proxy_pool`. Every request through
+a proxy is timed and its outcome recorded, proxies which keep failing are
+quarantined for a while and the healthy ones are picked in proportion to
+their health score. `proxies.pool.stats()` reports the health of each one.
+"""
+__title__ = 'newspaper'
+__author__ = 'Lucas Ou-Yang'
+__license__ = 'MIT'
+__copyright__ = 'Copyright 2014, Lucas Ou-Yang'
+
+import logging
+import random
+import threading
+import time
+
+from urllib.parse import urlparse
+
+log = logging.getLogger(__name__)
+
+
+# Weight of the latest request in the moving averages of a proxy's
+# latency and error rate
+SMOOTHING = 0.2
+
+# Latency assumed for a proxy which has not been used yet
+INITIAL_LATENCY = 1.0
+
+
+class ProxyHealth(object):
+    def __init__(self):
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.latency = INITIAL_LATENCY
+        self.error_rate = 0.0
+        self.quarantined_until = 0
+        self.quarantines = 0
+
+    def score(self):
+        """Requests which succeed per second of latency, the weight of the
+        proxy when one is picked
+        """
+        return max(1 - self.error_rate, 0.01) / max(self.latency, 0.01)
+
+    def record(self, success, latency):
+        self.requests += 1
+        self.latency += SMOOTHING * (latency - self.latency)
+        self.error_rate += SMOOTHING * ((not success) - self.error_rate)
+        if success:
+            self.consecutive_failures = 0
+        else:
+            self.failures += 1
+            self.consecutive_failures += 1
+
+    def to_dict(self, now):
+        return {
+            'requests': self.requests,
+            'failures': self.failures,
+            'error_rate': round(self.error_rate, 3),
+            'latency': round(self.latency, 3),
+            'quarantined': self.quarantined_until > now,
+            'quarantines': self.quarantines,
+        }
+
+
+class ProxyPool(object):
+    """Health of every proxy newspaper has sent requests through, shared
+    by all configs, and the proxy each host is pinned to when
+    `config.proxy_rotation` is 'host'
+    """
+    def __init__(self):
+        self.health = {}
+        self.hosts = {}
+        self._lock = threading.Lock()
+        self._random = random.Random()
+
+    def _health(self, proxy):
+        health = self.health.get(proxy)
+        if health is None:
+            health = self.health[proxy] = ProxyHealth()
+        return health
+
+    def _pick(self, candidates, now):
+        healthy = [p for p in candidates
+                   if self._health(p).quarantined_until <= now]
+        if not healthy:
+            # everything is quarantined, the one released first is the
+            # least bad choice
+            return min(candidates,
+                       key=lambda p: self._health(p).quarantined_until)
+        weights = [self._health(p).score() for p in healthy]
+        point = self._random.uniform(0, sum(weights))
+        for proxy, weight in zip(healthy, weights):
+            point -= weight
+            if point < 0:
+                return proxy
+        return healthy[-1]
+
+    def select(self, url, config):
+        """Returns the proxy url the request of `url` should go through
+        """
+        candidates = list(config.proxy_pool)
+        now = time.time()
+        with self._lock:
+            if config.proxy_rotation != 'host':
+                return self._pick(candidates, now)
+            host = urlparse(url).netloc
+            proxy = self.hosts.get(host)
+            if proxy not in candidates or \
+                    self._health(proxy).quarantined_until > now:
+                proxy = self.hosts[host] = self._pick(candidates, now)
+            return proxy
+
+    def record(self, proxy, success, latency, config):
+        """Records the outcome of one request through `proxy`. It is
+        quarantined after `config.proxy_max_failures` failures in a row
+        """
+        with self._lock:
+            health = self._health(proxy)
+            health.record(success, latency)
+            if success or \
+                    health.consecutive_failures < config.proxy_max_failures:
+                return
+            health.quarantined_until = time.time() + config.proxy_quarantine
+            health.quarantines += 1
+            health.consecutive_failures = 0
+        log.warning('Proxy %s quarantined for %s seconds after repeated '
+                    'failures' % (proxy, config.proxy_quarantine))
+
+    def stats(self):
+        """Health of every proxy, keyed by proxy url
+        """
+        now = time.time()
+        with self._lock:
+            return {proxy: health.to_dict(now)
+                    for proxy, health in self.health.items()}
+
+    def reset(self):
+        with self._lock:
+            self.health.clear()
+            self.hosts.clear()
+
+
+pool = ProxyPool()
+
+
+def select(url, config):
+    """The proxy url the request of `url` goes through, None when
+    `config.proxy_pool` is empty and the static `config.proxies` apply
+    """
+    if not config.proxy_pool:
+        return None
+    return pool.select(url, config)
+
+
+def record(proxy, started, config, response=None):
+    """Records the request sent through `proxy` at `started`, which
+    failed unless there is a `response`. Responses of
+    `config.proxy_ban_statuses` tell the proxy is refused, banned or rate
+    limited and count as failures too.
+    """
+    if proxy is None:
+        return
+    success = response is not None and \
+        response.status_code not in config.proxy_ban_statuses
+    pool.record(proxy, success, time.time() - started, config)
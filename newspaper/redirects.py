@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Remembers the permanent redirects met while downloading, so that later
+requests and later runs go straight to the final url instead of paying
+the extra round trips again, see `config.remember_redirects`.
+"""
+__title__ = 'newspaper'
+__author__ = 'Lucas Ou-Yang'
+__license__ = 'MIT'
+__copyright__ = 'Copyright 2014, Lucas Ou-Yang'
+
+import atexit
+import logging
+import threading
+import time
+
+from urllib.parse import urlparse
+
+from .cache import DiskStore
+from .settings import REDIRECT_DIRECTORY
+
+log = logging.getLogger(__name__)
+
+
+# 301 Moved Permanently and 308 Permanent Redirect, temporary redirects
+# are followed every time
+PERMANENT_STATUSES = (301, 308)
+
+# Longest chain of remembered redirects followed by `resolve`
+MAX_HOPS = 10
+
+# Redirects kept per host, the oldest make room for new ones
+MAX_REDIRECTS_PER_HOST = 5000
+
+
+def permanent_hops(response):
+    """Yields (url, final url) for every url of the redirect history of
+    `response` which only went through permanent redirects to reach the
+    url it finally ended up at
+    """
+    history = getattr(response, 'history', None) or []
+    urls = [hop.url for hop in history] + [response.url]
+    for i, hop in enumerate(history):
+        j = i
+        while j < len(history) and \
+                history[j].status_code in PERMANENT_STATUSES:
+            j += 1
+        if j > i and urls[j] != urls[i]:
+            yield urls[i], urls[j]
+
+
+class RedirectMap(object):
+    """Maps the urls which redirected permanently to where they ended up.
+    Every host gets one entry on disk holding the redirects of its urls,
+    loaded the first time one of them is requested. Changes are written
+    by `save()`, once per batch of downloads and at exit, expired
+    redirects are dropped as they are met.
+    """
+    def __init__(self, directory):
+        self.store = DiskStore(directory)
+        self.hosts = {}
+        self.dirty = set()
+        self._lock = threading.Lock()
+
+    def _host(self, host):
+        redirects = self.hosts.get(host)
+        if redirects is None:
+            redirects = self.store.load(host) or {}
+            self.hosts[host] = redirects
+        return redirects
+
+    def get(self, url, ttl):
+        """Final url of `url` if it redirected less than `ttl` seconds ago
+        """
+        host = urlparse(url).netloc
+        with self._lock:
+            redirects = self._host(host)
+            entry = redirects.get(url)
+            if entry is None:
+                return None
+            if entry[1] + ttl < time.time():
+                del redirects[url]
+                self.dirty.add(host)
+                return None
+        return entry[0]
+
+    def resolve(self, url, ttl):
+        """Follows the remembered redirects of `url`, returns `url` when
+        there are none
+        """
+        seen = {url}
+        for _ in range(MAX_HOPS):
+            target = self.get(url, ttl)
+            if target is None or target in seen:
+                break
+            seen.add(target)
+            url = target
+        return url
+
+    def add(self, url, target):
+        host = urlparse(url).netloc
+        with self._lock:
+            redirects = self._host(host)
+            if redirects.get(url, (None,))[0] == target:
+                return
+            redirects.pop(url, None)
+            redirects[url] = (target, time.time())
+            while len(redirects) > MAX_REDIRECTS_PER_HOST:
+                del redirects[next(iter(redirects))]
+            self.dirty.add(host)
+        log.debug('Remembering the redirect of %s to %s' % (url, target))
+
+    def record(self, response):
+        """Remembers the permanent redirects `response` went through
+        """
+        for url, target in permanent_hops(response):
+            self.add(url, target)
+
+    def forget(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            redirects = self._host(host)
+            if redirects.pop(url, None) is not None:
+                self.dirty.add(host)
+
+    def save(self):
+        """Writes the hosts whose redirects changed since the last save
+        """
+        with self._lock:
+            changed = [(host, dict(self.hosts[host])) for host in self.dirty]
+            self.dirty.clear()
+        for host, redirects in changed:
+            self.store.save(host, redirects)
+
+    def clear(self):
+        with self._lock:
+            self.hosts.clear()
+            self.dirty.clear()
+
+
+redirect_map = RedirectMap(REDIRECT_DIRECTORY)
+atexit.register(lambda: redirect_map.save())
+
+
+def resolve(url, config):
+    """Where `url` should be requested, see `config.remember_redirects`
+    """
+    if not config.remember_redirects:
+        return url
+    return redirect_map.resolve(url, config.redirect_ttl)
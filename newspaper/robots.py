@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+robots.txt support. Every host's rules are fetched once and kept on disk
+for `config.robots_txt_ttl` seconds, see `config.respect_robots_txt`.
+"""
+__title__ = 'newspaper'
+__author__ = 'Lucas Ou-Yang'
+__license__ = 'MIT'
+__copyright__ = 'Copyright 2014, Lucas Ou-Yang'
+
+import logging
+import threading
+import time
+
+from collections import defaultdict
+from concurrent import futures
+from urllib.parse import urlparse
+from urllib.robotparser import RobotFileParser
+
+import requests
+
+from .cache import DiskStore
+from .settings import ROBOTS_DIRECTORY
+
+log = logging.getLogger(__name__)
+
+
+# Seconds before a robots.txt which could not be fetched is tried again,
+# all urls of its host are disallowed meanwhile
+UNREACHABLE_TTL = 600
+
+
+def robots_url(url):
+    parsed = urlparse(url)
+    return '%s://%s/robots.txt' % (parsed.scheme, parsed.netloc)
+
+
+def _download(url, config):
+    """Returns the status code and the text of the robots.txt at `url`,
+    a None status when the host could not be reached
+    """
+    from . import network
+
+    try:
+        text, response = network.fetch(url, config)
+        return response.status_code, text
+    except requests.exceptions.HTTPError as e:
+        return e.response.status_code, ''
+    except requests.exceptions.RequestException as e:
+        log.debug('Could not fetch %s: %s' % (url, e))
+        return None, ''
+
+
+def _parse(status, text):
+    """Rules as RFC 9309 reads a response: a 4XX allows everything, a
+    5XX or an unreachable host disallows everything
+    """
+    parser = RobotFileParser()
+    if status is None or status >= 500:
+        parser.disallow_all = True
+    elif status >= 400:
+        parser.allow_all = True
+    else:
+        parser.parse(text.splitlines())
+    return parser
+
+
+class RobotsCache(object):
+    """Keeps the parsed robots.txt of every host in memory and the raw
+    file on disk, so concurrent crawls and later runs don't fetch it again
+    """
+    def __init__(self, directory):
+        self.store = DiskStore(directory)
+        self.parsers = {}
+        self._lock = threading.Lock()
+        self._host_locks = defaultdict(threading.Lock)
+
+    def rules(self, url, config):
+        """Returns the `RobotFileParser` of the host of `url`
+        """
+        key = robots_url(url)
+        with self._lock:
+            host_lock = self._host_locks[key]
+        with host_lock:
+            now = time.time()
+            cached = self.parsers.get(key)
+            if cached is not None and cached[0] > now:
+                return cached[1]
+
+            stored = self.store.load(key)
+            if stored is not None and \
+                    stored[0] + config.robots_txt_ttl > now:
+                fetched_at, status, text = stored
+            else:
+                fetched_at = now
+                status, text = _download(key, config)
+                if status is not None and status < 500:
+                    self.store.save(key, (fetched_at, status, text))
+
+            if status is None or status >= 500:
+                expires = fetched_at + UNREACHABLE_TTL
+            else:
+                expires = fetched_at + config.robots_txt_ttl
+            parser = _parse(status, text)
+            self.parsers[key] = (expires, parser)
+            return parser
+
+    def can_fetch(self, url, config):
+        return self.rules(url, config).can_fetch(
+            config.browser_user_agent, url)
+
+    def crawl_delay(self, url, config):
+        """Crawl-delay of the host of `url` for our user agent, capped at
+        `config.max_crawl_delay`, 0 when there is none
+        """
+        delay = self.rules(url, config).crawl_delay(
+            config.browser_user_agent) or 0
+        return min(delay, config.max_crawl_delay)
+
+    def clear(self):
+        self.parsers.clear()
+
+
+cache = RobotsCache(ROBOTS_DIRECTORY)
+
+
+def prefetch(urls, config):
+    """Fetches the robots.txt of the distinct hosts of `urls` in parallel
+    on the shared executor, so that the `can_fetch` and `crawl_delay`
+    lookups which follow are answered from memory
+    """
+    from .mthreading import executor
+
+    first_urls = {}
+    for url in urls:
+        parsed = urlparse(url)
+        if parsed.scheme in ('http', 'https') and parsed.netloc:
+            first_urls.setdefault(robots_url(url), url)
+    if len(first_urls) < 2:
+        return
+    executor.reserve(len(first_urls))
+    futures.wait([executor.submit(cache.rules, url, config)
+                  for url in first_urls.values()])
+
+
+def can_fetch(url, config):
+    return cache.can_fetch(url, config)
+
+
+def crawl_delay(url, config):
+    return cache.crawl_delay(url, config)
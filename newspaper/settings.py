@@ -47,9 +47,35 @@ MEMO_DIR = os.path.join(TOP_DIRECTORY, MEMO_FILE)
 CF_CACHE_DIRECTORY = 'feed_category_cache'
 ANCHOR_DIRECTORY = os.path.join(TOP_DIRECTORY, CF_CACHE_DIRECTORY)
 
+# ETag / Last-Modified validators of source, category and feed pages
+VALIDATOR_CACHE = 'validator_cache'
+VALIDATOR_DIRECTORY = os.path.join(TOP_DIRECTORY, VALIDATOR_CACHE)
+
+# Opt-in cache of downloaded pages, see network.response_cache
+RESPONSE_CACHE = 'response_cache'
+RESPONSE_CACHE_DIRECTORY = os.path.join(TOP_DIRECTORY, RESPONSE_CACHE)
+
+# robots.txt of every crawled host, see robots.py
+ROBOTS_CACHE = 'robots_cache'
+ROBOTS_DIRECTORY = os.path.join(TOP_DIRECTORY, ROBOTS_CACHE)
+
+# Permanent redirects met while downloading, see redirects.py
+REDIRECT_CACHE = 'redirect_cache'
+REDIRECT_DIRECTORY = os.path.join(TOP_DIRECTORY, REDIRECT_CACHE)
+
+# Adaptive per host concurrency caps, see mthreading.HostLimits
+LIMITS_CACHE = 'concurrency_limits'
+LIMITS_DIRECTORY = os.path.join(TOP_DIRECTORY, LIMITS_CACHE)
+
+# AMP variants of the articles downloaded with config.prefer_amp
+AMP_CACHE = 'amp_cache'
+AMP_DIRECTORY = os.path.join(TOP_DIRECTORY, AMP_CACHE)
+
 TRENDING_URL = 'http://www.google.com/trends/hottrends/atom/feed?pn=p1'
 
-for path in (TOP_DIRECTORY, MEMO_DIR, ANCHOR_DIRECTORY):
+for path in (TOP_DIRECTORY, MEMO_DIR, ANCHOR_DIRECTORY, VALIDATOR_DIRECTORY,
+             RESPONSE_CACHE_DIRECTORY, ROBOTS_DIRECTORY, REDIRECT_DIRECTORY,
+             LIMITS_DIRECTORY, AMP_DIRECTORY):
     try:
         os.mkdir(path)
     except FileExistsError:
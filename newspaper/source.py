@@ -8,12 +8,18 @@ __author__ = 'Lucas Ou-Yang'
 __license__ = 'MIT'
 __copyright__ = 'Copyright 2014, Lucas Ou-Yang'
 
+import asyncio
 import logging
+import time
+from collections import defaultdict
 from urllib.parse import urljoin, urlsplit, urlunsplit
 
 from tldextract import tldextract
 
+from . import amp
 from . import network
+from . import redirects
+from . import robots
 from . import urls
 from . import utils
 from .article import Article
@@ -38,6 +44,15 @@ class Feed(object):
         # TODO self.dom = None, speed up Feedparser
 
 
+def _by_url(items):
+    """Maps every url to the categories, feeds or articles which have it
+    """
+    grouped = defaultdict(list)
+    for item in items:
+        grouped[item.url].append(item)
+    return grouped
+
+
 NUM_THREADS_PER_SOURCE_WARN_LIMIT = 5
 
 
@@ -92,6 +107,8 @@ class Source(object):
         self.parse()
 
         self.set_categories()
+        if self.config.prewarm_connections:
+            network.prewarm([c.url for c in self.categories], self.config)
         self.download_categories()  # mthread
         self.parse_categories()
 
@@ -101,6 +118,25 @@ class Source(object):
 
         self.generate_articles()
 
+    async def abuild(self):
+        """Asyncio version of `build()`, every download stage shares one
+        aiohttp session, requires aiohttp
+        """
+        from . import aio
+
+        async with aio.aio_session(self.config):
+            await self.adownload()
+            self.parse()
+
+            self.set_categories()
+            await self.adownload_categories()
+            self.parse_categories()
+
+            await self.aset_feeds()
+            await self.adownload_feeds()
+
+        self.generate_articles()
+
     def purge_articles(self, reason, articles):
         """Delete rejected articles, if there is an articles param,
         purge from there, otherwise purge from source instance.
@@ -112,6 +148,8 @@ class Source(object):
         """
         if reason == 'url':
             articles[:] = [a for a in articles if a.is_valid_url()]
+        elif reason == 'download':
+            articles[:] = [a for a in articles if a.has_html()]
         elif reason == 'body':
             articles[:] = [a for a in articles if a.is_valid_body()]
         return articles
@@ -128,9 +166,8 @@ class Source(object):
         urls = self._get_category_urls(self.domain)
         self.categories = [Category(url=url) for url in urls]
 
-    def set_feeds(self):
-        """Don't need to cache getting feed urls, it's almost
-        instant with xpath
+    def _get_common_feed_urls(self):
+        """Guesses the usual feed locations of this source
         """
         common_feed_urls = ['/feed', '/feeds', '/rss']
         common_feed_urls = [urljoin(self.url, url) for url in common_feed_urls]
@@ -142,18 +179,12 @@ class Source(object):
                 new_path = '/feed/' + split.path.split('/')[1]
                 new_parts = split.scheme, split.netloc, new_path, '', ''
                 common_feed_urls.append(urlunsplit(new_parts))
+        return common_feed_urls
 
-        common_feed_urls_as_categories = [Category(url=url) for url in common_feed_urls]
-
-        category_urls = [c.url for c in common_feed_urls_as_categories]
-        requests = network.multithread_request(category_urls, self.config)
-
-        for index, _ in enumerate(common_feed_urls_as_categories):
-            response = requests[index].resp
-            if response and response.ok:
-                common_feed_urls_as_categories[index].html = network.get_html(
-                    response.url, response=response)
-
+    def _set_feeds_from(self, common_feed_urls_as_categories):
+        """Extracts the feed urls out of the categories and the downloaded
+        common feed locations
+        """
         common_feed_urls_as_categories = [c for c in common_feed_urls_as_categories if c.html]
 
         for _ in common_feed_urls_as_categories:
@@ -167,6 +198,41 @@ class Source(object):
         urls = self.extractor.get_feed_urls(self.url, categories_and_common_feed_urls)
         self.feeds = [Feed(url=url) for url in urls]
 
+    def set_feeds(self):
+        """Don't need to cache getting feed urls, it's almost
+        instant with xpath
+        """
+        common_feed_urls_as_categories = [
+            Category(url=url) for url in self._get_common_feed_urls()]
+
+        by_url = _by_url(common_feed_urls_as_categories)
+        for url, response in network.iter_requests(
+                list(by_url), self.config,
+                revalidate=self.config.revalidate_source_pages):
+            if isinstance(response, Exception) or not response.ok:
+                continue
+            for category in by_url[url]:
+                category.html = network.get_html(
+                    response.url, response=response)
+
+        self._set_feeds_from(common_feed_urls_as_categories)
+
+    async def aset_feeds(self):
+        """Asyncio version of `set_feeds()`
+        """
+        from . import aio
+
+        common_feed_urls_as_categories = [
+            Category(url=url) for url in self._get_common_feed_urls()]
+
+        htmls = await aio.agather_html(
+            [c.url for c in common_feed_urls_as_categories], self.config,
+            revalidate=self.config.revalidate_source_pages)
+        for category, html in zip(common_feed_urls_as_categories, htmls):
+            category.html = html
+
+        self._set_feeds_from(common_feed_urls_as_categories)
+
     def set_description(self):
         """Sets a blurb for this source, for now we just query the
         desc html attribute
@@ -177,40 +243,85 @@ class Source(object):
     def download(self):
         """Downloads html of source
         """
-        self.html = network.get_html(self.url, self.config)
+        self.html = network.get_html(
+            self.url, self.config,
+            revalidate=self.config.revalidate_source_pages)
 
-    def download_categories(self):
-        """Download all category html, can use mthreading
+    async def adownload(self):
+        """Asyncio version of `download()`
         """
-        category_urls = [c.url for c in self.categories]
-        requests = network.multithread_request(category_urls, self.config)
+        from . import aio
 
-        for index, _ in enumerate(self.categories):
-            req = requests[index]
-            if req.resp is not None:
-                self.categories[index].html = network.get_html(
-                    req.url, response=req.resp)
-            else:
+        self.html = await aio.aget_html(
+            self.url, self.config,
+            revalidate=self.config.revalidate_source_pages)
+
+    def download_categories(self):
+        """Download all category html, can use mthreading. Categories are
+        parsed as they arrive, while the slower ones are still downloading
+        """
+        by_url = _by_url(self.categories)
+        for url, response in network.iter_requests(
+                list(by_url), self.config,
+                revalidate=self.config.revalidate_source_pages,
+                build_doc=True):
+            if isinstance(response, Exception):
                 log.warning(('Deleting category %s from source %s due to '
-                             'download error') %
-                             (self.categories[index].url, self.url))
+                             'download error') % (url, self.url))
+                continue
+            for category in by_url[url]:
+                category.html = network.get_html(url, response=response)
+                category.doc = response.doc
+                if category.doc is None:
+                    category.doc = self.config.get_parser().fromstring(
+                        category.html)
+                # a tree belongs to one category
+                response.doc = None
         self.categories = [c for c in self.categories if c.html]
 
     def download_feeds(self):
         """Download all feed html, can use mthreading
         """
-        feed_urls = [f.url for f in self.feeds]
-        requests = network.multithread_request(feed_urls, self.config)
+        by_url = _by_url(self.feeds)
+        for url, response in network.iter_requests(
+                list(by_url), self.config,
+                revalidate=self.config.revalidate_source_pages):
+            if isinstance(response, Exception):
+                log.warning(('Deleting feed %s from source %s due to '
+                             'download error') % (url, self.url))
+                continue
+            for feed in by_url[url]:
+                feed.rss = network.get_html(url, response=response)
+        self.feeds = [f for f in self.feeds if f.rss]
 
-        for index, _ in enumerate(self.feeds):
-            req = requests[index]
-            if req.resp is not None:
-                self.feeds[index].rss = network.get_html(
-                    req.url, response=req.resp)
-            else:
+    async def adownload_categories(self):
+        """Asyncio version of `download_categories()`
+        """
+        from . import aio
+
+        htmls = await aio.agather_html(
+            [c.url for c in self.categories], self.config,
+            revalidate=self.config.revalidate_source_pages)
+        for category, html in zip(self.categories, htmls):
+            category.html = html
+            if not html:
+                log.warning(('Deleting category %s from source %s due to '
+                             'download error') % (category.url, self.url))
+        self.categories = [c for c in self.categories if c.html]
+
+    async def adownload_feeds(self):
+        """Asyncio version of `download_feeds()`
+        """
+        from . import aio
+
+        htmls = await aio.agather_html(
+            [f.url for f in self.feeds], self.config,
+            revalidate=self.config.revalidate_source_pages)
+        for feed, html in zip(self.feeds, htmls):
+            feed.rss = html
+            if not html:
                 log.warning(('Deleting feed %s from source %s due to '
-                             'download error') %
-                             (self.categories[index].url, self.url))
+                             'download error') % (feed.url, self.url))
         self.feeds = [f for f in self.feeds if f.rss]
 
     def parse(self):
@@ -230,8 +341,9 @@ class Source(object):
         log.debug('We are extracting from %d categories' %
                   len(self.categories))
         for category in self.categories:
-            doc = self.config.get_parser().fromstring(category.html)
-            category.doc = doc
+            if category.doc is None:
+                category.doc = self.config.get_parser().fromstring(
+                    category.html)
 
         self.categories = [c for c in self.categories if c.doc is not None]
 
@@ -269,6 +381,7 @@ class Source(object):
                 cur_articles.append(article)
 
             cur_articles = self.purge_articles('url', cur_articles)
+            self.resolve_redirects(cur_articles)
             after_purge = len(cur_articles)
 
             if self.config.memoize_articles:
@@ -281,6 +394,13 @@ class Source(object):
                       (before_purge, after_purge, after_memo, feed.url))
         return articles
 
+    def resolve_redirects(self, articles):
+        """Points the articles whose url is known to redirect permanently
+        to their final url, so that memoization sees the final urls
+        """
+        for article in articles:
+            article.url = redirects.resolve(article.url, self.config)
+
     def categories_to_articles(self):
         """Takes the categories, splays them into a big list of urls and churns
         the articles out of each url with the url_to_article method
@@ -304,6 +424,7 @@ class Source(object):
                 cur_articles.append(_article)
 
             cur_articles = self.purge_articles('url', cur_articles)
+            self.resolve_redirects(cur_articles)
             after_purge = len(cur_articles)
 
             if self.config.memoize_articles:
@@ -330,6 +451,13 @@ class Source(object):
         """Saves all current articles of news source, filter out bad urls
         """
         articles = self._generate_articles()
+        if self.config.respect_robots_txt:
+            robots.prefetch([a.url for a in articles], self.config)
+            allowed = [a for a in articles
+                       if robots.can_fetch(a.url, self.config)]
+            log.debug('robots.txt disallows %d of %d articles',
+                      len(articles) - len(allowed), len(articles))
+            articles = allowed
         self.articles = articles[:limit]
         log.debug('%d articles generated and cutoff at %d',
                   len(articles), limit)
@@ -340,27 +468,129 @@ class Source(object):
         # TODO fix how the article's is_downloaded is not set!
         urls = [a.url for a in self.articles]
         failed_articles = []
+        decode = not self.config.keep_html_bytes
 
         if threads == 1:
-            for index, article in enumerate(self.articles):
-                url = urls[index]
-                html = network.get_html(url, config=self.config)
-                self.articles[index].set_html(html)
-                if not html:
-                    failed_articles.append(self.articles[index])
-            self.articles = [a for a in self.articles if a.html]
+            pace = self.config.respect_robots_txt
+            if pace:
+                robots.prefetch(urls, self.config)
+            next_start = {}
+            for url, article in zip(urls, self.articles):
+                if pace:
+                    # the Crawl-delay of robots.txt spaces the requests
+                    # sent to one host
+                    host = urlsplit(url).netloc
+                    wait = next_start.get(host, 0) - time.time()
+                    if wait > 0:
+                        time.sleep(wait)
+                    next_start[host] = time.time() + robots.crawl_delay(
+                        url, self.config)
+                # the same download as a standalone article's, which tells
+                # whether the html was truncated
+                article.download()
+                if not article.has_html():
+                    failed_articles.append(article)
+            self.articles = [a for a in self.articles if a.has_html()]
         else:
-            if threads > NUM_THREADS_PER_SOURCE_WARN_LIMIT:
+            if threads > NUM_THREADS_PER_SOURCE_WARN_LIMIT and \
+                    not self.config.adaptive_concurrency:
                 log.warning(('Using %s+ threads on a single source '
                             'may result in rate limiting!') % NUM_THREADS_PER_SOURCE_WARN_LIMIT)
-            filled_requests = network.multithread_request(urls, self.config)
-            # Note that the responses are returned in original order
-            for index, req in enumerate(filled_requests):
-                html = network.get_html(req.url, response=req.resp)
-                self.articles[index].set_html(html)
-                if not req.resp:
-                    failed_articles.append(self.articles[index])
-            self.articles = [a for a in self.articles if a.html]
+            by_url = _by_url(self.articles)
+            # Responses come in as they complete
+            for url, response in self._iter_responses(by_url):
+                if isinstance(response, Exception):
+                    failed_articles.extend(by_url[url])
+                    continue
+                html = network.get_html(url, self.config, response,
+                                        decode=decode)
+                for article in by_url[url]:
+                    article.set_response(response)
+                    article.set_html(html)
+                    # a tree belongs to one article
+                    response.doc = None
+            self.articles = [a for a in self.articles if a.has_html()]
+
+        self.is_downloaded = True
+        if len(failed_articles) > 0:
+            log.warning('The following article urls failed the download: %s' %
+                        ', '.join([a.url for a in failed_articles]))
+
+    def _iter_responses(self, by_url):
+        """Downloads the articles grouped in `by_url` on the shared threads
+        and yields every article url with its response or error as they
+        complete. With `config.prefer_amp`, the articles which link to an
+        AMP variant get the response of the AMP page and their `amp_url`
+        and `canonical_head` are set, like `Article.download` does. The
+        original page is downloaded after all when its variant fails.
+        """
+        config = self.config
+        if not config.prefer_amp:
+            yield from network.iter_requests(list(by_url), config,
+                                             build_doc=True)
+            return
+
+        # AMP url -> urls of the articles it stands in for
+        variants = defaultdict(list)
+
+        def request(url, amp_url):
+            """Urls to request for the article at `url`
+            """
+            if amp_url is None or amp_url in by_url:
+                return [url]
+            first = not variants[amp_url]
+            variants[amp_url].append(url)
+            return [amp_url] if first else []
+
+        requested = []
+        for url, articles in by_url.items():
+            for article in articles:
+                article.amp_url = article.canonical_head = None
+            requested += request(url, amp.known_amp_url(url))
+        # the first round reads the heads of the original pages
+        stop_at_amp = True
+        while requested:
+            retry = []
+            for url, response in network.iter_requests(
+                    requested, config, build_doc=True,
+                    stop_at_amp=stop_at_amp):
+                failed = isinstance(response, Exception)
+                if url in variants:
+                    originals = variants.pop(url)
+                    for original in originals:
+                        if failed:
+                            log.debug('AMP variant %s of %s failed: %s' %
+                                      (url, original, response))
+                            amp.known.forget(original)
+                            for article in by_url[original]:
+                                article.canonical_head = None
+                            retry.append(original)
+                            continue
+                        amp.remember(original, url)
+                        for article in by_url[original]:
+                            article.amp_url = url
+                        yield original, response
+                elif not failed and response.amp_url is not None:
+                    head = network.get_html(url, config, response)
+                    for article in by_url[url]:
+                        article.canonical_head = head
+                    retry += request(url, response.amp_url)
+                else:
+                    yield url, response
+            requested = retry
+            stop_at_amp = False
+
+    async def adownload_articles(self):
+        """Asyncio version of `download_articles()`, every article is
+        downloaded concurrently with `Article.adownload`, bounded per host
+        by `config.pool_maxsize`
+        """
+        from . import aio
+
+        async with aio.aio_session(self.config):
+            await asyncio.gather(*[a.adownload() for a in self.articles])
+        failed_articles = [a for a in self.articles if not a.has_html()]
+        self.articles = [a for a in self.articles if a.has_html()]
 
         self.is_downloaded = True
         if len(failed_articles) > 0:
@@ -261,6 +261,22 @@ def url_to_filetype(abs_url):
     return None
 
 
+def normalize_url(abs_url):
+    """
+    Canonical form of a url for use as a cache key: lowercase scheme and
+    host, no default port, no fragment and sorted query arguments.
+    'HTTP://CNN.com:80/a?b=2&a=1#top' -> 'http://cnn.com/a?a=1&b=2'
+    """
+    parsed = urlsplit(abs_url)
+    scheme = parsed.scheme.lower()
+    netloc = parsed.netloc.lower()
+    if (scheme, netloc.rsplit(':', 1)[-1]) in (('http', '80'),
+                                               ('https', '443')):
+        netloc = netloc.rsplit(':', 1)[0]
+    query = '&'.join(sorted(q for q in parsed.query.split('&') if q))
+    return urlunsplit((scheme, netloc, parsed.path or '/', query, ''))
+
+
 def get_domain(abs_url, **kwargs):
     """
     returns a url's domain, this method exists to
@@ -56,6 +56,10 @@ setup(
     packages=packages,
     include_package_data=True,
     install_requires=required,
+    extras_require={
+        'async': ['aiohttp>=3.5; python_version >= "3.7"'],
+        'compression': ['urllib3[brotli,zstd]'],
+    },
     license='MIT',
     zip_safe=False,
     classifiers=[
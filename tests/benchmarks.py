@@ -6,15 +6,18 @@ Multi-thread:           5.9 secs (10 threads) for 100 requests
 Async-IO with Gevent:   10.5 secs  for 100 requests
 Single thread:          86.0 secs for 100 requests
 """
+import asyncio
 import sys
 import logging
 import queue
 import os
+import time
 
-from threading import activeCount
-from threading import Thread
-from http.cookiejar import CookieJar as cj
-from .unit_tests import read_urls
+import requests
+
+from bs4 import UnicodeDammit
+
+from .unit_tests import HTML_FN, LocalServer
 
 try:  # Python 2.7+
     from logging import NullHandler
@@ -29,17 +32,39 @@ log = logging.getLogger(__name__)
 PARENT_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.insert(0, os.path.join(PARENT_DIR, '..'))
 
-from newspaper.network import multithread_request, sync_request
+from newspaper import Article, parsers
+from newspaper.aio import agather_html
+from newspaper.configuration import Configuration
+from newspaper.encoding import decode_html
+from newspaper.network import close_session, get_html, multithread_request
 from newspaper.utils import print_duration
 
 
+def read_urls(amount=1000):
+    """Returns up to `amount` article urls from the test data
+    """
+    with open(os.path.join(PARENT_DIR, 'data', 'fulltext_url_list.txt')) as f:
+        urls = [line.strip() for line in f if line.strip()]
+    return urls[:amount]
+
+
+def local_article_routes():
+    """Maps a path to every pre-downloaded article in tests/data/html
+    """
+    routes = {}
+    for fn in sorted(os.listdir(HTML_FN)):
+        with open(os.path.join(HTML_FN, fn), 'rb') as f:
+            routes['/' + fn] = (200, {}, f.read())
+    return routes
+
+
 @print_duration
 def naive_run(urls):
     """no multithreading or async io
     """
     resps = []
     for url in urls:
-        resps.append(sync_request(url))
+        resps.append(get_html(url))
     print(resps)
 
 
@@ -55,10 +80,91 @@ def mthread_run(urls):
 def asyncio_run(urls):
     """download a bunch of urls via async io
     """
-    pass
-    # rs = (grequests.request('GET', u, **req_kwargs) for u in urls)
-    # responses = async_request(urls)
-    # print(responses)
+    htmls = asyncio.run(agather_html(urls))
+    print('%d of %d urls downloaded' % (len([h for h in htmls if h]),
+                                        len(urls)))
+
+
+def connection_reuse_run():
+    """Counts the TCP connections a local server sees per article, for
+    one `requests.get` per url versus newspaper's pooled session
+    """
+    routes = local_article_routes()
+    with LocalServer(routes) as server:
+        urls = [server.url + path for path in routes]
+        for url in urls:
+            requests.get(url)
+        unpooled = server.connections
+
+        config = Configuration()
+        for url in urls:
+            get_html(url, config)
+        multithread_request(urls, config)
+        close_session(config)
+        pooled = server.connections - unpooled
+
+    print('requests.get:   %.2f connections per article' %
+          (unpooled / len(urls)))
+    print('pooled session: %.2f connections per article' %
+          (pooled / (2 * len(urls))))
+
+
+def encoding_detection_run(rounds=5):
+    """Time to decode every page of tests/data/html with the charset
+    prescan versus requests' header guess and UnicodeDammit
+    """
+    pages = [body for _, _, body in local_article_routes().values()]
+
+    def requests_decode(page):
+        response = requests.Response()
+        response._content = page
+        response.encoding = response.apparent_encoding
+        return response.text
+
+    for name, decode in (('prescan', decode_html),
+                         ('requests apparent_encoding', requests_decode),
+                         ('UnicodeDammit', lambda page: UnicodeDammit(
+                             page, is_html=True).unicode_markup)):
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for page in pages:
+                decode(page)
+        elapsed = time.perf_counter() - start
+        print('%-28s %.2f ms per page' %
+              (name + ':', 1000 * elapsed / (rounds * len(pages))))
+
+
+def selector_cache_run(rounds=3):
+    """Time to parse every page of tests/data/html with the compiled
+    selector cache versus compiling every XPath and css selector per call
+    """
+    pages = [body.decode('utf-8', 'replace')
+             for _, _, body in local_article_routes().values()]
+    config = Configuration()
+    config.fetch_images = False
+
+    def parse_all():
+        for page in pages:
+            article = Article('http://example.com/2019/01/01/story.html',
+                              config=config)
+            article.download(input_html=page)
+            article.parse()
+
+    maxsize = parsers.selectors.maxsize
+    parse_all()  # warm up, e.g. the stopwords
+    try:
+        for name, size in (('compiled per call', 0),
+                           ('selector cache', maxsize)):
+            parsers.selectors.maxsize = size
+            parsers.selectors.clear()
+            start = time.perf_counter()
+            for _ in range(rounds):
+                parse_all()
+            elapsed = time.perf_counter() - start
+            print('%-28s %.2f ms per article' %
+                  (name + ':', 1000 * elapsed / (rounds * len(pages))))
+    finally:
+        parsers.selectors.maxsize = maxsize
 
 
 def benchmark():
@@ -67,7 +173,10 @@ def benchmark():
     urls = read_urls(amount=1000)
     # naive_run(urls)
     mthread_run(urls)
-    # asyncio_run(urls)
+    asyncio_run(urls)
+    connection_reuse_run()
+    encoding_detection_run()
+    selector_cache_run()
 
 
 if __name__ == '__main__':
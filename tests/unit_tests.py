@@ -8,9 +8,22 @@ import unittest
 import time
 import traceback
 import re
+import asyncio
+import codecs
+import contextlib
+import datetime
+import gzip
+import tempfile
+import socket
+import threading
 from collections import defaultdict, OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
 import concurrent.futures
 
+import lxml.html
+import requests
+
 TEST_DIR = os.path.abspath(os.path.dirname(__file__))
 PARENT_DIR = os.path.join(TEST_DIR, '..')
 
@@ -25,10 +38,30 @@ URLS_FILE = os.path.join(TEST_DIR, 'data', 'fulltext_url_list.txt')
 
 import newspaper
 from newspaper import Article, fulltext, Source, ArticleException, news_pool
+from newspaper import (amp, encoding, network, parsers, proxies, redirects,
+                       robots)
+from newspaper import NewsPool
 from newspaper.article import ArticleDownloadState
+from newspaper.cache import ResponseCache, StoredResponse
 from newspaper.configuration import Configuration
+from newspaper.parsers import (DocIndex, IncrementalParser, Parser,
+                               SelectorCache)
+from newspaper import mthreading
+from newspaper.mthreading import (DomainScheduler, Executor, HostLimits,
+                                  executor)
+from newspaper.source import Category
 from newspaper.urls import get_domain
 
+if sys.version_info >= (3, 7):
+    from newspaper import aio
+    from newspaper.aio import AsyncNewsPool
+else:
+    aio = None
+
+# The asyncio engine needs Python 3.7 and aiohttp
+requires_aio = unittest.skipIf(aio is None or aio.aiohttp is None,
+                               'the asyncio engine cannot run here')
+
 
 def print_test(method):
     """
@@ -61,6 +94,73 @@ def mock_resource_with(filename, resource_type):
         return f.read()
 
 
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class LocalServer(object):
+    """Serves canned responses from a local HTTP/1.1 server so network
+    code can be tested without hitting the internet. `routes` maps a path
+    to a (status, headers, body) tuple or to a callable returning one,
+    which is called with the request handler. A '*' route answers the
+    paths which have no route of their own, e.g. the absolute urls a
+    stand-in proxy gets.
+    """
+    def __init__(self, routes):
+        self.routes = routes
+        self.connections = 0
+        self.requests = []
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                with server._lock:
+                    server.connections += 1
+                BaseHTTPRequestHandler.setup(self)
+
+            def do_HEAD(self):
+                self.do_GET(send_body=False)
+
+            def do_GET(self, send_body=True):
+                with server._lock:
+                    server.requests.append((self.path, dict(self.headers)))
+                route = server.routes.get(self.path,
+                                          server.routes.get('*'))
+                if route is None:
+                    route = (404, {}, b'not found')
+                elif callable(route):
+                    route = route(self)
+                status, headers, body = route
+                if isinstance(body, str):
+                    body = body.encode('utf-8')
+                self.send_response(status)
+                headers = dict(headers)
+                headers.setdefault('Content-Type', 'text/html; charset=utf-8')
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if send_body:
+                    self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d' % self.httpd.server_address[1]
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
 def get_base_domain(url):
     """
     For example, the base url of uk.reuters.com => reuters.com
@@ -444,6 +544,58 @@ class ContentExtractorTestCase(unittest.TestCase):
             'https://example.com/meta_link_rel_icon.ico'
         )
 
+    def test_meta_tags_harvest(self):
+        html = ('<html lang="en"><head>'
+                '<meta name="description" content=" First &amp; best ">'
+                '<meta name="description" content="Second">'
+                '<meta property="og:type" content="article">'
+                '<link rel="Shortcut ICON" href="/favicon.ico">'
+                '<link rel="canonical" href="http://example.com/a">'
+                '</head><body><meta name="late" content="body meta">'
+                '</body></html>')
+        doc = self.parser.fromstring(html)
+        meta_tags = self.extractor.get_meta_tags(doc)
+        self.assertEqual(4, len(meta_tags.metas))
+        self.assertEqual(2, len(meta_tags.links))
+        self.assertEqual('First & best',
+                         meta_tags.content('name', 'description'))
+        self.assertEqual('', meta_tags.content('name', 'keywords'))
+        self.assertEqual([meta_tags.links[0]], meta_tags.find_links('icon'))
+        self.assertEqual(meta_tags.metas[:2],
+                         meta_tags.find_metas('name', 'DESCRIPTION'))
+
+        # simple selectors are answered from the harvest, others by lxml
+        for selector in ('meta[name=description]',
+                         'meta[property="og:type"]',
+                         'head meta[name=description]',
+                         'meta[name=late]'):
+            expected = self.parser.css_select(doc, selector)
+            expected = expected[0].get('content').strip()
+            self.assertEqual(expected.replace('&amp;', '&'),
+                             self.extractor.get_meta_content(doc, selector))
+
+    def test_meta_tags_harvested_once_while_indexed(self):
+        doc = self.parser.fromstring('<html><head><meta name="a" content="b">'
+                                     '</head></html>')
+        self.assertIsNot(self.extractor.get_meta_tags(doc),
+                         self.extractor.get_meta_tags(doc))
+        with self.parser.indexed(doc):
+            self.assertIs(self.extractor.get_meta_tags(doc),
+                          self.extractor.get_meta_tags(doc))
+
+    def test_publishing_date_outside_meta_tags(self):
+        url = 'http://example.com/news/story.html'
+        html = ('<html><body><span property="article:published_time" '
+                'content="2019-05-20T10:00:00">May 20</span></body></html>')
+        for indexed in (False, True):
+            doc = self.parser.fromstring(html)
+            if indexed:
+                with self.parser.indexed(doc):
+                    date = self.extractor.get_publishing_date(url, doc)
+            else:
+                date = self.extractor.get_publishing_date(url, doc)
+            self.assertEqual(datetime.datetime(2019, 5, 20, 10), date)
+
 
 class SourceTestCase(unittest.TestCase):
     @print_test
@@ -604,6 +756,750 @@ class APITestCase(unittest.TestCase):
         newspaper.popular_urls()
 
 
+class DomainSchedulerTestCase(unittest.TestCase):
+    def slow_routes(self, paths, log):
+        lock = threading.Lock()
+        in_flight = defaultdict(int)
+
+        def respond(handler):
+            host = handler.headers['Host'].split(':')[0]
+            with lock:
+                in_flight[host] += 1
+                log.append((host, time.time(), in_flight[host]))
+            time.sleep(0.1)
+            with lock:
+                in_flight[host] -= 1
+            return 200, {}, '<html>%s</html>' % handler.path
+        return {path: respond for path in paths}
+
+    @print_test
+    def test_per_domain_cap_and_interleaving(self):
+        paths = ['/2019/01/01/a%d.html' % i for i in range(6)]
+        log = []
+        with LocalServer(self.slow_routes(paths, log)) as server:
+            port = server.url.rsplit(':', 1)[1]
+            source = Source('http://localhost:%s' % port)
+            source.articles = [Article(source.url + p) for p in paths]
+            lone_articles = [Article(server.url + p) for p in paths]
+            pool = NewsPool()
+            pool.set([source] + lone_articles, threads_per_source=2)
+            pool.join()
+
+        self.assertEqual(12, len(log))
+        self.assertEqual({'localhost', '127.0.0.1'}, {h for h, _, _ in log[:4]})
+        self.assertLessEqual(max(n for _, _, n in log), 2)
+        self.assertEqual(6, len(source.articles))
+        self.assertTrue(source.is_downloaded)
+        self.assertTrue(all(a.html for a in lone_articles))
+
+    @print_test
+    def test_domain_delay(self):
+        paths = ['/2019/01/01/a%d.html' % i for i in range(3)]
+        log = []
+        config = Configuration()
+        config.domain_delay = 0.2
+        with LocalServer(self.slow_routes(paths, log)) as server:
+            pool = NewsPool(config)
+            pool.set([Article(server.url + p) for p in paths],
+                     override_threads=3)
+            pool.join()
+        starts = sorted(t for _, t, _ in log)
+        self.assertGreaterEqual(starts[1] - starts[0], 0.15)
+        self.assertGreaterEqual(starts[2] - starts[1], 0.15)
+
+    @print_test
+    def test_limits_are_read_outside_the_lock(self):
+        def lock_is_held():
+            held = []
+
+            def probe():
+                acquired = scheduler.cond.acquire(blocking=False)
+                if acquired:
+                    scheduler.cond.release()
+                held.append(not acquired)
+            probe_thread = threading.Thread(target=probe)
+            probe_thread.start()
+            probe_thread.join()
+            return held[0]
+
+        calls = []
+
+        def limits(domain):
+            calls.append(lock_is_held())
+            return 1
+
+        scheduler = DomainScheduler(1, limits=limits)
+        tasks = [scheduler.add_task(domain, time.sleep, 0)
+                 for domain in ('a.com', 'b.com', 'a.com')]
+        scheduler.start()
+        scheduler.wait_completion()
+        self.assertTrue(all(task.done() for task in tasks))
+        self.assertEqual(6, len(calls))
+        self.assertFalse(any(calls))
+
+
+class AdaptiveTimeoutTestCase(unittest.TestCase):
+    def setUp(self):
+        self.original_latencies = network.host_latencies
+        network.host_latencies = network.HostLatencies()
+        self.config = Configuration()
+        self.config.adaptive_timeouts = True
+
+    def tearDown(self):
+        network.host_latencies = self.original_latencies
+
+    @print_test
+    def test_timeout_follows_the_percentile(self):
+        latencies = network.host_latencies
+        self.assertEqual(7, latencies.timeout('cnn.com', self.config))
+        for i in range(1, 101):
+            latencies.record('cnn.com', i / 100.0)
+        self.assertEqual(0.5, latencies.percentile('cnn.com', 50))
+        self.assertEqual(0.99, latencies.percentile('cnn.com', 99))
+        self.assertAlmostEqual(2.97, latencies.timeout('cnn.com', self.config))
+        self.config.timeout_factor = 100
+        self.assertEqual(7, latencies.timeout('cnn.com', self.config))
+        self.config.max_request_timeout = 30
+        self.assertEqual(30, latencies.timeout('cnn.com', self.config))
+        self.config.adaptive_timeouts = False
+        self.assertEqual(7, latencies.timeout('cnn.com', self.config))
+
+    @print_test
+    def test_window_is_rolling(self):
+        latencies = network.host_latencies
+        for _ in range(network.LATENCY_WINDOW):
+            latencies.record('cnn.com', 10)
+        for _ in range(network.LATENCY_WINDOW):
+            latencies.record('cnn.com', 0.01)
+        self.assertEqual(1, latencies.timeout('cnn.com', self.config))
+
+    @print_test
+    def test_hung_host_fails_fast(self):
+        def hang(handler):
+            time.sleep(1)
+            return 200, {}, 'late'
+
+        routes = {'/fast': (200, {}, 'fast'), '/hang': hang}
+        self.config.min_request_timeout = 0.2
+        with LocalServer(routes) as server:
+            for _ in range(network.MIN_TIMEOUT_SAMPLES):
+                network.fetch(server.url + '/fast', self.config)
+            started = time.time()
+            with self.assertRaises(requests.exceptions.Timeout):
+                network.fetch(server.url + '/hang', self.config)
+        self.assertLess(time.time() - started, 0.9)
+        stats = network.host_latencies.stats(self.config)
+        host = stats[get_domain(server.url)]
+        # the timeout is no latency sample and does not stretch the next one
+        self.assertEqual(network.MIN_TIMEOUT_SAMPLES, host['samples'])
+        self.assertEqual(1, host['timeouts'])
+        self.assertLess(host['p99'], 0.2)
+        self.assertEqual(0.2, host['timeout'])
+
+
+class AdaptiveConcurrencyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.original_limits = mthreading.host_limits
+        mthreading.host_limits = HostLimits(self.directory)
+        self.config = Configuration()
+        self.config.adaptive_concurrency = True
+        self.config.max_retries = 0
+
+    def tearDown(self):
+        mthreading.host_limits = self.original_limits
+
+    @print_test
+    def test_additive_increase(self):
+        limits = mthreading.host_limits
+        self.assertEqual(2, limits.limit('cnn.com', self.config))
+        for _ in range(10):
+            limits.record('cnn.com', self.config, 0.1, 200)
+        self.assertEqual(4, limits.limit('cnn.com', self.config))
+        self.config.max_host_concurrency = 3
+        limits.record('cnn.com', self.config, 0.1, 200)
+        self.assertEqual(3, limits.limit('cnn.com', self.config))
+
+    @print_test
+    def test_multiplicative_decrease(self):
+        limits = mthreading.host_limits
+        limits.hosts['cnn.com'] = mthreading.HostLimit(16, 0.1, 10)
+        limits.record('cnn.com', self.config, 0.1, 429)
+        self.assertEqual(8, limits.limit('cnn.com', self.config))
+        # one cut per average response time
+        limits.record('cnn.com', self.config, 0.1, 503)
+        self.assertEqual(8, limits.limit('cnn.com', self.config))
+        limits.hosts['cnn.com'].last_decrease = 0
+        limits.record('cnn.com', self.config, 1.0, 200)
+        self.assertEqual(4, limits.limit('cnn.com', self.config))
+        limits.hosts['cnn.com'].last_decrease = 0
+        limits.record('cnn.com', self.config)
+        self.assertEqual(2, limits.limit('cnn.com', self.config))
+
+    @print_test
+    def test_limits_persist_between_runs(self):
+        limits = mthreading.host_limits
+        limits.hosts['cnn.com'] = mthreading.HostLimit(7.5, 0.2, 10)
+        limits.dirty.add('cnn.com')
+        limits.save()
+        reloaded = HostLimits(self.directory)
+        self.assertEqual(7, reloaded.limit('cnn.com', self.config))
+        self.assertEqual(2, reloaded.limit('bbc.com', self.config))
+
+    @print_test
+    def test_requests_follow_the_limits(self):
+        lock = threading.Lock()
+        in_flight = [0, 0]
+
+        def respond(handler):
+            with lock:
+                in_flight[0] += 1
+                in_flight[1] = max(in_flight)
+            time.sleep(0.05)
+            with lock:
+                in_flight[0] -= 1
+            return (429 if handler.path == '/busy' else 200), {}, 'page'
+
+        paths = ['/%d' % i for i in range(6)] + ['/busy']
+        self.config.initial_host_concurrency = 1
+        self.config.max_host_concurrency = 2
+        with LocalServer({p: respond for p in paths}) as server:
+            list(network.iter_requests([server.url + p for p in paths],
+                                       self.config))
+        self.assertEqual(2, in_flight[1])
+        limit, latency, samples = HostLimits(self.directory).store.load(
+            get_domain(server.url))
+        self.assertLessEqual(limit, 2)
+        self.assertEqual(7, samples)
+
+
+class EncodingTestCase(unittest.TestCase):
+    @print_test
+    def test_declaration_order(self):
+        page = '<html><head><meta charset="koi8-r"></head>'.encode('koi8-r')
+        self.assertEqual('utf-8-sig', encoding.detect_encoding(
+            codecs.BOM_UTF8 + page, 'text/html; charset=iso-8859-2'))
+        self.assertEqual('iso8859-2', encoding.detect_encoding(
+            page, 'text/html; charset=ISO-8859-2'))
+        self.assertEqual('koi8-r', encoding.detect_encoding(page))
+        self.assertIsNone(encoding.detect_encoding(b'<html>plain</html>'))
+
+    @print_test
+    def test_prescan(self):
+        cases = [
+            (b'<meta http-equiv="Content-Type" '
+             b'content="text/html; charset=Shift_JIS">', 'cp932'),
+            (b'<META CONTENT="text/html; charset=gb2312" '
+             b'HTTP-EQUIV="content-type">', 'gb18030'),
+            (b'<meta content="text/html; charset=koi8-r">', None),
+            (b'<!-- <meta charset="koi8-r"> --><meta charset=utf-8>', 'utf-8'),
+            (b'<script data-x="<meta charset=koi8-r>"></script>', None),
+            (b'<meta charset="utf-16le">', 'utf-8'),
+            (b'<meta charset="base64"><meta charset="latin1">', 'cp1252'),
+        ]
+        for page, expected in cases:
+            self.assertEqual(expected, encoding.prescan(page), page)
+        late = b'<script>' + b' ' * 8000 + b'</script><meta charset="koi8-r">'
+        self.assertEqual('koi8-r', encoding.prescan(late))
+
+    @print_test
+    def test_decode_html(self):
+        html = '<html><p>caf\xe9 \u201cquoted\u201d</p></html>'
+        self.assertEqual((html, 'utf-8'),
+                         encoding.decode_html(html.encode('utf-8')))
+        self.assertEqual((html, 'cp1252'), encoding.decode_html(
+            html.encode('cp1252'), 'text/html; charset=ISO-8859-1'))
+        russian = ('<html><p>Москва — столица России, город '
+                   'федерального значения, административный '
+                   'центр Центрального федерального '
+                   'округа.</p></html>')
+        self.assertEqual((russian, 'cp1251'),
+                         encoding.decode_html(russian.encode('cp1251')))
+
+
+class BytesParsingTestCase(unittest.TestCase):
+    @print_test
+    def test_fromstring_bytes(self):
+        page = ('<html><head><title>Новости</title></head>'
+                '<body><p>Привет</p></body></html>')
+        parser = Configuration().get_parser()
+        doc = parser.fromstring(page.encode('cp1251'), 'cp1251')
+        self.assertEqual('Новости', doc.findtext('.//title'))
+        doc = parser.fromstring(codecs.BOM_UTF8 + page.encode('utf-8'),
+                                'utf-8-sig')
+        self.assertEqual('Привет', doc.findtext('.//p'))
+        doc = parser.fromstring(page.encode('euc_jp', 'replace'), 'euc_jp')
+        self.assertIsNotNone(doc)
+
+    @print_test
+    def test_article_keeps_bytes(self):
+        html = mock_resource_with('cnn_article', 'html')
+        config = Configuration()
+        config.keep_html_bytes = True
+        config.fetch_images = False
+        routes = {'/cnn.html': (200, {}, html)}
+        with LocalServer(routes) as server:
+            article = Article(server.url + '/cnn.html', config=config)
+            article.download()
+        self.assertEqual(html.encode('utf-8'), article.html_bytes)
+        self.assertEqual('utf-8', article.html_encoding)
+        article.parse()
+        self.assertIsNone(article._html)
+
+        decoded = Article(server.url + '/cnn.html', fetch_images=False)
+        decoded.download(input_html=html)
+        decoded.parse()
+        self.assertEqual(decoded.title, article.title)
+        self.assertEqual(decoded.text, article.text)
+        self.assertEqual(html, article.html)
+
+    @print_test
+    def test_source_keeps_bytes(self):
+        config = Configuration()
+        config.keep_html_bytes = True
+        config.memoize_articles = False
+        page = '<html><body><p>Привет</p></body></html>'
+        with LocalServer({'*': (200, {}, page)}) as server:
+            for threads in (1, 2):
+                source = Source(server.url, config=config)
+                source.articles = [
+                    Article(server.url + '/2019/01/0%d/story.html' % day,
+                            config=config) for day in (1, 2)]
+                source.download_articles(threads=threads)
+                self.assertEqual(2, len(source.articles))
+                for article in source.articles:
+                    self.assertEqual(page.encode('utf-8'),
+                                     article.html_bytes)
+                    self.assertIsNone(article._html)
+
+
+class CleanDocTestCase(unittest.TestCase):
+    @print_test
+    def test_clean_doc_is_built_on_demand(self):
+        html = mock_resource_with('cnn_article', 'html')
+        article = Article('http://www.cnn.com/2013/11/27/travel/'
+                          'weather-thanksgiving/index.html',
+                          fetch_images=False)
+        article.download(input_html=html)
+        article.parse()
+        self.assertIsNone(article._clean_doc)
+        self.assertTrue(article.is_valid_body())
+        self.assertIsNone(article._clean_doc)
+
+        clean_doc = article.clean_doc
+        self.assertIs(clean_doc, article.clean_doc)
+        self.assertIsNot(clean_doc, article.doc)
+        # the cleaner strips scripts from `doc` only
+        self.assertTrue(clean_doc.xpath('//script'))
+        self.assertFalse(article.doc.xpath('//script'))
+        self.assertEqual(
+            article.meta_data,
+            article.extractor.get_meta_data(article.clean_doc))
+
+    @print_test
+    def test_unparsed_article_has_no_clean_doc(self):
+        article = Article('http://www.cnn.com/')
+        article.download(input_html='<html><body>text</body></html>')
+        self.assertIsNone(article.clean_doc)
+
+
+class DocIndexTestCase(unittest.TestCase):
+    QUERIES = [
+        {'tag': 'title'}, {'tag': 'img'}, {},
+        {'attr': 'name', 'value': 'AUTHOR'},
+        {'attr': 'class', 'value': 'byline'},
+        {'tag': 'link', 'attr': 'rel', 'value': 'icon'},
+        {'tag': 'meta', 'attr': 'property', 'value': 'og:'},
+        {'tag': 'link', 'attr': 'rel', 'value': 'img_src|image_src',
+         'use_regex': True},
+    ]
+    SELECTORS = ['meta', 'meta[name=description]',
+                 'meta[property="og:type"]', 'a[rel=tag]']
+
+    def setUp(self):
+        self.doc = Parser.fromstring(mock_resource_with('cnn_article', 'html'))
+
+    @print_test
+    def test_index_matches_xpath(self):
+        for query in self.QUERIES:
+            expected = Parser.getElementsByTag(self.doc, **query)
+            with Parser.indexed(self.doc):
+                self.assertIsNotNone(Parser.get_index(self.doc))
+                self.assertEqual(expected,
+                                 Parser.getElementsByTag(self.doc, **query))
+        for selector in self.SELECTORS:
+            expected = Parser.css_select(self.doc, selector)
+            with Parser.indexed(self.doc):
+                self.assertEqual(expected,
+                                 Parser.css_select(self.doc, selector))
+
+    @print_test
+    def test_index_is_scoped_to_the_block(self):
+        with Parser.indexed(self.doc):
+            with Parser.indexed(self.doc):
+                pass
+            self.assertIsNotNone(Parser.get_index(self.doc))
+            # subtrees are still queried with XPath
+            body = Parser.getElementsByTag(self.doc, tag='body')[0]
+            self.assertIsNone(Parser.get_index(body))
+        self.assertIsNone(Parser.get_index(self.doc))
+
+        Parser.remove(Parser.getElementsByTag(self.doc, tag='title')[0])
+        self.assertEqual([], Parser.getElementsByTag(self.doc, tag='title'))
+
+    @print_test
+    def test_queries_left_to_xpath(self):
+        index = DocIndex(self.doc)
+        self.assertIsNone(index.find(attr='rel', value='x|', use_regex=True))
+        self.assertIsNone(index.select('div p'))
+        self.assertIsNone(index.select('a[href*="/tag/"]'))
+
+
+class SelectorCacheTestCase(unittest.TestCase):
+    @print_test
+    def test_compiled_once_and_bounded(self):
+        cache = SelectorCache(maxsize=2)
+        xpath = cache.xpath('//p')
+        self.assertIs(xpath, cache.xpath('//p'))
+        self.assertIsNot(xpath, cache.xpath('//p', {'re': 'urn:re'}))
+        self.assertIs(cache.css('p'), cache.css('p'))
+        # //p was the least recently used
+        self.assertIsNot(xpath, cache.xpath('//p'))
+
+        cache = SelectorCache(maxsize=0)
+        self.assertIsNot(cache.xpath('//p'), cache.xpath('//p'))
+
+    @print_test
+    def test_one_cache_per_thread(self):
+        cache = SelectorCache()
+        xpath = cache.xpath('//p')
+        with concurrent.futures.ThreadPoolExecutor(1) as pool:
+            other = pool.submit(cache.xpath, '//p').result()
+        self.assertIsNot(xpath, other)
+
+    @print_test
+    def test_same_results_as_lxml(self):
+        doc = Parser.fromstring(mock_resource_with('cnn_article', 'html'))
+        self.assertEqual(doc.xpath('//p[@class]'),
+                         Parser.xpath(doc, '//p[@class]'))
+        self.assertEqual(doc.cssselect('div p'),
+                         Parser.css_select(doc, 'div p'))
+        expression = '//*[re:test(@id, "foot", "i")]'
+        self.assertEqual(
+            doc.xpath(expression, namespaces=parsers.EXSLT_NAMESPACES),
+            Parser.xpath_re(doc, expression))
+
+
+class IncrementalParseTestCase(unittest.TestCase):
+    PAGE = ('<!DOCTYPE html><html><head><title>Новости</title></head>'
+            '<body>%s</body></html>' % ('<p>Привет</p>' * 5000))
+
+    def feed(self, data, content_type=None, size=1000):
+        parser = IncrementalParser(content_type)
+        for i in range(0, len(data), size):
+            parser.feed(data[i:i + size])
+        return parser.close()
+
+    @print_test
+    def test_tree_matches_fromstring(self):
+        for charset, content_type in (
+                ('utf-8', None), ('cp1251', 'text/html; charset=cp1251'),
+                ('utf-8', 'text/html; charset=utf-8')):
+            data = self.PAGE.encode(charset)
+            doc = self.feed(data, content_type)
+            expected = Configuration().get_parser().fromstring(
+                data, charset)
+            self.assertEqual(lxml.html.tostring(expected),
+                             lxml.html.tostring(doc))
+            self.assertEqual('Новости', doc.findtext('.//title'))
+
+    @print_test
+    def test_falls_back_to_a_regular_parse(self):
+        # undeclared and not utf-8
+        self.assertIsNone(self.feed(self.PAGE.encode('cp1251')))
+        # fragments are handled by lxml.html.fromstring
+        self.assertIsNone(self.feed(b'<p>just a paragraph</p>'))
+        self.assertIsNone(self.feed(b''))
+
+    @print_test
+    def test_article_is_parsed_while_downloading(self):
+        html = mock_resource_with('cnn_article', 'html')
+        config = Configuration()
+        config.parse_while_downloading = True
+        config.fetch_images = False
+        routes = {'/cnn.html': (200, {}, html),
+                  '/feed.xml': (200, {'Content-Type': 'application/rss+xml'},
+                                '<rss></rss>')}
+        with LocalServer(routes) as server:
+            article = Article(server.url + '/cnn.html', config=config)
+            article.download()
+            feed = network.fetch(server.url + '/feed.xml', config)[1]
+        self.assertIsNone(feed.doc)
+        streamed_doc = article._streamed_doc
+        self.assertIsNotNone(streamed_doc)
+        article.parse()
+        self.assertIs(streamed_doc, article.doc)
+
+        regular = Article(server.url + '/cnn.html', fetch_images=False)
+        regular.download(input_html=html)
+        regular.parse()
+        self.assertEqual(regular.title, article.title)
+        self.assertEqual(regular.text, article.text)
+
+        article.html = html
+        self.assertIsNone(article._streamed_doc)
+
+    @print_test
+    def test_source_reuses_the_streamed_trees(self):
+        config = Configuration()
+        config.parse_while_downloading = True
+        config.memoize_articles = False
+        page = ('<html><body><a href="/2019/01/01/story.html">x</a>'
+                '</body></html>')
+        with LocalServer({'*': (200, {}, page)}) as server:
+            plain = network.fetch(server.url + '/plain', config)[1]
+            source = Source(server.url, config=config)
+            source.categories = [Category(server.url + '/world'),
+                                 Category(server.url + '/world')]
+            source.download_categories()
+            url = server.url + '/2019/01/01/story.html'
+            source.articles = [Article(url, config=config),
+                               Article(url, config=config)]
+            source.download_articles(threads=2)
+        # only the callers which use the tree build one
+        self.assertIsNone(plain.doc)
+        first, second = source.categories
+        self.assertEqual('x', first.doc.findtext('.//a'))
+        self.assertIsNot(first.doc, second.doc)
+        self.assertIsNotNone(source.articles[0]._streamed_doc)
+        self.assertIsNone(source.articles[1]._streamed_doc)
+        self.assertEqual(page, source.articles[1].html)
+
+
+class AmpTestCase(unittest.TestCase):
+    ORIGINAL = ('<html lang="en"><head><title>Original title</title>'
+                '<link rel="canonical" href="/original-story">'
+                '<meta name="description" content="From the original">'
+                '<link rel="amphtml" href="/story/amp"></head>'
+                '<body>%s</body></html>' % ('<p>Heavy markup</p>' * 20000))
+    AMP = ('<html><head><title>Original title</title></head><body>'
+           '<article><p>%s</p></article></body></html>' %
+           ' '.join(['The lighter amp page holds the text.'] * 20))
+
+    def setUp(self):
+        self.original_known = amp.known
+        amp.known = redirects.RedirectMap(tempfile.mkdtemp())
+        self.config = Configuration()
+        self.config.prefer_amp = True
+        self.config.fetch_images = False
+        self.routes = {'/story': (200, {}, self.ORIGINAL),
+                       '/story/amp': (200, {}, self.AMP),
+                       '/plain': (200, {}, self.AMP)}
+
+    def tearDown(self):
+        amp.known = self.original_known
+
+    def paths(self, server):
+        return [path for path, _ in server.requests]
+
+    @print_test
+    def test_find_amp_url(self):
+        base = 'http://example.com/news/story'
+        self.assertEqual(
+            'http://example.com/news/story.amp',
+            amp.find_amp_url(b'<link rel="amphtml" href="story.amp">', base))
+        self.assertEqual(
+            'http://amp.example.com/a?b=1&c=2',
+            amp.find_amp_url(b"<LINK href='http://amp.example.com/a?b=1"
+                             b"&amp;c=2' REL='amphtml'>", base))
+        self.assertIsNone(amp.find_amp_url(
+            b'<link rel="canonical" href="/original-story">', base))
+
+    @print_test
+    def test_head_scanner_across_chunks(self):
+        data = self.ORIGINAL.encode('utf-8')
+        end = data.index(b'</head>')
+        scanner = amp.HeadScanner('http://example.com/story')
+        self.assertFalse(scanner.add(data[:end - 30]))
+        self.assertFalse(scanner.add(data[end - 30:end + 3]))
+        self.assertTrue(scanner.add(data[end + 3:end + 200]))
+        self.assertEqual('http://example.com/story/amp', scanner.amp_url)
+        self.assertFalse(scanner.add(data[end + 200:]))
+
+    @print_test
+    def test_text_comes_from_the_amp_page(self):
+        with LocalServer(self.routes) as server:
+            html, response = network.fetch(server.url + '/story',
+                                           self.config, stop_at_amp=True)
+            article = Article(server.url + '/story', config=self.config)
+            article.download()
+        self.assertTrue(response.truncated)
+        self.assertLess(len(response.content), len(self.ORIGINAL) / 2)
+        self.assertEqual(server.url + '/story/amp', response.amp_url)
+
+        self.assertEqual(server.url + '/story/amp', article.amp_url)
+        self.assertEqual(self.AMP, article.html)
+        article.parse()
+        self.assertIn('lighter amp page', article.text)
+        self.assertEqual('Original title', article.title)
+        self.assertEqual('From the original', article.meta_description)
+        self.assertTrue(article.canonical_link.endswith('/original-story'))
+
+    @print_test
+    @requires_aio
+    def test_known_amp_url_is_used_directly(self):
+        with LocalServer(self.routes) as server:
+            Article(server.url + '/story', config=self.config).download()
+            article = Article(server.url + '/story', config=self.config)
+            asyncio.run(article.adownload())
+        self.assertEqual(['/story', '/story/amp', '/story/amp'],
+                         self.paths(server))
+        self.assertEqual(self.AMP, article.html)
+        self.assertEqual(server.url + '/story/amp', article.amp_url)
+
+    @print_test
+    def test_falls_back_to_the_original(self):
+        del self.routes['/story/amp']
+        with LocalServer(self.routes) as server:
+            article = Article(server.url + '/story', config=self.config)
+            article.download()
+            plain = Article(server.url + '/plain', config=self.config)
+            plain.download()
+        self.assertEqual(self.ORIGINAL, article.html)
+        self.assertIsNone(article.amp_url)
+        self.assertIsNone(article.canonical_head)
+        self.assertIsNone(amp.known_amp_url(server.url + '/story'))
+        self.assertEqual(self.AMP, plain.html)
+        self.assertIsNone(plain.amp_url)
+
+    @print_test
+    def test_source_downloads_the_amp_pages(self):
+        self.config.memoize_articles = False
+        self.routes['/gone'] = (
+            200, {}, self.ORIGINAL.replace('/story/amp', '/gone/amp'))
+        with LocalServer(self.routes) as server:
+            # the last run uses the AMP urls learnt by the one before
+            for threads, learn in ((1, True), (3, True), (3, False)):
+                if learn:
+                    amp.known = redirects.RedirectMap(tempfile.mkdtemp())
+                source = Source(server.url, config=self.config)
+                source.articles = [
+                    Article(server.url + path, config=self.config)
+                    for path in ('/story', '/plain', '/gone')]
+                source.download_articles(threads=threads)
+                story, plain, gone = source.articles
+                self.assertEqual(self.AMP, story.html)
+                self.assertEqual(server.url + '/story/amp', story.amp_url)
+                self.assertEqual(self.AMP, plain.html)
+                self.assertIsNone(plain.amp_url)
+                self.assertIn('/gone/amp', gone.html)
+                self.assertIsNone(gone.amp_url)
+                self.assertIsNone(gone.canonical_head)
+                if learn:
+                    self.assertIn('Original title', story.canonical_head)
+        self.assertEqual(2, self.paths(server).count('/story'))
+        self.assertEqual(3, self.paths(server).count('/story/amp'))
+
+    @print_test
+    def test_cached_responses_keep_the_amp_url(self):
+        original_cache = network.response_cache
+        tmp_dir = tempfile.TemporaryDirectory()
+        network.response_cache = ResponseCache(tmp_dir.name)
+        self.config.use_response_cache = True
+        try:
+            with LocalServer(self.routes) as server:
+                articles = [Article(server.url + '/plain', config=self.config)
+                            for _ in range(2)]
+                for article in articles:
+                    article.download()
+                _, response = network.fetch(server.url + '/plain',
+                                            self.config, stop_at_amp=True)
+                network.fetch(server.url + '/plain', self.config)
+        finally:
+            network.response_cache = original_cache
+            tmp_dir.cleanup()
+        # the AMP scan and the plain download are cached apart
+        self.assertEqual(['/plain', '/plain'], self.paths(server))
+        self.assertIsNone(response.amp_url)
+        self.assertEqual([self.AMP, self.AMP], [a.html for a in articles])
+
+
+class ExecutorTestCase(unittest.TestCase):
+    @print_test
+    def test_futures_hold_results_and_exceptions(self):
+        ok = executor.submit(sum, [1, 2, 3])
+        failed = executor.submit(int, 'not a number')
+        self.assertEqual(6, ok.result(timeout=5))
+        self.assertIsInstance(failed.exception(timeout=5), ValueError)
+
+    @print_test
+    def test_pool_grows_with_queued_tasks(self):
+        pool = Executor(max_workers=4)
+        barrier = threading.Barrier(4, timeout=5)
+        waiting = [pool.submit(barrier.wait) for _ in range(4)]
+        self.assertEqual([0, 1, 2, 3],
+                         sorted(f.result(timeout=5) for f in waiting))
+        self.assertEqual(4, len(pool.workers))
+
+    @print_test
+    def test_reserve_counts_queued_tasks(self):
+        pool = Executor(max_workers=2)
+        release = threading.Event()
+        blocked = [pool.submit(release.wait, 5) for _ in range(3)]
+        self.assertEqual(2, len(pool.workers))
+        pool.reserve(1)
+        self.assertEqual(4, len(pool.workers))
+        release.set()
+        self.assertTrue(all(f.result(timeout=5) for f in blocked))
+
+    @print_test
+    def test_reserved_workers_retire_when_idle(self):
+        pool = Executor(max_workers=2, idle_timeout=0.05)
+        pool.reserve(6)
+        started = list(pool.workers)
+        self.assertEqual(6, len(started))
+        self.assertEqual(6, sum(f.result(timeout=5) for f in
+                                [pool.submit(len, 'x') for _ in range(6)]))
+        deadline = time.time() + 5
+        while len(pool.workers) > 2 and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(2, len(pool.workers))
+        for worker in started:
+            if worker not in pool.workers:
+                worker.join(timeout=5)
+                self.assertFalse(worker.is_alive())
+        self.assertEqual(4, pool.submit(len, 'four').result(timeout=5))
+
+    @print_test
+    def test_threads_are_reused_between_runs(self):
+        names = set()
+        for _ in range(3):
+            scheduler = DomainScheduler(4, per_domain=4)
+            futures = [scheduler.add_task(
+                'example.com', lambda: threading.current_thread().name)
+                for _ in range(8)]
+            scheduler.start()
+            scheduler.wait_completion()
+            names.update(f.result() for f in futures)
+        self.assertTrue(all(n.startswith('newspaper-') for n in names))
+        self.assertLessEqual(len(names), len(executor.workers))
+        self.assertTrue(all(w.is_alive() for w in executor.workers))
+
+    @print_test
+    def test_cancel_pending_tasks(self):
+        scheduler = DomainScheduler(1)
+        release = threading.Event()
+        running = scheduler.add_task('a.com', release.wait, 5)
+        pending = scheduler.add_task('a.com', time.sleep, 0)
+        scheduler.start()
+        time.sleep(0.1)
+        scheduler.cancel()
+        release.set()
+        scheduler.wait_completion()
+        self.assertTrue(running.result())
+        self.assertTrue(pending.cancelled())
+
+
 @unittest.skip("Need to mock download")
 class MThreadingTestCase(unittest.TestCase):
     @print_test
@@ -630,6 +1526,941 @@ class MThreadingTestCase(unittest.TestCase):
               len(tc_paper.articles[1].html))
 
 
+class SessionTestCase(unittest.TestCase):
+    @print_test
+    def test_connections_are_reused(self):
+        routes = {'/%d' % i: (200, {}, '<html>%d</html>' % i)
+                  for i in range(5)}
+        config = Configuration()
+        with LocalServer(routes) as server:
+            for path in routes:
+                html = network.get_html(server.url + path, config)
+                self.assertEqual(routes[path][2], html)
+            network.multithread_request(
+                [server.url + path for path in routes], config)
+            network.close_session(config)
+        self.assertLess(server.connections, 2 * len(routes))
+
+    @print_test
+    def test_cookies_are_not_shared_between_requests(self):
+        routes = {'/set': (200, {'Set-Cookie': 'meter=1; Path=/'}, 'set'),
+                  '/get': lambda handler: (
+                      200, {}, handler.headers.get('Cookie') or '')}
+        config = Configuration()
+        with LocalServer(routes) as server:
+            network.get_html(server.url + '/set', config)
+            self.assertEqual('', network.get_html(server.url + '/get', config))
+            network.close_session(config)
+
+    @print_test
+    def test_standalone_articles_share_connections(self):
+        routes = {'/%d' % i: (200, {}, '<html>%d</html>' % i)
+                  for i in range(50)}
+        with LocalServer(routes) as server:
+            for path in routes:
+                article = Article(server.url + path)
+                article.download()
+                self.assertEqual(routes[path][2], article.html)
+            network.close_session(Configuration())
+        self.assertEqual(1, server.connections)
+
+
+class ConditionalGetTestCase(unittest.TestCase):
+    def revalidating_route(self, body, etag=None, last_modified=None):
+        def respond(handler):
+            if etag and handler.headers.get('If-None-Match') == etag:
+                return 304, {}, b''
+            if last_modified and \
+                    handler.headers.get('If-Modified-Since') == last_modified:
+                return 304, {}, b''
+            headers = {}
+            if etag:
+                headers['ETag'] = etag
+            if last_modified:
+                headers['Last-Modified'] = last_modified
+            return 200, headers, body
+        return respond
+
+    @print_test
+    def test_etag_revalidation(self):
+        routes = {'/world': self.revalidating_route('<html>world</html>',
+                                                    etag='"v1"')}
+        with LocalServer(routes) as server:
+            url = server.url + '/world'
+            first = network.get_html(url, revalidate=True)
+            second = network.get_html(url, revalidate=True)
+            reqs = network.multithread_request([url], revalidate=True)
+        self.assertEqual('<html>world</html>', first)
+        self.assertEqual('<html>world</html>', second)
+        self.assertEqual(200, reqs[0].resp.status_code)
+        self.assertEqual('<html>world</html>', reqs[0].resp.text)
+        sent = [headers.get('If-None-Match') for _, headers in server.requests]
+        self.assertEqual([None, '"v1"', '"v1"'], sent)
+
+    @print_test
+    def test_last_modified_revalidation(self):
+        stamp = 'Wed, 21 Oct 2015 07:28:00 GMT'
+        routes = {'/feed': self.revalidating_route(
+            '<rss>items</rss>', last_modified=stamp)}
+        with LocalServer(routes) as server:
+            url = server.url + '/feed'
+            network.get_html(url, revalidate=True)
+            self.assertEqual('<rss>items</rss>',
+                             network.get_html(url, revalidate=True))
+            network.get_html(url)
+        sent = [headers.get('If-Modified-Since')
+                for _, headers in server.requests]
+        self.assertEqual([None, stamp, None], sent)
+
+
+class ResponseCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache = ResponseCache(self.tmp_dir.name)
+        self.global_cache = network.response_cache
+        network.response_cache = self.cache
+        self.config = Configuration()
+        self.config.use_response_cache = True
+
+    def tearDown(self):
+        network.response_cache = self.global_cache
+        self.tmp_dir.cleanup()
+
+    @print_test
+    def test_cache_hits(self):
+        routes = {'/a': (200, {}, '<html>a</html>')}
+        with LocalServer(routes) as server:
+            url = server.url + '/a'
+            self.assertEqual('<html>a</html>',
+                             network.get_html(url, self.config))
+            self.assertEqual('<html>a</html>',
+                             network.get_html(url + '#comments', self.config))
+            reqs = network.multithread_request([url], self.config)
+        self.assertEqual('<html>a</html>', reqs[0].resp.text)
+        self.assertEqual(1, len(server.requests))
+        self.assertEqual({'hits': 2, 'misses': 1, 'evictions': 0},
+                         self.cache.stats())
+
+    @print_test
+    def test_ttl_per_content_type(self):
+        self.config.response_cache_ttls = {'text/html': 0}
+        routes = {'/a': (200, {}, '<html>a</html>'),
+                  '/rss': (200, {'Content-Type': 'application/rss+xml'},
+                           '<rss></rss>')}
+        with LocalServer(routes) as server:
+            for _ in range(2):
+                network.get_html(server.url + '/a', self.config)
+                network.get_html(server.url + '/rss', self.config)
+        self.assertEqual(['/a', '/rss', '/a'],
+                         [path for path, _ in server.requests])
+
+    @print_test
+    def test_lru_eviction(self):
+        def response(url):
+            return StoredResponse(url, 200, {'Content-Type': 'text/html'},
+                                  b'x' * 10000, 'utf-8').to_response()
+
+        for url in ['http://a.com/', 'http://b.com/']:
+            self.cache.set(url, {}, response(url), 25000)
+        self.assertIsNotNone(self.cache.get('http://a.com/', {}, {}, 60))
+        self.cache.set('http://c.com/', {}, response('http://c.com/'), 25000)
+
+        self.assertIsNone(self.cache.get('http://b.com/', {}, {}, 60))
+        self.assertIsNotNone(self.cache.get('http://a.com/', {}, {}, 60))
+        self.assertIsNotNone(self.cache.get('http://c.com/', {}, {}, 60))
+        self.assertEqual(1, self.cache.evictions)
+
+
+class RetryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.config = Configuration()
+        self.config.retry_backoff = 0.01
+        network.breaker.reset()
+
+    def tearDown(self):
+        network.breaker.reset()
+
+    def flaky_route(self, failures, headers=None):
+        calls = []
+
+        def respond(handler):
+            calls.append(handler.path)
+            if len(calls) <= failures:
+                return 503, headers or {}, 'busy'
+            return 200, {}, '<html>ok</html>'
+        return respond
+
+    @print_test
+    def test_retry_until_success(self):
+        routes = {'/a': self.flaky_route(2, {'Retry-After': '0'}),
+                  '/b': self.flaky_route(5)}
+        # both urls fail on the same host, keep its breaker out of the way
+        self.config.breaker_threshold = 0
+        with LocalServer(routes) as server:
+            reqs = network.multithread_request(
+                [server.url + '/a', server.url + '/b'], self.config)
+        self.assertEqual(200, reqs[0].resp.status_code)
+        self.assertEqual(3, reqs[0].attempts)
+        self.assertEqual(503, reqs[1].resp.status_code)
+        self.assertEqual(self.config.max_retries + 1, reqs[1].attempts)
+
+    @print_test
+    def test_retry_after(self):
+        response = requests.Response()
+        response.headers['Retry-After'] = '120'
+        self.assertEqual(120, network._retry_after(response))
+        self.assertEqual(30, network._backoff(1, self.config, 120))
+        response.headers['Retry-After'] = 'Wed, 21 Oct 2015 07:28:00 GMT'
+        self.assertEqual(0, network._retry_after(response))
+        self.assertLessEqual(network._backoff(3, self.config),
+                             self.config.retry_backoff * 4)
+
+    @print_test
+    def test_breaker_skips_failing_host(self):
+        self.config.max_retries = 0
+        self.config.breaker_threshold = 2
+        self.config.number_threads = 1
+        routes = {'/down': (503, {}, 'busy')}
+        with LocalServer(routes) as server:
+            urls = [server.url + '/down?page=%d' % i for i in range(5)]
+            routes.update({'/down?page=%d' % i: routes['/down']
+                           for i in range(5)})
+            reqs = network.multithread_request(urls, self.config)
+            self.assertEqual(2, len(server.requests))
+        self.assertEqual([1, 1, 0, 0, 0], [req.attempts for req in reqs])
+
+    @print_test
+    def test_breaker_lets_one_trial_through(self):
+        breaker = network.CircuitBreaker()
+        cooldown = 0.2
+        for _ in range(2):
+            breaker.record('a.com', False, 2)
+        self.assertTrue(breaker.is_open('a.com', cooldown))
+        time.sleep(cooldown)
+        # half-open, only the first request is let through
+        self.assertFalse(breaker.is_open('a.com', cooldown))
+        self.assertTrue(breaker.is_open('a.com', cooldown))
+        # the failed trial opens the breaker for another cooldown
+        breaker.record('a.com', False, 10)
+        self.assertTrue(breaker.is_open('a.com', cooldown))
+        time.sleep(cooldown)
+        self.assertFalse(breaker.is_open('a.com', cooldown))
+        breaker.record('a.com', True, 2)
+        self.assertFalse(breaker.is_open('a.com', cooldown))
+        self.assertFalse(breaker.is_open('a.com', cooldown))
+        self.assertFalse(breaker.trials)
+
+
+class IterRequestsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.peak = 0
+
+    def tracked_route(self, delay):
+        def respond(handler):
+            with self.lock:
+                self.in_flight += 1
+                self.peak = max(self.peak, self.in_flight)
+            time.sleep(delay)
+            with self.lock:
+                self.in_flight -= 1
+            return 200, {}, '<html>%s</html>' % handler.path
+        return respond
+
+    @print_test
+    def test_completion_order_and_errors(self):
+        routes = {'/slow': self.tracked_route(0.5),
+                  '/fast': self.tracked_route(0)}
+        with LocalServer(routes) as server:
+            results = list(network.iter_requests(
+                [server.url + p for p in ('/slow', '/fast', '/missing')]))
+        urls = [url.rsplit('/', 1)[1] for url, _ in results]
+        self.assertEqual('slow', urls[-1])
+        self.assertEqual({'slow', 'fast', 'missing'}, set(urls))
+        outcomes = dict(zip(urls, [r for _, r in results]))
+        self.assertEqual('<html>/fast</html>', outcomes['fast'].text)
+        self.assertIsInstance(outcomes['missing'],
+                              requests.exceptions.HTTPError)
+
+    @print_test
+    def test_every_failure_is_reported(self):
+        def broken(url, *args, **kwargs):
+            raise ValueError('broken page')
+
+        original_send = network._send
+        network._send = broken
+        try:
+            results = dict(network.iter_requests(
+                ['http://example.com/page', 'http://[broken/']))
+        finally:
+            network._send = original_send
+        self.assertIsInstance(results['http://example.com/page'], ValueError)
+        self.assertIsInstance(results['http://[broken/'], ValueError)
+
+    @print_test
+    def test_window_bounds_in_flight_requests(self):
+        paths = ['/%d' % i for i in range(8)]
+        routes = {p: self.tracked_route(0.05) for p in paths}
+        with LocalServer(routes) as server:
+            results = list(network.iter_requests(
+                [server.url + p for p in paths], window=2))
+        self.assertEqual(8, len(results))
+        self.assertLessEqual(self.peak, 2)
+
+    @print_test
+    def test_source_downloads_consume_iterator(self):
+        routes = {'/world': (200, {}, '<html><a>world</a></html>'),
+                  '/sports': (404, {}, 'gone')}
+        with LocalServer(routes) as server:
+            source = Source(server.url, memoize_articles=False)
+            source.categories = [Category(server.url + '/world'),
+                                 Category(server.url + '/sports')]
+            source.download_categories()
+        self.assertEqual([server.url + '/world'],
+                         [c.url for c in source.categories])
+        self.assertIsNotNone(source.categories[0].doc)
+
+
+class SingleFlightTestCase(unittest.TestCase):
+    def setUp(self):
+        self.single_flight = network.single_flight
+        network.single_flight = network.SingleFlight()
+
+    def tearDown(self):
+        network.single_flight = self.single_flight
+
+    def slow_route(self, status=200):
+        def respond(handler):
+            time.sleep(0.3)
+            return status, {}, '<html>%s</html>' % handler.path
+        return respond
+
+    def fetch_together(self, url, n=4):
+        def fetch():
+            try:
+                return network.fetch(url)[1]
+            except requests.exceptions.RequestException as e:
+                return e
+        pool = concurrent.futures.ThreadPoolExecutor(n)
+        try:
+            return list(pool.map(lambda _: fetch(), range(n)))
+        finally:
+            pool.shutdown()
+
+    @print_test
+    def test_identical_requests_are_coalesced(self):
+        with LocalServer({'/page': self.slow_route()}) as server:
+            responses = self.fetch_together(server.url + '/page')
+        self.assertEqual(1, len(server.requests))
+        self.assertEqual(4, len({id(r) for r in responses}))
+        self.assertEqual({'<html>/page</html>'}, {r.text for r in responses})
+        self.assertEqual({'sent': 1, 'avoided': 3},
+                         network.single_flight.stats())
+
+    @print_test
+    def test_error_is_shared(self):
+        with LocalServer({'/gone': self.slow_route(404)}) as server:
+            errors = self.fetch_together(server.url + '/gone', n=3)
+        self.assertEqual(1, len(server.requests))
+        for error in errors:
+            self.assertIsInstance(error, requests.exceptions.HTTPError)
+        self.assertFalse(network.single_flight.calls)
+
+    @print_test
+    def test_later_requests_are_sent_again(self):
+        with LocalServer({'/page': (200, {}, '<html>page</html>')}) as server:
+            network.fetch(server.url + '/page')
+            network.fetch(server.url + '/page')
+        self.assertEqual(2, len(server.requests))
+        self.assertEqual(0, network.single_flight.avoided)
+
+    @requires_aio
+    @print_test
+    def test_async_requests_are_coalesced(self):
+        async def fetch_all(url):
+            return await asyncio.gather(
+                *[aio.afetch(url) for _ in range(3)])
+
+        with LocalServer({'/page': self.slow_route()}) as server:
+            results = asyncio.run(fetch_all(server.url + '/page'))
+        self.assertEqual(1, len(server.requests))
+        self.assertEqual(['<html>/page</html>'] * 3,
+                         [html for html, _ in results])
+        self.assertEqual(2, network.single_flight.avoided)
+
+    @print_test
+    def test_differently_configured_requests_are_not_shared(self):
+        small = Configuration()
+        small.max_html_bytes = 10
+
+        def fetch(config):
+            return network.fetch(server.url + '/page', config)[1]
+
+        with LocalServer({'/page': self.slow_route()}) as server:
+            pool = concurrent.futures.ThreadPoolExecutor(2)
+            try:
+                full, cut = pool.map(fetch, [Configuration(), small])
+            finally:
+                pool.shutdown()
+        self.assertEqual(2, len(server.requests))
+        self.assertFalse(full.truncated)
+        self.assertTrue(cut.truncated)
+        self.assertEqual(0, network.single_flight.avoided)
+
+    @requires_aio
+    @print_test
+    def test_waiters_outlive_a_cancelled_leader(self):
+        async def fetch_after_cancel(url):
+            leader = asyncio.ensure_future(aio.afetch(url))
+            await asyncio.sleep(0.05)
+            waiter = asyncio.ensure_future(aio.afetch(url))
+            await asyncio.sleep(0.05)
+            leader.cancel()
+            return await waiter
+
+        with LocalServer({'/page': self.slow_route()}) as server:
+            html, _ = asyncio.run(fetch_after_cancel(server.url + '/page'))
+        self.assertEqual('<html>/page</html>', html)
+        self.assertEqual(2, network.single_flight.sent)
+        self.assertFalse(network.single_flight.calls)
+
+
+class DNSCacheTestCase(unittest.TestCase):
+    ROUTES = {'/': (200, {}, '<html>home</html>')}
+
+    def setUp(self):
+        self.original_cache = network.dns_cache
+        network.dns_cache = network.DNSCache()
+        self.config = Configuration()
+        self.config.keep_alive = False
+
+    def tearDown(self):
+        network.dns_cache = self.original_cache
+        network.close_session(self.config)
+
+    @print_test
+    def test_hosts_are_resolved_once(self):
+        with LocalServer(self.ROUTES) as server:
+            url = server.url.replace('127.0.0.1', 'localhost') + '/'
+            for _ in range(3):
+                network.fetch(url, self.config)
+        self.assertEqual(3, server.connections)
+        self.assertEqual(1, network.dns_cache.misses)
+        self.assertEqual(2, network.dns_cache.hits)
+
+    @print_test
+    def test_addresses_are_not_resolved(self):
+        self.assertEqual(['127.0.0.1'],
+                         network.dns_cache.resolve('127.0.0.1', 80, 60))
+        self.assertEqual(['::1'], network.dns_cache.resolve('[::1]', 80, 60))
+        self.assertEqual(0, network.dns_cache.misses)
+
+    @print_test
+    def test_cache_can_be_disabled(self):
+        self.config.dns_cache_ttl = 0
+        with LocalServer(self.ROUTES) as server:
+            network.fetch(server.url.replace('127.0.0.1', 'localhost'),
+                          self.config)
+        self.assertEqual(0, network.dns_cache.misses)
+        self.assertNotIsInstance(
+            network.get_session(self.config).get_adapter(server.url),
+            network.CachedDNSAdapter)
+
+    @print_test
+    def test_prewarm_resolves_each_host_once(self):
+        with LocalServer(self.ROUTES) as server:
+            host = server.url.replace('127.0.0.1', 'localhost')
+            reached = network.prewarm(
+                [host + '/world', host + '/sports', host + '/world',
+                 'http://nonexistent.invalid/'], self.config)
+            self.assertEqual(0, server.connections)
+            network.fetch(host + '/', self.config)
+        self.assertEqual(1, reached)
+        self.assertEqual(1, network.dns_cache.stats()['hosts'])
+        self.assertEqual(2, network.dns_cache.misses)
+        self.assertEqual(1, network.dns_cache.hits)
+
+
+class ProxyPoolTestCase(unittest.TestCase):
+    TARGET = 'http://news.example/2019/01/01/story.html'
+
+    def setUp(self):
+        self.original_pool = proxies.pool
+        proxies.pool = proxies.ProxyPool()
+        self.config = Configuration()
+        self.config.max_retries = 0
+
+    def tearDown(self):
+        proxies.pool = self.original_pool
+        network.close_session(self.config)
+
+    def stand_in(self, name, status=200):
+        return LocalServer({'*': (status, {}, '<html>%s</html>' % name)})
+
+    def dead_proxy(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        url = 'http://127.0.0.1:%d' % sock.getsockname()[1]
+        sock.close()
+        return url
+
+    @print_test
+    def test_requests_rotate_over_the_pool(self):
+        with self.stand_in('a') as a, self.stand_in('b') as b:
+            self.config.proxy_pool = [a.url, b.url]
+            htmls = [network.get_html(self.TARGET, self.config)
+                     for _ in range(30)]
+        self.assertEqual({'<html>a</html>', '<html>b</html>'}, set(htmls))
+        self.assertEqual(self.TARGET, a.requests[0][0])
+        stats = proxies.pool.stats()
+        self.assertEqual(30, sum(s['requests'] for s in stats.values()))
+
+    @print_test
+    def test_failing_proxy_is_quarantined(self):
+        dead = self.dead_proxy()
+        with self.stand_in('alive') as alive:
+            self.config.proxy_pool = [dead]
+            for _ in range(3):
+                with self.assertRaises(requests.exceptions.ProxyError):
+                    network.fetch(self.TARGET, self.config)
+            self.config.proxy_pool = [dead, alive.url]
+            htmls = [network.get_html(self.TARGET, self.config)
+                     for _ in range(10)]
+        stats = proxies.pool.stats()
+        self.assertEqual(['<html>alive</html>'] * 10, htmls)
+        self.assertTrue(stats[dead]['quarantined'])
+        self.assertEqual(3, stats[dead]['failures'])
+        self.assertGreater(stats[dead]['error_rate'], 0)
+        self.assertFalse(stats[alive.url]['quarantined'])
+
+    @print_test
+    def test_ban_statuses_count_as_failures(self):
+        with self.stand_in('banned', 407) as banned:
+            self.config.proxy_pool = [banned.url]
+            for _ in range(3):
+                network.get_html(self.TARGET, self.config)
+        stats = proxies.pool.stats()[banned.url]
+        self.assertEqual(3, stats['failures'])
+        self.assertTrue(stats['quarantined'])
+
+    @print_test
+    def test_prewarm_leaves_proxied_hosts_to_the_proxy(self):
+        original_cache = network.dns_cache
+        cache = network.dns_cache = network.DNSCache()
+        try:
+            with self.stand_in('a') as a:
+                self.config.proxy_pool = [a.url]
+                reached = network.prewarm([self.TARGET], self.config)
+        finally:
+            network.dns_cache = original_cache
+        self.assertEqual(0, reached)
+        self.assertEqual([], a.requests)
+        self.assertEqual(0, cache.misses)
+
+    @print_test
+    def test_hosts_stick_to_one_proxy(self):
+        with self.stand_in('a') as a, self.stand_in('b') as b:
+            self.config.proxy_pool = [a.url, b.url]
+            self.config.proxy_rotation = 'host'
+            htmls = {network.get_html(self.TARGET, self.config)
+                     for _ in range(10)}
+        self.assertEqual(1, len(htmls))
+        self.assertEqual({'news.example'}, set(proxies.pool.hosts))
+
+
+class RobotsTestCase(unittest.TestCase):
+    ROUTES = {
+        '/robots.txt': (200, {'Content-Type': 'text/plain'},
+                        'User-agent: *\nDisallow: /private/\nCrawl-delay: 1\n'),
+        '/2019/01/01/public.html': (200, {}, '<html>public</html>'),
+        '/2019/01/02/public.html': (200, {}, '<html>public</html>'),
+        '/private/2019/01/01/secret.html': (200, {}, '<html>secret</html>'),
+    }
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.original_cache = robots.cache
+        robots.cache = robots.RobotsCache(self.directory)
+        self.config = Configuration()
+        self.config.respect_robots_txt = True
+
+    def tearDown(self):
+        robots.cache = self.original_cache
+
+    def robots_fetches(self, server):
+        return len([p for p, _ in server.requests if p == '/robots.txt'])
+
+    @print_test
+    def test_rules_are_fetched_once_and_kept_on_disk(self):
+        with LocalServer(self.ROUTES) as server:
+            self.assertTrue(robots.can_fetch(
+                server.url + '/2019/01/01/public.html', self.config))
+            self.assertFalse(robots.can_fetch(
+                server.url + '/private/2019/01/01/secret.html', self.config))
+            self.assertEqual(1, robots.crawl_delay(server.url, self.config))
+            robots.cache = robots.RobotsCache(self.directory)
+            self.assertTrue(robots.can_fetch(server.url + '/', self.config))
+            self.assertEqual(1, self.robots_fetches(server))
+
+    @print_test
+    def test_missing_and_failing_robots_txt(self):
+        with LocalServer({}) as server:
+            self.assertTrue(robots.can_fetch(server.url + '/a', self.config))
+        with LocalServer({'/robots.txt': (503, {}, '')}) as server:
+            self.assertFalse(robots.can_fetch(server.url + '/a', self.config))
+
+    @print_test
+    def test_generate_articles_drops_disallowed_urls(self):
+        with LocalServer(self.ROUTES) as server:
+            source = Source(server.url, config=self.config)
+            source._generate_articles = lambda: [
+                Article(server.url + path) for path in self.ROUTES]
+            source.generate_articles()
+        self.assertEqual(3, len(source.articles))
+        self.assertFalse(any('/private/' in a.url for a in source.articles))
+
+    @print_test
+    def test_crawl_delay_paces_requests(self):
+        paths = ['/2019/01/01/public.html', '/2019/01/02/public.html']
+        starts = []
+
+        def timed(handler):
+            starts.append(time.time())
+            return 200, {}, '<html>public</html>'
+        routes = dict(self.ROUTES, **{p: timed for p in paths})
+        with LocalServer(routes) as server:
+            urls = [server.url + p for p in paths]
+            network.multithread_request(urls, self.config)
+            pool = NewsPool(self.config)
+            pool.set([Article(url) for url in urls], threads_per_source=2)
+            pool.join()
+            source = Source(server.url, config=self.config)
+            source.articles = [Article(url, config=self.config)
+                               for url in urls]
+            source.download_articles(threads=1)
+        self.assertEqual(6, len(starts))
+        for first in (0, 2, 4):
+            self.assertGreaterEqual(starts[first + 1] - starts[first], 0.9)
+
+    @print_test
+    def test_prefetch_reads_every_host_at_once(self):
+        def slow_robots(handler):
+            time.sleep(0.5)
+            return 200, {}, 'User-agent: *\nDisallow: /private/\n'
+
+        with contextlib.ExitStack() as stack:
+            servers = [stack.enter_context(
+                LocalServer({'/robots.txt': slow_robots})) for _ in range(3)]
+            urls = [server.url + '/a' for server in servers]
+            started = time.time()
+            robots.prefetch(urls + urls, self.config)
+            elapsed = time.time() - started
+            for url in urls:
+                self.assertTrue(robots.can_fetch(url, self.config))
+        self.assertLess(elapsed, 1.2)
+        self.assertEqual([1, 1, 1], [self.robots_fetches(server)
+                                     for server in servers])
+
+
+class RedirectMapTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.original_map = redirects.redirect_map
+        redirects.redirect_map = redirects.RedirectMap(self.directory)
+        self.routes = {
+            '/old': (301, {'Location': '/tracked'}, ''),
+            '/tracked': (302, {'Location': '/new'}, ''),
+            '/moved': (308, {'Location': '/new'}, ''),
+            '/new': (200, {}, '<html>new</html>'),
+        }
+
+    def tearDown(self):
+        redirects.redirect_map = self.original_map
+
+    def paths(self, server):
+        return [path for path, _ in server.requests]
+
+    @print_test
+    def test_permanent_redirects_are_skipped(self):
+        with LocalServer(self.routes) as server:
+            network.fetch(server.url + '/moved')
+            html, response = network.fetch(server.url + '/moved')
+        self.assertEqual(['/moved', '/new', '/new'], self.paths(server))
+        self.assertEqual('<html>new</html>', html)
+        self.assertEqual(server.url + '/new', response.url)
+
+    @print_test
+    def test_temporary_redirects_are_followed(self):
+        with LocalServer(self.routes) as server:
+            network.fetch(server.url + '/old')
+            network.fetch(server.url + '/old')
+        self.assertEqual(['/old', '/tracked', '/new', '/tracked', '/new'],
+                         self.paths(server))
+
+    @print_test
+    def test_redirects_are_kept_on_disk(self):
+        with LocalServer(self.routes) as server:
+            network.fetch(server.url + '/moved')
+            # written once per batch of downloads
+            self.assertEqual([], os.listdir(self.directory))
+            redirects.redirect_map.save()
+            redirects.redirect_map = redirects.RedirectMap(self.directory)
+            self.assertEqual(server.url + '/new', redirects.resolve(
+                server.url + '/moved', Configuration()))
+            config = Configuration()
+            config.redirect_ttl = 0
+            self.assertEqual(server.url + '/moved', redirects.resolve(
+                server.url + '/moved', config))
+
+    @print_test
+    def test_broken_redirect_is_forgotten(self):
+        with LocalServer(self.routes) as server:
+            network.fetch(server.url + '/moved')
+            server.routes['/new'] = (404, {}, 'gone')
+            with self.assertRaises(requests.exceptions.HTTPError):
+                network.fetch(server.url + '/moved')
+            network.get_html(server.url + '/moved')
+        self.assertEqual(['/moved', '/new', '/new', '/moved', '/new'],
+                         self.paths(server))
+
+    @print_test
+    def test_entries_are_capped_and_expire(self):
+        redirect_map = redirects.redirect_map
+        limit = redirects.MAX_REDIRECTS_PER_HOST
+        for i in range(limit + 1):
+            redirect_map.add('http://a.com/%d' % i, 'http://a.com/new')
+        entries = redirect_map.hosts['a.com']
+        self.assertEqual(limit, len(entries))
+        self.assertNotIn('http://a.com/0', entries)
+        self.assertIsNone(redirect_map.get('http://a.com/1', -1))
+        self.assertNotIn('http://a.com/1', entries)
+        redirect_map.save()
+        self.assertEqual(1, len(os.listdir(self.directory)))
+        self.assertFalse(redirect_map.dirty)
+
+    @requires_aio
+    @print_test
+    def test_async_redirects_are_remembered(self):
+        with LocalServer(self.routes) as server:
+            asyncio.run(aio.afetch(server.url + '/moved'))
+            asyncio.run(aio.afetch(server.url + '/moved'))
+        self.assertEqual(['/moved', '/new', '/new'], self.paths(server))
+
+    @print_test
+    def test_source_memoizes_final_urls(self):
+        with LocalServer(self.routes) as server:
+            network.fetch(server.url + '/moved')
+        source = Source(server.url, memoize_articles=False)
+        articles = [Article(server.url + '/moved', source_url=server.url)]
+        source.resolve_redirects(articles)
+        self.assertEqual(server.url + '/new', articles[0].url)
+
+
+class StreamingDownloadTestCase(unittest.TestCase):
+    ROUTES = {
+        '/long.html': (200, {}, '<html>' + 'x' * 5000 + '</html>'),
+        '/short.html': (200, {}, '<html>short</html>'),
+        '/video.mp4': (200, {'Content-Type': 'video/mp4'}, b'\0' * 5000),
+        '/doc.pdf': (200, {'Content-Type': 'application/pdf'}, b'%PDF-'),
+    }
+
+    def setUp(self):
+        self.config = Configuration()
+        self.config.max_html_bytes = 1000
+
+    @print_test
+    def test_body_cut_at_max_html_bytes(self):
+        with LocalServer(self.ROUTES) as server:
+            article = Article(server.url + '/long.html', config=self.config)
+            article.download()
+            short = Article(server.url + '/short.html', config=self.config)
+            short.download()
+        self.assertEqual(1000, len(article.html))
+        self.assertTrue(article.download_truncated)
+        self.assertEqual(ArticleDownloadState.SUCCESS, article.download_state)
+        self.assertEqual('<html>short</html>', short.html)
+        self.assertFalse(short.download_truncated)
+
+    @print_test
+    def test_source_reports_truncation(self):
+        self.config.memoize_articles = False
+        with LocalServer(self.ROUTES) as server:
+            for threads in (1, 2):
+                source = Source(server.url, config=self.config)
+                source.articles = [
+                    Article(server.url + path, config=self.config)
+                    for path in ('/long.html', '/short.html')]
+                source.download_articles(threads=threads)
+                long, short = source.articles
+                self.assertEqual(1000, len(long.html))
+                self.assertTrue(long.download_truncated)
+                self.assertFalse(short.download_truncated)
+
+    @print_test
+    def test_non_html_content_type_aborted(self):
+        self.config.ignored_content_types_defaults = {
+            'application/pdf': '%PDF-'}
+        with LocalServer(self.ROUTES) as server:
+            video = Article(server.url + '/video.mp4', config=self.config)
+            video.download()
+            self.assertEqual('%PDF-', network.get_html(
+                server.url + '/doc.pdf', self.config))
+            self.assertEqual('', network.get_html(
+                server.url + '/video.mp4', self.config))
+        self.assertEqual(ArticleDownloadState.FAILED_RESPONSE,
+                         video.download_state)
+        self.assertIn('video/mp4', video.download_exception_msg)
+
+    @print_test
+    @requires_aio
+    def test_async_body_cut_at_max_html_bytes(self):
+        with LocalServer(self.ROUTES) as server:
+            article = Article(server.url + '/long.html', config=self.config)
+            asyncio.run(article.adownload())
+            video = Article(server.url + '/video.mp4', config=self.config)
+            asyncio.run(video.adownload())
+        self.assertEqual(1000, len(article.html))
+        self.assertTrue(article.download_truncated)
+        self.assertEqual(ArticleDownloadState.FAILED_RESPONSE,
+                         video.download_state)
+
+
+class ContentCodingTestCase(unittest.TestCase):
+    HTML = '<html><body>%s</body></html>' % ('<p>Compressible</p>' * 5000)
+
+    def setUp(self):
+        network.transfers.reset()
+        self.routes = {'/page': (200, {'Content-Encoding': 'gzip'},
+                                 gzip.compress(self.HTML.encode('utf-8')))}
+
+    def tearDown(self):
+        network.transfers.reset()
+
+    @print_test
+    def test_accept_encoding(self):
+        decodable = network._decodable_codings()
+        self.assertTrue({'gzip', 'deflate'} <= decodable)
+        value = network.accept_encoding(('zstd', 'br', 'gzip', 'deflate'))
+        self.assertEqual([c for c in ('zstd', 'br', 'gzip', 'deflate')
+                          if c in decodable], value.split(', '))
+        self.assertEqual('deflate, gzip',
+                         network.accept_encoding(('deflate', 'gzip')))
+
+        config = Configuration()
+        headers = {'User-Agent': 'ua', 'accept-encoding': 'identity'}
+        self.assertIs(headers, network._negotiated(headers, config))
+        config.content_codings = []
+        self.assertNotIn('Accept-Encoding',
+                         network._negotiated({'User-Agent': 'ua'}, config))
+
+    @print_test
+    @requires_aio
+    def test_wire_and_decoded_bytes(self):
+        with LocalServer(self.routes) as server:
+            html = network.fetch(server.url + '/page')[0]
+            asyncio.run(aio.afetch(server.url + '/page'))
+        self.assertEqual(self.HTML, html)
+        for _, headers in server.requests:
+            self.assertIn('gzip', headers['Accept-Encoding'])
+        stats = network.transfers.stats()[get_domain(server.url)]
+        self.assertEqual(2, stats['responses'])
+        self.assertEqual({'gzip': 2}, stats['codings'])
+        self.assertEqual(2 * len(self.HTML), stats['decoded_bytes'])
+        self.assertEqual(2 * len(self.routes['/page'][2]),
+                         stats['wire_bytes'])
+        self.assertGreater(stats['ratio'], 10)
+
+    @print_test
+    def test_limit_applies_to_decoded_bytes(self):
+        config = Configuration()
+        config.max_html_bytes = 20000
+        with LocalServer(self.routes) as server:
+            response = network.fetch(server.url + '/page', config)[1]
+        self.assertTrue(response.truncated)
+        self.assertLess(len(response.content), len(self.HTML))
+        stats = network.transfers.stats()[get_domain(server.url)]
+        self.assertLess(stats['decoded_bytes'], len(self.HTML))
+
+
+@requires_aio
+class AsyncDownloadTestCase(unittest.TestCase):
+    ROUTES = {
+        '/2019/01/01/first.html': (200, {}, '<html>first</html>'),
+        '/2019/01/02/second.html': (200, {}, '<html>second</html>'),
+        '/2019/01/03/missing.html': (404, {}, 'gone'),
+    }
+
+    @print_test
+    def test_agather_html(self):
+        with LocalServer(self.ROUTES) as server:
+            urls = [server.url + path for path in self.ROUTES]
+            htmls = asyncio.run(aio.agather_html(urls))
+        self.assertEqual(['<html>first</html>', '<html>second</html>', ''],
+                         htmls)
+
+    @print_test
+    def test_article_adownload(self):
+        with LocalServer(self.ROUTES) as server:
+            article = Article(server.url + '/2019/01/01/first.html')
+            asyncio.run(article.adownload())
+            missing = Article(server.url + '/2019/01/03/missing.html')
+            asyncio.run(missing.adownload())
+        self.assertEqual('<html>first</html>', article.html)
+        self.assertEqual(ArticleDownloadState.SUCCESS, article.download_state)
+        self.assertEqual(ArticleDownloadState.FAILED_RESPONSE,
+                         missing.download_state)
+
+    @print_test
+    def test_calls_outside_a_block_share_a_session(self):
+        config = Configuration()
+
+        async def fetch_twice(url):
+            await aio.afetch(url, config)
+            await aio.afetch(url, config)
+            return await aio.get_aio_session(config)
+
+        with LocalServer(self.ROUTES) as server:
+            url = server.url + '/2019/01/01/first.html'
+            session = asyncio.run(fetch_twice(url))
+            self.assertEqual(1, server.connections)
+            self.assertTrue(session.closed)
+            asyncio.run(aio.afetch(url, config))
+        self.assertEqual(2, server.connections)
+        self.assertEqual(3, len(server.requests))
+
+    @print_test
+    def test_async_news_pool(self):
+        with LocalServer(self.ROUTES) as server:
+            source = Source(server.url, memoize_articles=False)
+            source.articles = [Article(server.url + path)
+                               for path in self.ROUTES]
+            lone_article = Article(server.url + '/2019/01/02/second.html')
+            pool = AsyncNewsPool()
+            pool.set([source, lone_article])
+            asyncio.run(pool.join())
+        self.assertEqual(2, len(source.articles))
+        self.assertTrue(source.is_downloaded)
+        self.assertEqual('<html>second</html>', lone_article.html)
+
+    @print_test
+    def test_source_adownload_keeps_what_the_response_tells(self):
+        config = Configuration()
+        config.keep_html_bytes = True
+        config.max_html_bytes = 12
+        config.memoize_articles = False
+        with LocalServer(self.ROUTES) as server:
+            source = Source(server.url, config=config)
+            source.articles = [Article(server.url + path, config=config)
+                               for path in self.ROUTES]
+            asyncio.run(source.adownload_articles())
+        first, second = source.articles
+        self.assertEqual(b'<html>first<', first.html_bytes)
+        self.assertTrue(first.download_truncated)
+        self.assertEqual('utf-8', first.html_encoding)
+        self.assertEqual(b'<html>second', second.html_bytes)
+
+
 class ConfigBuildTestCase(unittest.TestCase):
     """Test if our **kwargs to config building setup actually works.
     NOTE: No need to mock responses as we are just initializing the